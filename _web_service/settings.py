@@ -140,6 +140,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "app_api.middleware.CRMCallerMiddleware",
 ]
 
 ROOT_URLCONF = "_web_service.urls"
@@ -216,6 +217,16 @@ MEDIA_ROOT = BASE_DIR / "media"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
+# Общий кэш (справочники CRM и ответы CRM)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6379/1",
+        "KEY_PREFIX": "kiberone",
+    }
+}
+
+
 # Настройки Celery
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_ACCEPT_CONTENT = ["json"]
@@ -239,6 +250,9 @@ LOGGING = {
             "format": "{levelname} {asctime} {module} {filename} {lineno} {message}",
             "style": "{",
         },
+        "crm_json": {
+            "()": "app_api.alfa_crm_service.crm_logging.CRMJsonFormatter",
+        },
     },
     "handlers": {
         "console": {
@@ -254,6 +268,14 @@ LOGGING = {
             "backupCount": 5,
             "formatter": "verbose",
         },
+        "crm_calls": {
+            "level": "INFO",
+            "class": "logging.handlers.RotatingFileHandler",
+            "filename": os.path.join(BASE_DIR, "crm_calls.log"),
+            "maxBytes": 10 * 1024 * 1024,  # 10 Мегабайт
+            "backupCount": 5,
+            "formatter": "crm_json",
+        },
     },
     "loggers": {
         "django": {
@@ -271,5 +293,11 @@ LOGGING = {
             "level": "INFO",
             "propagate": True,
         },
+        # Запросы к CRM: одна JSON-строка на запрос, успешные - выборочно (CRM_LOG_SAMPLE_RATE)
+        "app_api.crm_calls": {
+            "handlers": ["crm_calls"],
+            "level": os.getenv("CRM_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
     },
 }
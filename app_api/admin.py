@@ -1,2 +1,41 @@
 from django.contrib import admin
 
+from app_api.models import CRMSyncRun, CustomerPhone, Lesson, LessonMirrorBranch
+
+
+@admin.register(CustomerPhone)
+class CustomerPhoneAdmin(admin.ModelAdmin):
+    list_display = ["phone", "crm_branch_id", "crm_id", "is_study", "updated_at"]
+    list_filter = ["crm_branch_id", "is_study"]
+    search_fields = ["phone", "crm_id"]
+    readonly_fields = ["updated_at"]
+
+
+@admin.register(CRMSyncRun)
+class CRMSyncRunAdmin(admin.ModelAdmin):
+    list_display = [
+        "started_at", "mode", "status", "changed", "unchanged", "missing", "failed",
+        "cursor_branch_id", "cursor_crm_id", "resumed_count", "updated_at", "finished_at",
+    ]
+    list_filter = ["status", "mode"]
+    readonly_fields = [field.name for field in CRMSyncRun._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(Lesson)
+class LessonAdmin(admin.ModelAdmin):
+    list_display = ["date", "time_from", "crm_branch_id", "crm_lesson_id", "crm_customer_id", "status", "lesson_type_id", "is_attend"]
+    list_filter = ["status", "lesson_type_id", "crm_branch_id"]
+    search_fields = ["crm_customer_id", "crm_lesson_id"]
+    readonly_fields = ["updated_at"]
+
+
+@admin.register(LessonMirrorBranch)
+class LessonMirrorBranchAdmin(admin.ModelAdmin):
+    list_display = ["crm_branch_id", "schedule_loaded_at", "history_from", "history_to", "updated_at"]
+    readonly_fields = [field.name for field in LessonMirrorBranch._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
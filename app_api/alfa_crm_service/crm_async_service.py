@@ -0,0 +1,471 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator
+from urllib.parse import urlsplit
+
+import httpx
+
+from app_api.alfa_crm_service.crm_caller import get_crm_caller
+from app_api.alfa_crm_service.crm_circuit_breaker import get_circuit_breaker
+from app_api.alfa_crm_service.crm_coalescing import is_read_request, request_coalescer, request_key
+from app_api.alfa_crm_service.crm_logging import log_crm_call, response_body
+from app_api.alfa_crm_service.crm_metrics import observe_crm_request, observe_crm_retry
+from app_api.alfa_crm_service.crm_metrics_publisher import maybe_publish_metrics
+from app_api.alfa_crm_service.crm_rate_limiter import CRMRateLimitTimeout, rate_limiter
+from app_api.alfa_crm_service.crm_stream import ItemsStreamDecoder
+from app_api.alfa_crm_service.crm_token import token_manager
+from app_api.alfa_crm_service.crm_transport import crm_url, get_crm_transport
+
+logger = logging.getLogger(__name__)
+
+CRM_ASYNC_CONCURRENCY = int(os.getenv("CRM_ASYNC_CONCURRENCY", 8))  # Одновременных запросов в одной операции
+CRM_BULK_CHUNK_SIZE = int(os.getenv("CRM_BULK_CHUNK_SIZE", 50))  # Сколько id клиентов передавать в одном запросе
+CRM_PAGE_WINDOW = int(os.getenv("CRM_PAGE_WINDOW", 4))  # Сколько страниц одного метода загружать одновременно
+CRM_STREAM_BUFFER_PAGES = int(os.getenv("CRM_STREAM_BUFFER_PAGES", 4))  # Сколько загруженных страниц держать в памяти на источник
+MAX_RETRIES = 5  # Максимальное количество попыток
+RETRY_DELAY = 2  # Начальная задержка между попытками
+
+
+def run_async(coro):
+    """
+    Выполняет корутину из синхронного кода.
+    ---
+    Если в потоке уже запущен цикл событий (например, под ASGI),
+    корутина выполняется в отдельном потоке со своим циклом.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # Контекст (например, приоритет запросов к CRM) переносится в новый поток
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(context.run, asyncio.run, coro).result()
+
+
+class AsyncCRMSession:
+    """
+    Асинхронная сессия к CRM: один httpx-клиент и общий семафор
+    на все запросы, выполняемые внутри `async with`.
+    """
+
+    def __init__(self, concurrency: int = CRM_ASYNC_CONCURRENCY):
+        self.concurrency = concurrency
+        self.client: httpx.AsyncClient | None = None
+        self.semaphore: asyncio.Semaphore | None = None
+        self.token: str | None = None
+
+    async def __aenter__(self):
+        self.client = get_crm_transport().async_client()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.aclose()
+
+    async def get_token(self) -> str | None:
+        if self.token is None:
+            self.token = await asyncio.to_thread(token_manager.get_token)
+        return self.token
+
+    async def renew_token(self, rejected_token: str) -> str | None:
+        """
+        Повторная авторизация после 401. Запросы, получившие 401 одновременно,
+        сбрасывают токен один раз.
+        """
+        if self.token == rejected_token:
+            self.token = None
+            await asyncio.to_thread(token_manager.invalidate, rejected_token)
+        return await self.get_token()
+
+    async def request(
+        self, url: str, data: dict | None, params: dict | None = None, fields: tuple | None = None
+    ) -> dict | None:
+        """
+        Асинхронный аналог send_request_to_crm.
+        ---
+        Если заданы fields, ответ метода *index* читается потоком и записи
+        items сокращаются до этих полей по мере разбора (см. ItemsStreamDecoder).
+        """
+        if is_read_request(url):
+            return await request_coalescer.run_async(
+                request_key(url, data, params, fields), lambda: self._request(url, data, params, fields)
+            )
+        return await self._request(url, data, params, fields)
+
+    async def _post_streaming(self, url: str, data: dict | None, params: dict | None, headers: dict, fields: tuple):
+        """
+        POST с потоковым разбором ответа: (ответ, разобранная страница или None).
+        Тело ответа с ошибкой читается целиком для лога.
+        """
+        async with self.client.stream("POST", url, json=data, params=params, headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return response, None
+            decoder = ItemsStreamDecoder(fields)
+            items = []
+            async for chunk in response.aiter_bytes():
+                items.extend(decoder.feed(chunk))
+            try:
+                return response, {**decoder.close(), "items": items}
+            except ValueError as e:
+                logger.error("Ошибка разбора JSON. %s", e)
+                return response, None
+
+    async def _request(
+        self, url: str, data: dict | None, params: dict | None = None, fields: tuple | None = None
+    ) -> dict | None:
+        token = await self.get_token()
+        if not token:
+            logger.error("Токен отсутствует. Отмена запроса.")
+            return None
+
+        headers = {"X-ALFACRM-TOKEN": token}
+        retry_delay = RETRY_DELAY
+        token_renewed = False
+
+        breaker = get_circuit_breaker(url)
+        for attempt in range(MAX_RETRIES):
+            if not breaker.allow():
+                logger.error(f"CRM недоступна (предохранитель '{breaker.family}' разомкнут). Отмена запроса.")
+                return None
+
+            started = time.monotonic()
+            try:
+                async with self.semaphore:
+                    await rate_limiter.acquire_async(urlsplit(url).netloc)
+                    started = time.monotonic()
+                    if fields is None:
+                        response = await self.client.post(url, json=data, params=params, headers=headers)
+                    else:
+                        response, page = await self._post_streaming(url, data, params, headers, fields)
+            except httpx.HTTPError as e:
+                duration = time.monotonic() - started
+                breaker.record(duration, failed=True)
+                observe_crm_request(url, "error", duration, 0, get_crm_caller())
+                log_crm_call(url, "error", duration, caller=get_crm_caller())
+                logger.error("Ошибка при отправке запроса: %s", e)
+                return None
+            except CRMRateLimitTimeout as e:
+                # Запрос не отправлен: это не ошибка CRM, слот пробы освобождается
+                breaker.cancel()
+                logger.error("%s. Отмена запроса.", e)
+                return None
+            except BaseException:
+                # Отмена задачи: слот пробного запроса не должен потеряться
+                breaker.cancel()
+                raise
+            duration = time.monotonic() - started
+            breaker.record(duration, failed=response.status_code >= 500)
+            # Размер потокового ответа - по заголовку (тело уже разобрано по кускам)
+            size = len(response.content) if fields is None else int(response.headers.get("Content-Length", 0))
+            caller = get_crm_caller()
+            observe_crm_request(url, response.status_code, duration, size, caller)
+            log_crm_call(url, response.status_code, duration, size, caller, response)
+            maybe_publish_metrics()
+
+            if response.status_code == 200:
+                if fields is not None:
+                    return page
+                try:
+                    return response.json()
+                except json.JSONDecodeError:
+                    logger.error("Ошибка декодирования JSON. Ответ: %s", response_body(response))
+                    return None
+            elif response.status_code == 401:
+                if not token_renewed:
+                    logger.warning("CRM отклонила токен. Повторная авторизация...")
+                    token = await self.renew_token(token)
+                    if token:
+                        headers["X-ALFACRM-TOKEN"] = token
+                        token_renewed = True
+                        observe_crm_retry(url, 401, get_crm_caller())
+                        continue
+                logger.error("Неавторизованный запрос. Отмена запроса.")
+                return None
+            elif response.status_code == 429:
+                logger.warning("Слишком много запросов. Повторная попытка через %s секунд...", retry_delay)
+                observe_crm_retry(url, 429, get_crm_caller())
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2
+                continue
+            else:
+                logger.error("Неожиданный статус: %s. Тело: %s", response.status_code, response_body(response))
+                return None
+
+        logger.error("Достигнуто максимальное количество попыток. Запрос не выполнен.")
+        return None
+
+    async def gather(
+        self, calls: list[tuple[str, dict | None, dict | None]], fields: tuple | None = None
+    ) -> list[dict | None]:
+        """
+        Выполняет независимые запросы (url, data, params) одновременно.
+        Результаты возвращаются в порядке запросов.
+        """
+        return await asyncio.gather(*(self.request(url, data, params, fields) for url, data, params in calls))
+
+
+async def find_user_by_phone_async(phone_number: str, targets) -> dict:
+    """
+    Поиск пользователя по номеру телефона сразу во всех парах (филиал, is_study) targets.
+    """
+    calls = [
+        (crm_url(f"{branch}/customer/index"), {"is_study": status, "page": 0, "phone": phone_number}, None)
+        for branch, status in targets
+    ]
+    logger.info(f"Поиск по телефону {phone_number}: {len(calls)} запросов к CRM")
+
+    async with AsyncCRMSession() as session:
+        responses = await session.gather(calls)
+    results = [result for result in responses if result is not None]
+
+    return {
+        "failed_requests": len(responses) - len(results),
+        "total": sum(int(result.get("total", 0)) for result in results),
+        "count": sum(int(result.get("count", 0)) for result in results),
+        "items": [item for result in results for item in result.get("items", [])],
+    }
+
+
+async def fetch_all_pages_async(
+    session: AsyncCRMSession, url: str, data: dict | None = None, fields: tuple | None = None
+) -> list[dict] | None:
+    """
+    Загружает все страницы метода *index*: первая страница показывает
+    total и размер страницы, остальные запрашиваются одновременно.
+    Возвращает None, если первую страницу получить не удалось.
+    fields - какие поля записей оставить (см. AsyncCRMSession.request).
+    """
+    data = dict(data or {})
+    first_page = await session.request(url, {**data, "page": 0}, fields=fields)
+    if not first_page:
+        return None
+
+    items = list(first_page.get("items", []))
+    page_size = len(items)
+    total = int(first_page.get("total", 0) or 0)
+    if page_size == 0 or total <= page_size:
+        return items
+
+    last_page = (total - 1) // page_size
+    other_pages = await session.gather(
+        [(url, {**data, "page": page}, None) for page in range(1, last_page + 1)], fields
+    )
+    for page, response in enumerate(other_pages, start=1):
+        if response is None:
+            logger.error(f"Не удалось получить страницу {page} для {url}")
+            return None
+        items.extend(response.get("items", []))
+    return items
+
+
+async def fetch_all_items_async(url: str, data: dict | None = None, fields: tuple | None = None) -> list[dict] | None:
+    """
+    fetch_all_pages_async в собственной сессии.
+    """
+    async with AsyncCRMSession() as session:
+        return await fetch_all_pages_async(session, url, data, fields)
+
+
+async def iter_pages_async(
+    session: AsyncCRMSession,
+    url: str,
+    data: dict | None = None,
+    window: int = CRM_PAGE_WINDOW,
+    fields: tuple | None = None,
+) -> AsyncIterator[list[dict]]:
+    """
+    Отдает страницы метода *index* по порядку.
+    ---
+    После первой страницы, которая показывает total и размер страницы,
+    следующие запрашиваются скользящим окном по window страниц: пока
+    отдается текущая страница, следующие уже загружаются.
+    Если страницу получить не удалось, загрузка прекращается.
+    """
+    data = dict(data or {})
+    first_page = await session.request(url, {**data, "page": 0}, fields=fields)
+    if not first_page:
+        logger.error(f"Не удалось получить страницу 0 для {url}")
+        return
+
+    items = first_page.get("items", [])
+    if not items:
+        return
+    yield items
+
+    page_size = len(items)
+    total = int(first_page.get("total", 0) or 0)
+    if total <= page_size:
+        return
+
+    last_page = (total - 1) // page_size
+    next_page = 1
+    pending = deque()
+    try:
+        while pending or next_page <= last_page:
+            while next_page <= last_page and len(pending) < window:
+                task = asyncio.create_task(session.request(url, {**data, "page": next_page}, fields=fields))
+                pending.append((next_page, task))
+                next_page += 1
+
+            page, task = pending.popleft()
+            response = await task
+            if response is None:
+                logger.error(f"Не удалось получить страницу {page} для {url}")
+                return
+            items = response.get("items", [])
+            if not items:
+                # Записей стало меньше, чем было в total на первой странице
+                return
+            yield items
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+
+_END_OF_STREAM = object()
+
+
+def stream_all_items(
+    sources: list[tuple[str, dict | None]],
+    window: int = CRM_PAGE_WINDOW,
+    buffer_pages: int = CRM_STREAM_BUFFER_PAGES,
+    fields: tuple | None = None,
+) -> Iterator[dict]:
+    """
+    Потоковая загрузка всех записей нескольких методов *index* (url, data).
+    ---
+    Страницы загружаются в фоновом потоке с собственным циклом событий:
+    источники (например, филиалы) - одновременно, страницы каждого
+    источника - окном по window запросов. Записи отдаются по порядку:
+    сначала все записи первого источника, затем второго и т.д.
+    На каждый источник в памяти держится не больше buffer_pages страниц,
+    а с fields - только нужные поля записей, разобранные из потока ответа.
+    """
+    buffers = [queue.Queue(maxsize=buffer_pages) for _ in sources]
+    stopped = threading.Event()
+
+    def put(buffer: queue.Queue, value) -> bool:
+        # Ждем место в буфере, пока потребитель не прекратил чтение
+        while not stopped.is_set():
+            try:
+                buffer.put(value, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def pump(session: AsyncCRMSession, url: str, data: dict | None, buffer: queue.Queue):
+        try:
+            async for page in iter_pages_async(session, url, data, window, fields):
+                if not await asyncio.to_thread(put, buffer, page):
+                    return
+        except Exception as e:
+            await asyncio.to_thread(put, buffer, e)
+            return
+        await asyncio.to_thread(put, buffer, _END_OF_STREAM)
+
+    async def produce():
+        async with AsyncCRMSession() as session:
+            await asyncio.gather(
+                *(pump(session, url, data, buffer) for (url, data), buffer in zip(sources, buffers))
+            )
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as e:
+            for buffer in buffers:
+                put(buffer, e)
+
+    # Контекст (например, приоритет запросов к CRM) переносится в фоновый поток
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), daemon=True).start()
+
+    try:
+        for buffer in buffers:
+            while True:
+                page = buffer.get()
+                if page is _END_OF_STREAM:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+    finally:
+        stopped.set()
+
+
+async def fetch_customers_by_ids_async(session: AsyncCRMSession, branch_id, crm_ids) -> dict[int, dict]:
+    """
+    Загружает клиентов филиала по списку id: id передаются в customer/index
+    пачками по CRM_BULK_CHUNK_SIZE, пачки запрашиваются одновременно.
+    Возвращает словарь id -> запись клиента; не найденных клиентов в нем нет.
+    """
+    ids = sorted({int(crm_id) for crm_id in crm_ids})
+    url = crm_url(f"{branch_id}/customer/index")
+    chunks = [ids[start:start + CRM_BULK_CHUNK_SIZE] for start in range(0, len(ids), CRM_BULK_CHUNK_SIZE)]
+
+    pages = await asyncio.gather(
+        *(fetch_all_pages_async(session, url, {"id": chunk, "is_study": 2}) for chunk in chunks)
+    )
+
+    customers = {}
+    for chunk, items in zip(chunks, pages):
+        if items is None:
+            logger.error(f"Не удалось получить клиентов филиала {branch_id}: {chunk}")
+            continue
+        for item in items:
+            if item.get("id") is not None:
+                customers[int(item["id"])] = item
+    return customers
+
+
+async def find_clients_by_ids_async(branch_id, crm_ids) -> dict[int, dict]:
+    async with AsyncCRMSession() as session:
+        return await fetch_customers_by_ids_async(session, branch_id, crm_ids)
+
+
+async def find_clients_by_id_async(clients: list[tuple]) -> list[dict | None]:
+    """
+    Поиск нескольких клиентов по парам (branch_id, crm_id): клиенты каждого
+    филиала загружаются пачками, филиалы - одновременно.
+    ---
+    Пары без филиала или с нечисловым crm_id в CRM не ищутся: на их местах
+    в результате None, остальные клиенты находятся как обычно.
+    """
+    branch_ids = defaultdict(set)
+    keys = []
+    for branch_id, crm_id in clients:
+        try:
+            key = (branch_id, int(crm_id)) if branch_id is not None else None
+        except (TypeError, ValueError):
+            key = None
+        if key is None:
+            logger.error(f"Некорректный ID клиента {crm_id!r} (филиал {branch_id}), клиент не запрашивается")
+        else:
+            branch_ids[branch_id].add(key[1])
+        keys.append(key)
+
+    async with AsyncCRMSession() as session:
+        branch_customers = await asyncio.gather(
+            *(fetch_customers_by_ids_async(session, branch_id, ids) for branch_id, ids in branch_ids.items())
+        )
+    found = dict(zip(branch_ids, branch_customers))
+
+    results = []
+    for key in keys:
+        customer = found[key[0]].get(key[1]) if key is not None else None
+        if key is not None and customer is None:
+            logger.error(f"Клиент с ID {key[1]} не найден")
+        results.append(customer)
+    return results
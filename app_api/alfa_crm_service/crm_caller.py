@@ -0,0 +1,49 @@
+import contextvars
+from contextlib import contextmanager
+
+from celery.signals import task_postrun, task_prerun
+
+CALLER_UNKNOWN = "unknown"
+
+_crm_caller: contextvars.ContextVar[str] = contextvars.ContextVar("crm_caller", default=CALLER_UNKNOWN)
+
+
+def get_crm_caller() -> str:
+    return _crm_caller.get()
+
+
+def set_crm_caller(caller: str) -> contextvars.Token:
+    return _crm_caller.set(caller)
+
+
+@contextmanager
+def crm_caller(caller: str):
+    """
+    Задает код (view, задачу, команду), от имени которого идут запросы к CRM внутри блока.
+    """
+    token = _crm_caller.set(caller)
+    try:
+        yield
+    finally:
+        _crm_caller.reset(token)
+
+
+_task_caller_tokens: dict[str, contextvars.Token] = {}
+
+
+@task_prerun.connect
+def _set_task_caller(task_id=None, task=None, **kwargs):
+    """
+    Запросы Celery-задачи подписываются ее именем.
+    """
+    _task_caller_tokens[task_id] = _crm_caller.set(getattr(task, "name", None) or CALLER_UNKNOWN)
+
+
+@task_postrun.connect
+def _reset_task_caller(task_id=None, **kwargs):
+    token = _task_caller_tokens.pop(task_id, None)
+    if token is not None:
+        try:
+            _crm_caller.reset(token)
+        except ValueError:
+            _crm_caller.set(CALLER_UNKNOWN)
@@ -0,0 +1,194 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+from app_api.alfa_crm_service.crm_metrics import parse_crm_url, registry
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"  # Запросы идут в CRM
+STATE_OPEN = "open"  # Запросы сразу завершаются ошибкой
+STATE_HALF_OPEN = "half_open"  # Пробные запросы проверяют, восстановилась ли CRM
+
+CRM_BREAKER_WINDOW = float(os.getenv("CRM_BREAKER_WINDOW", 30))  # За сколько секунд считается доля ошибок
+CRM_BREAKER_MIN_CALLS = int(os.getenv("CRM_BREAKER_MIN_CALLS", 10))  # Меньше запросов в окне - не размыкаем
+CRM_BREAKER_FAILURE_RATE = float(os.getenv("CRM_BREAKER_FAILURE_RATE", 0.5))  # Доля ошибок для размыкания
+CRM_BREAKER_SLOW_CALL = float(os.getenv("CRM_BREAKER_SLOW_CALL", 5))  # Запрос дольше стольких секунд считается медленным
+CRM_BREAKER_SLOW_RATE = float(os.getenv("CRM_BREAKER_SLOW_RATE", 0.8))  # Доля медленных запросов для размыкания
+CRM_BREAKER_OPEN_SECONDS = float(os.getenv("CRM_BREAKER_OPEN_SECONDS", 30))  # Сколько держать разомкнутым до пробы
+CRM_BREAKER_HALF_OPEN_PROBES = int(os.getenv("CRM_BREAKER_HALF_OPEN_PROBES", 1))  # Одновременных пробных запросов
+
+CRM_BREAKER_TRANSITIONS = registry.counter(
+    "crm_circuit_breaker_transitions_total",
+    "Переключения предохранителя запросов к CRM",
+    ("family", "state"),
+)
+
+
+class CRMUnavailableError(requests.ConnectionError):
+    """
+    Предохранитель разомкнут: запрос к CRM не отправлялся.
+    ---
+    Наследуется от ConnectionError, чтобы существующая обработка
+    ошибок requests срабатывала так же, как при недоступной CRM.
+    """
+
+
+def endpoint_family(url: str) -> str:
+    """
+    Группа методов API по URL: 1/customer/index -> customer, auth/login -> auth.
+    """
+    _, endpoint = parse_crm_url(url)
+    return endpoint.split("/", 1)[0]
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для группы методов CRM (в памяти процесса).
+    ---
+    1. В замкнутом состоянии запоминает исход и длительность запросов
+       за последние CRM_BREAKER_WINDOW секунд.
+    2. Если доля ошибок или медленных запросов превысила порог,
+       размыкается: запросы сразу завершаются CRMUnavailableError.
+    3. Через CRM_BREAKER_OPEN_SECONDS пропускает пробные запросы:
+       успешная проба замыкает предохранитель, неудачная - снова размыкает.
+    """
+
+    def __init__(
+        self,
+        family: str,
+        window: float = CRM_BREAKER_WINDOW,
+        min_calls: int = CRM_BREAKER_MIN_CALLS,
+        failure_rate: float = CRM_BREAKER_FAILURE_RATE,
+        slow_call: float = CRM_BREAKER_SLOW_CALL,
+        slow_rate: float = CRM_BREAKER_SLOW_RATE,
+        open_seconds: float = CRM_BREAKER_OPEN_SECONDS,
+        half_open_probes: int = CRM_BREAKER_HALF_OPEN_PROBES,
+    ):
+        self.family = family
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._calls: deque[tuple[float, bool, bool]] = deque()  # (время, ошибка, медленный)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == STATE_OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return STATE_HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        Можно ли отправить запрос. В полуоткрытом состоянии занимает слот пробы,
+        который освобождается в record().
+        """
+        with self._lock:
+            if self._state == STATE_CLOSED:
+                return True
+            if self._state == STATE_OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._transition(STATE_HALF_OPEN)
+            if self._probes >= self.half_open_probes:
+                return False
+            self._probes += 1
+            return True
+
+    def record(self, duration: float, failed: bool):
+        """
+        Запоминает исход запроса, пропущенного allow().
+        """
+        slow = duration >= self.slow_call
+        now = time.monotonic()
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._calls.clear()
+                    self._transition(STATE_CLOSED)
+                return
+            if self._state == STATE_OPEN:
+                return
+
+            self._calls.append((now, failed, slow))
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._calls.popleft()
+
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, call_failed, _ in self._calls if call_failed)
+            slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_rate:
+                logger.error(
+                    f"Предохранитель CRM '{self.family}' разомкнут: ошибок {failures}/{total}, медленных {slow_calls}/{total}"
+                )
+                self._open(now)
+
+    def cancel(self):
+        """
+        Освобождает слот пробы, если запрос отменен до получения ответа.
+        """
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+
+    def _open(self, now: float):
+        self._opened_at = now
+        self._probes = 0
+        self._calls.clear()
+        self._transition(STATE_OPEN)
+
+    def _transition(self, state: str):
+        if self._state != state:
+            logger.warning(f"Предохранитель CRM '{self.family}': {self._state} -> {state}")
+            self._state = state
+            CRM_BREAKER_TRANSITIONS.inc(family=self.family, state=state)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    """
+    Предохранитель группы методов, к которой относится URL.
+    """
+    family = endpoint_family(url)
+    breaker = _breakers.get(family)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(family, CircuitBreaker(family))
+    return breaker
+
+
+def breaker_states() -> dict[str, str]:
+    """
+    Состояние предохранителей всех групп методов, к которым были запросы.
+    """
+    return {family: breaker.state for family, breaker in list(_breakers.items())}
+
+
+def crm_available(family: str | None = None) -> bool:
+    """
+    False, если предохранитель группы (или любой группы, если она не указана) разомкнут.
+    """
+    if family is not None:
+        breaker = _breakers.get(family)
+        return breaker is None or breaker.state != STATE_OPEN
+    return all(state != STATE_OPEN for state in breaker_states().values())
@@ -0,0 +1,220 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlsplit
+
+import redis
+
+from app_api.alfa_crm_service.crm_metrics import registry
+from app_api.alfa_crm_service.crm_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CRM_COALESCE_REDIS = os.getenv("CRM_COALESCE_REDIS", "0") == "1"  # Объединять запросы и между процессами
+CRM_COALESCE_LOCK_TTL = float(os.getenv("CRM_COALESCE_LOCK_TTL", 15))  # Сколько секунд ждать чужой запрос
+CRM_COALESCE_RESULT_TTL = int(os.getenv("CRM_COALESCE_RESULT_TTL", 5))  # Сколько секунд ответ ждет ожидающие процессы
+CRM_COALESCE_POLL_INTERVAL = 0.05
+
+# Методы только для чтения: их одинаковые запросы можно объединять
+READ_ACTIONS = {"index", "customer", "balance-bonus"}
+
+CRM_COALESCED_REQUESTS = registry.counter(
+    "crm_coalesced_requests_total",
+    "Запросы к CRM, получившие ответ одновременного одинакового запроса",
+    ("mode",),
+)
+
+
+def is_read_request(url: str) -> bool:
+    action = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+    return action in READ_ACTIONS
+
+
+def request_key(url: str, data: dict | None, params: dict | None, fields: tuple | None = None) -> str:
+    # Ответы с разным набором полей (fields) - разные запросы
+    request = [url, data, params] if fields is None else [url, data, params, list(fields)]
+    payload = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class LeaderCancelled(Exception):
+    """
+    Первый запрос с ключом прерван (отмена задачи, остановка процесса)
+    и ответа не будет: ожидающие выполняют запрос сами.
+    """
+
+
+class RequestCoalescer:
+    """
+    Объединение одинаковых одновременных запросов к CRM (single flight).
+    ---
+    Первый запрос с ключом выполняется, остальные, пришедшие до его
+    завершения, ждут и получают копию того же ответа. Синхронные и
+    асинхронные вызовы процесса ждут общий concurrent.futures.Future.
+    Асинхронный запрос выполняется отдельной задачей, поэтому отмена
+    первого вызвавшего не отменяет ответ остальным; если запрос все же
+    прерван, ожидающие выполняют его сами (LeaderCancelled).
+    В режиме Redis первый процесс ставит метку запроса в Redis, а
+    остальные процессы ждут его ответ, пока метка жива; если ответа
+    не дождались, они выполняют запрос сами.
+    """
+
+    def __init__(self, use_redis: bool = CRM_COALESCE_REDIS):
+        self.use_redis = use_redis
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, fetch: Callable[[], Any]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            CRM_COALESCED_REQUESTS.inc(mode="local")
+            try:
+                return copy.deepcopy(future.result())
+            except LeaderCancelled:
+                return fetch()
+
+        try:
+            result = self._fetch_shared(key, fetch)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def run_async(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            CRM_COALESCED_REQUESTS.inc(mode="local")
+            try:
+                # shield: отмена одного ожидающего не должна отменять общий Future
+                return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(future)))
+            except LeaderCancelled:
+                return await fetch()
+
+        # Запрос выполняется отдельной задачей: отмена первого вызвавшего
+        # (например, отмена оставшихся страниц) не отменяет его для ожидающих
+        task = asyncio.ensure_future(self._fetch_shared_async(key, fetch))
+        task.add_done_callback(lambda done: self._finish_task(key, future, done))
+        return await asyncio.shield(task)
+
+    def _finish_task(self, key: str, future: Future, task: asyncio.Task):
+        if task.cancelled():
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, task.result())
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                future.waiters = True
+                return future, False
+            future = self._inflight[key] = Future()
+            future.waiters = False
+            return future, True
+
+    def _finish(self, key: str, future: Future, result: Any = None, error: BaseException | None = None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            # Отмена или остановка первого вызвавшего не передается ожидающим
+            future.set_exception(error if isinstance(error, Exception) else LeaderCancelled(repr(error)))
+        else:
+            # Ожидающие получают отдельную копию: вызвавший может изменять свой ответ
+            future.set_result(copy.deepcopy(result) if future.waiters else result)
+
+    def _claim(self, key: str) -> bool:
+        """
+        True, если этот процесс выполняет запрос (или Redis недоступен).
+        """
+        try:
+            return bool(
+                get_redis_client().set(f"crm_inflight:{key}", os.getpid(), nx=True, px=int(CRM_COALESCE_LOCK_TTL * 1000))
+            )
+        except redis.RedisError as e:
+            logger.error(f"Redis недоступен, запрос к CRM выполняется без объединения: {e}")
+            return True
+
+    def _poll(self, key: str) -> tuple[bool, Any]:
+        """
+        (готово, ответ): ответ другого процесса или признак, что ждать больше нечего.
+        """
+        try:
+            redis_client = get_redis_client()
+            cached = redis_client.get(f"crm_result:{key}")
+            if cached is not None:
+                return True, json.loads(cached)
+            if not redis_client.exists(f"crm_inflight:{key}"):
+                return True, None
+        except redis.RedisError:
+            return True, None
+        return False, None
+
+    def _publish(self, key: str, result: Any):
+        try:
+            pipe = get_redis_client().pipeline()
+            if result is not None:
+                pipe.set(f"crm_result:{key}", json.dumps(result), ex=CRM_COALESCE_RESULT_TTL)
+            pipe.delete(f"crm_inflight:{key}")
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Не удалось передать ответ CRM другим процессам: {e}")
+
+    def _fetch_shared(self, key: str, fetch: Callable[[], Any]) -> Any:
+        if not self.use_redis:
+            return fetch()
+
+        if not self._claim(key):
+            deadline = time.monotonic() + CRM_COALESCE_LOCK_TTL
+            while time.monotonic() < deadline:
+                done, result = self._poll(key)
+                if done:
+                    if result is not None:
+                        CRM_COALESCED_REQUESTS.inc(mode="redis")
+                        return result
+                    break
+                time.sleep(CRM_COALESCE_POLL_INTERVAL)
+            return fetch()
+
+        result = None
+        try:
+            result = fetch()
+            return result
+        finally:
+            self._publish(key, result)
+
+    async def _fetch_shared_async(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.use_redis:
+            return await fetch()
+
+        # Клиент Redis блокирующий: его вызовы не должны останавливать цикл событий
+        if not await asyncio.to_thread(self._claim, key):
+            deadline = time.monotonic() + CRM_COALESCE_LOCK_TTL
+            while time.monotonic() < deadline:
+                done, result = await asyncio.to_thread(self._poll, key)
+                if done:
+                    if result is not None:
+                        CRM_COALESCED_REQUESTS.inc(mode="redis")
+                        return result
+                    break
+                await asyncio.sleep(CRM_COALESCE_POLL_INTERVAL)
+            return await fetch()
+
+        result = None
+        try:
+            result = await fetch()
+            return result
+        finally:
+            await asyncio.to_thread(self._publish, key, result)
+
+
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,142 @@
+import logging
+import os
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import OuterRef
+from django.utils import timezone
+
+from app_api.alfa_crm_service.crm_records import LessonRecord
+from app_api.models import Lesson, LessonMirrorBranch
+
+logger = logging.getLogger(__name__)
+
+LESSON_MIRROR_DAYS_BEFORE = int(os.getenv("LESSON_MIRROR_DAYS_BEFORE", 1))  # С какого дня (дней назад) обновлять расписание
+LESSON_MIRROR_DAYS_AHEAD = int(os.getenv("LESSON_MIRROR_DAYS_AHEAD", 14))  # По какой день (дней вперед) обновлять расписание
+LESSON_MIRROR_HISTORY_DAYS = int(os.getenv("LESSON_MIRROR_HISTORY_DAYS", 180))  # За сколько дней обновлять проведенные уроки
+LESSON_MIRROR_HISTORY_START = date.fromisoformat(os.getenv("LESSON_MIRROR_HISTORY_START", "2015-01-01"))  # С какой даты в CRM есть уроки (начало полной истории)
+LESSON_MIRROR_BACKFILL_DAYS = int(os.getenv("LESSON_MIRROR_BACKFILL_DAYS", 365))  # Окно загрузки полной истории, дней
+
+LESSON_TAUGHT = 3  # Статус проведенного урока
+
+
+def lesson_rows(branch_id: int, lesson: LessonRecord) -> list[Lesson]:
+    """
+    Строки зеркала по уроку CRM: по одной на каждого клиента урока.
+    """
+    if lesson.date is None:
+        return []
+    return [
+        Lesson(
+            crm_branch_id=branch_id,
+            crm_lesson_id=lesson.id,
+            crm_customer_id=customer_id,
+            date=lesson.date,
+            time_from=lesson.time_from.time() if lesson.time_from else None,
+            time_to=lesson.time_to.time() if lesson.time_to else None,
+            status=lesson.status,
+            lesson_type_id=lesson.lesson_type_id,
+            room_id=lesson.room_id,
+            is_attend=lesson.attended.get(customer_id, False),
+            reason_id=lesson.reasons.get(customer_id),
+        )
+        for customer_id in lesson.all_customer_ids
+    ]
+
+
+def mirror_branch_lessons(
+    branch_id: int,
+    items,
+    date_from: date,
+    date_to: date,
+    status: int | None = None,
+    batch_size: int = 500,
+) -> int:
+    """
+    Заменяет уроки филиала за даты date_from..date_to (и статус status,
+    если задан) выгрузкой lesson/index items. Возвращает число строк.
+    ---
+    Замена выполняется одной транзакцией: отмененные и перенесенные
+    в CRM уроки пропадают из зеркала, а при ошибке остаются прежние данные.
+    Загрузка отмечается в состоянии филиала (см. mark_branch_mirrored).
+    """
+    rows = {}
+    for item in items:
+        if item.get("id") is None:
+            continue
+        for row in lesson_rows(branch_id, LessonRecord.from_crm(item)):
+            rows[(row.crm_lesson_id, row.crm_customer_id)] = row
+
+    stale = Lesson.objects.filter(crm_branch_id=branch_id, date__range=(date_from, date_to))
+    if status is not None:
+        stale = stale.filter(status=status)
+    lesson_ids = sorted({lesson_id for lesson_id, _ in rows})
+    with transaction.atomic():
+        stale.delete()
+        # Урок мог сменить дату или статус, и его прежние строки лежат вне окна
+        for start in range(0, len(lesson_ids), batch_size):
+            Lesson.objects.filter(crm_branch_id=branch_id, crm_lesson_id__in=lesson_ids[start:start + batch_size]).delete()
+        Lesson.objects.bulk_create(rows.values(), batch_size=batch_size)
+        mark_branch_mirrored(branch_id, date_from, date_to, status)
+    return len(rows)
+
+
+def mark_branch_mirrored(branch_id: int, date_from: date, date_to: date, status: int | None = None):
+    """
+    Отмечает загрузку уроков филиала за даты date_from..date_to.
+    ---
+    Выгрузка без статуса - это расписание. Проведенные уроки есть в выгрузках
+    обоих видов, поэтому обе продлевают историю, если окно пересекается с уже
+    загруженной или примыкает к ней; иначе история начинается заново с окна.
+    """
+    state, _ = LessonMirrorBranch.objects.select_for_update().get_or_create(crm_branch_id=branch_id)
+    if status is None:
+        state.schedule_loaded_at = timezone.now()
+    if status in (None, LESSON_TAUGHT):
+        # Будущие уроки еще не проведены, история по ним не полна
+        date_to = min(date_to, timezone.localdate())
+        day = timedelta(days=1)
+        if state.history_to is not None and date_from <= state.history_to + day and date_to >= state.history_from - day:
+            state.history_from = min(state.history_from, date_from)
+            state.history_to = max(state.history_to, date_to)
+        elif date_from <= date_to:
+            state.history_from, state.history_to = date_from, date_to
+    state.save()
+
+
+def scheduled_branch_ids():
+    """
+    Филиалы, расписание которых загружено в зеркало хотя бы раз (для __in).
+    """
+    return LessonMirrorBranch.objects.filter(schedule_loaded_at__isnull=False).values("crm_branch_id")
+
+
+def history_branch_ids(fresh: bool = True):
+    """
+    Филиалы, проведенные уроки которых загружены без пропусков с
+    LESSON_MIRROR_HISTORY_START (для __in): только по ним отсутствие уроков
+    в зеркале означает, что у клиента их не было. С fresh история должна
+    быть загружена не раньше, чем по вчерашний день.
+    """
+    branches = LessonMirrorBranch.objects.filter(history_from__lte=LESSON_MIRROR_HISTORY_START)
+    if fresh:
+        branches = branches.filter(history_to__gte=timezone.localdate() - timedelta(days=1))
+    return branches.values("crm_branch_id")
+
+
+def client_lessons(**filters):
+    """
+    Уроки зеркала клиента внешнего запроса (для Exists): клиенты должны
+    быть аннотированы branch_int и crm_id_int (см. tracked_clients).
+    """
+    return Lesson.objects.filter(crm_branch_id=OuterRef("branch_int"), crm_customer_id=OuterRef("crm_id_int"), **filters)
+
+
+def first_lessons(lessons) -> dict[tuple[int, int], Lesson]:
+    """
+    Первый по времени урок каждого клиента: (филиал, id клиента в CRM) -> урок.
+    """
+    first = {}
+    for lesson in lessons.order_by("date", "time_from"):
+        first.setdefault((lesson.crm_branch_id, lesson.crm_customer_id), lesson)
+    return first
@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import random
+import time
+
+from app_api.alfa_crm_service.crm_metrics import parse_crm_url
+
+CRM_LOG_BODY_LIMIT = int(os.getenv("CRM_LOG_BODY_LIMIT", 500))  # Сколько символов тела запроса/ответа попадает в лог
+CRM_LOG_SAMPLE_RATE = float(os.getenv("CRM_LOG_SAMPLE_RATE", 0.01))  # Доля успешных запросов к CRM, попадающих в лог
+# Доля для отдельных методов: "customer/index=0.001,auth/login=1"
+CRM_LOG_SAMPLE_RATES = os.getenv("CRM_LOG_SAMPLE_RATES", "")
+
+# Один компактный event на каждый запрос к CRM (см. CRMJsonFormatter)
+crm_call_logger = logging.getLogger("app_api.crm_calls")
+
+
+def _parse_sample_rates(value: str) -> dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        endpoint, _, rate = item.partition("=")
+        if endpoint.strip() and rate.strip():
+            rates[endpoint.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_sample_rates(CRM_LOG_SAMPLE_RATES)
+
+
+class Truncated:
+    """
+    Тело запроса или ответа для лога.
+    ---
+    Строка формируется и обрезается до CRM_LOG_BODY_LIMIT символов
+    только если запись действительно выводится (ленивое форматирование).
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = CRM_LOG_BODY_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text)} символов)"
+        return text
+
+
+def response_body(response) -> Truncated:
+    """
+    Ленивое обрезанное тело ответа requests/httpx.
+    """
+    return Truncated(response.text)
+
+
+def is_sampled(endpoint: str) -> bool:
+    rate = SAMPLE_RATES.get(endpoint, CRM_LOG_SAMPLE_RATE)
+    return rate >= 1 or random.random() < rate
+
+
+def log_crm_call(url: str, status, duration: float, size: int = 0, caller: str = "", response=None):
+    """
+    Записывает event об одном HTTP-запросе к CRM.
+    ---
+    Ошибки (нет ответа или статус не 2xx) пишутся всегда, успешные
+    запросы - с вероятностью CRM_LOG_SAMPLE_RATE (или из CRM_LOG_SAMPLE_RATES
+    для метода). Тело ответа response попадает в лог только для ошибок.
+    """
+    failed = status == "error" or status >= 400
+    level = logging.WARNING if failed else logging.INFO
+    if not crm_call_logger.isEnabledFor(level):
+        return
+
+    branch, endpoint = parse_crm_url(url)
+    if not failed and not is_sampled(endpoint):
+        return
+
+    event = {
+        "endpoint": endpoint,
+        "branch": branch,
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        "bytes": size,
+        "caller": caller,
+    }
+    if failed and response is not None:
+        event["body"] = str(response_body(response))
+    crm_call_logger.log(level, "CRM %s %s %s %.3fs", endpoint, branch, status, duration, extra={"crm": event})
+
+
+class CRMJsonFormatter(logging.Formatter):
+    """
+    Однострочный JSON для лога запросов к CRM: время, уровень, сообщение
+    и поля event из extra={"crm": {...}}.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        payload.update(getattr(record, "crm", None) or {})
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
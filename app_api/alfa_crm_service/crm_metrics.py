@@ -0,0 +1,216 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric(ABC):
+    """
+    Базовая метрика: значения хранятся в памяти процесса по наборам меток.
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: dict | None = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.extend(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def snapshot(self) -> dict[tuple, object]:
+        """
+        Копия значений метрики по наборам меток.
+        """
+        with self._lock:
+            return {key: json.loads(json.dumps(value)) for key, value in self._values.items()}
+
+    @abstractmethod
+    def merge(self, values: dict[tuple, object], other: dict[tuple, object]):
+        """
+        Добавляет к values значения метрики другого процесса.
+        """
+
+    def render(self, values: dict[tuple, object] | None = None) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, values: dict[tuple, object], other: dict[tuple, object]):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values: dict[tuple, object] | None = None) -> list[str]:
+        lines = super().render()
+        values = self.snapshot() if values is None else values
+        for key, value in values.items():
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [счетчики по бакетам..., сумма, количество]
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def merge(self, values: dict[tuple, object], other: dict[tuple, object]):
+        for key, state in other.items():
+            if key in values:
+                values[key] = [current + added for current, added in zip(values[key], state)]
+            else:
+                values[key] = list(state)
+
+    def render(self, values: dict[tuple, object] | None = None) -> list[str]:
+        lines = super().render()
+        values = self.snapshot() if values is None else values
+        for key, state in values.items():
+            for bound, count in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, {'le': bound})} {count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, {'le': '+Inf'})} {state[-1]}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {state[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def dump(self) -> str:
+        """
+        Значения всех метрик процесса в JSON (для объединения между процессами).
+        """
+        return json.dumps(
+            {
+                name: [[list(key), value] for key, value in metric.snapshot().items()]
+                for name, metric in list(self._metrics.items())
+            }
+        )
+
+    def render_prometheus(self, dumps: list[str] | None = None) -> str:
+        """
+        Метрики в текстовом формате Prometheus: этого процесса или,
+        если переданы результаты dump() нескольких процессов, их сумма.
+        """
+        merged = None
+        if dumps is not None:
+            merged = {name: {} for name in self._metrics}
+            for dump in dumps:
+                for name, items in json.loads(dump).items():
+                    metric = self._metrics.get(name)
+                    if metric is not None:
+                        metric.merge(merged[name], {tuple(key): value for key, value in items})
+
+        lines = []
+        for name, metric in list(self._metrics.items()):
+            lines.extend(metric.render(merged[name] if merged is not None else None))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def parse_crm_url(url: str) -> tuple[str, str]:
+    """
+    (филиал, шаблон метода) по URL API: .../v2api/1/customer/index -> ("1", "customer/index").
+    Для методов без филиала (auth/login) филиал пустой.
+    """
+    path = urlsplit(url).path.split("/v2api/", 1)[-1].strip("/")
+    parts = [part for part in path.split("/") if part]
+    branch = parts.pop(0) if parts and parts[0].isdigit() else ""
+    return branch, "/".join(parts) or "unknown"
+
+
+CRM_RATE_LIMIT_WAIT = registry.histogram(
+    "crm_rate_limit_wait_seconds",
+    "Время ожидания разрешения ограничителя запросов к CRM",
+    ("host", "priority"),
+)
+
+CRM_REQUEST_DURATION = registry.histogram(
+    "crm_request_duration_seconds",
+    "Длительность HTTP-запросов к CRM",
+    ("endpoint", "branch", "caller"),
+)
+
+CRM_REQUESTS = registry.counter(
+    "crm_requests_total",
+    "HTTP-запросы к CRM по статусу ответа (error - ответа нет)",
+    ("endpoint", "branch", "status", "caller"),
+)
+
+CRM_RESPONSE_BYTES = registry.counter(
+    "crm_response_bytes_total",
+    "Объем ответов CRM в байтах",
+    ("endpoint", "branch", "caller"),
+)
+
+CRM_RETRIES = registry.counter(
+    "crm_retries_total",
+    "Повторные запросы к CRM по причине (401 - новый токен, 429 - превышен лимит)",
+    ("endpoint", "reason", "caller"),
+)
+
+
+def observe_crm_request(url: str, status, duration: float, size: int, caller: str):
+    """
+    Записывает метрики одного HTTP-запроса к CRM.
+    """
+    branch, endpoint = parse_crm_url(url)
+    CRM_REQUEST_DURATION.observe(duration, endpoint=endpoint, branch=branch, caller=caller)
+    CRM_REQUESTS.inc(endpoint=endpoint, branch=branch, status=status, caller=caller)
+    if size:
+        CRM_RESPONSE_BYTES.inc(size, endpoint=endpoint, branch=branch, caller=caller)
+
+
+def observe_crm_retry(url: str, reason, caller: str):
+    _, endpoint = parse_crm_url(url)
+    CRM_RETRIES.inc(endpoint=endpoint, reason=reason, caller=caller)
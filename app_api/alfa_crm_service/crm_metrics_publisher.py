@@ -0,0 +1,60 @@
+import logging
+import os
+import socket
+import time
+
+import redis
+
+from app_api.alfa_crm_service.crm_metrics import registry
+from app_api.alfa_crm_service.crm_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CRM_METRICS_REDIS = os.getenv("CRM_METRICS_REDIS", "0") == "1"  # Собирать метрики всех процессов через Redis
+CRM_METRICS_PUBLISH_INTERVAL = float(os.getenv("CRM_METRICS_PUBLISH_INTERVAL", 15))  # Как часто процесс выгружает метрики
+CRM_METRICS_TTL = int(os.getenv("CRM_METRICS_TTL", 5 * 60))  # Метрики остановленного процесса пропадают через это время
+
+_last_publish = 0.0
+
+
+def _process_key() -> str:
+    return f"crm_metrics:{socket.gethostname()}:{os.getpid()}"
+
+
+def publish_metrics():
+    """
+    Выгружает метрики процесса в Redis.
+    """
+    global _last_publish
+    _last_publish = time.monotonic()
+    try:
+        get_redis_client().set(_process_key(), registry.dump(), ex=CRM_METRICS_TTL)
+    except redis.RedisError as e:
+        logger.error(f"Не удалось выгрузить метрики CRM в Redis: {e}")
+
+
+def maybe_publish_metrics():
+    """
+    Выгружает метрики, если включен режим Redis и прошло CRM_METRICS_PUBLISH_INTERVAL.
+    """
+    if CRM_METRICS_REDIS and time.monotonic() - _last_publish >= CRM_METRICS_PUBLISH_INTERVAL:
+        publish_metrics()
+
+
+def render_metrics() -> str:
+    """
+    Метрики в формате Prometheus. В режиме Redis - сумма по всем процессам
+    (веб-воркерам и Celery), иначе - только текущего процесса.
+    """
+    if not CRM_METRICS_REDIS:
+        return registry.render_prometheus()
+
+    publish_metrics()
+    try:
+        redis_client = get_redis_client()
+        keys = list(redis_client.scan_iter("crm_metrics:*"))
+        dumps = [dump for dump in redis_client.mget(keys) if dump] if keys else []
+    except redis.RedisError as e:
+        logger.error(f"Не удалось получить метрики CRM из Redis: {e}")
+        return registry.render_prometheus()
+    return registry.render_prometheus(dumps)
@@ -0,0 +1,93 @@
+import logging
+import os
+from itertools import islice
+
+from django.core.cache import cache
+from django.db import transaction
+
+from app_api.alfa_crm_service.crm_records import CustomerRecord
+from app_api.models import CustomerPhone
+from app_api.utils.util_phone import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+CRM_PHONE_NEGATIVE_TTL = int(os.getenv("CRM_PHONE_NEGATIVE_TTL", 120))  # Сколько секунд помнить, что номера нет в CRM
+
+# Поля клиента CRM, которые нужны индексу (для выгрузки с fields)
+PHONE_INDEX_FIELDS = ("id", "phone", "branch_ids", "is_study")
+
+
+def _missing_key(phone: str) -> str:
+    return f"crm_phone_missing:{phone}"
+
+
+def get_phone_targets(phone: str) -> list[tuple[int, int]]:
+    """
+    Пары (филиал, is_study), в которых по индексу есть клиенты с этим номером.
+    """
+    return sorted(set(CustomerPhone.objects.filter(phone=phone).values_list("crm_branch_id", "is_study")))
+
+
+def is_phone_missing(phone: str) -> bool:
+    try:
+        return cache.get(_missing_key(phone)) is not None
+    except Exception as e:
+        logger.error(f"Кэш телефонов недоступен: {e}")
+        return False
+
+
+def remember_phone_missing(phone: str):
+    try:
+        cache.set(_missing_key(phone), 1, CRM_PHONE_NEGATIVE_TTL)
+    except Exception as e:
+        logger.error(f"Кэш телефонов недоступен: {e}")
+
+
+def forget_phone_missing(*phones: str):
+    try:
+        cache.delete_many([_missing_key(phone) for phone in phones])
+    except Exception as e:
+        logger.error(f"Кэш телефонов недоступен: {e}")
+
+
+def _customer_phones(customer: CustomerRecord, branch_id=None) -> list[CustomerPhone]:
+    branch_ids = customer.branch_ids or ([branch_id] if branch_id is not None else [])
+
+    rows = {}
+    for raw_phone in customer.phones:
+        phone = normalize_phone(raw_phone)
+        if not phone:
+            continue
+        for crm_branch_id in branch_ids:
+            rows[(phone, int(crm_branch_id))] = CustomerPhone(
+                phone=phone,
+                crm_branch_id=int(crm_branch_id),
+                crm_id=str(customer.id),
+                is_study=customer.is_study,
+            )
+    return list(rows.values())
+
+
+def index_customers(customers, branch_id=None, batch_size: int = 500) -> int:
+    """
+    Обновляет индекс по клиентам CRM: записям customer/index или CustomerRecord.
+    Телефоны каждого клиента заменяются целиком, записи обрабатываются
+    пачками по batch_size. Возвращает число записей индекса.
+    """
+    customers = (
+        customer if isinstance(customer, CustomerRecord) else CustomerRecord.from_crm(customer)
+        for customer in customers
+        if isinstance(customer, CustomerRecord) or customer.get("id") is not None
+    )
+
+    indexed = 0
+    while batch := list(islice(customers, batch_size)):
+        rows = [row for customer in batch for row in _customer_phones(customer, branch_id)]
+        crm_ids = {str(customer.id) for customer in batch}
+        with transaction.atomic():
+            CustomerPhone.objects.filter(crm_id__in=crm_ids).delete()
+            CustomerPhone.objects.bulk_create(rows, ignore_conflicts=True)
+
+        forget_phone_missing(*{row.phone for row in rows})
+        indexed += len(rows)
+    return indexed
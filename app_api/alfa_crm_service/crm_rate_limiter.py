@@ -0,0 +1,232 @@
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import redis
+import requests
+from celery.signals import task_postrun, task_prerun
+
+from app_api.alfa_crm_service.crm_metrics import CRM_RATE_LIMIT_WAIT
+from app_api.alfa_crm_service.crm_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"  # Запросы веб-приложения и бота
+PRIORITY_BATCH = "batch"  # Celery-задачи: синхронизация, уведомления, рассылки
+
+CRM_RATE_LIMIT = float(os.getenv("CRM_RATE_LIMIT", 5))  # Запросов в секунду на хост CRM для всего кластера
+CRM_RATE_BURST = float(os.getenv("CRM_RATE_BURST", 10))  # Емкость корзины хоста
+CRM_RATE_BATCH_SHARE = float(os.getenv("CRM_RATE_BATCH_SHARE", 0.6))  # Доля бюджета хоста для фоновых задач
+CRM_RATE_INTERACTIVE_RESERVE = float(os.getenv("CRM_RATE_INTERACTIVE_RESERVE", 0.3))  # Доля корзины, недоступная фоновым задачам
+CRM_RATE_MAX_WAIT = float(os.getenv("CRM_RATE_MAX_WAIT", 30))  # После этого запрос завершается CRMRateLimitTimeout
+CRM_RATE_LIMIT_ENABLED = os.getenv("CRM_RATE_LIMIT_ENABLED", "1") == "1"  # 0 - без ограничения (например, для заглушки CRM)
+
+# Две корзины (хоста и класса приоритета) проверяются и списываются атомарно.
+# Класс может взять токен из корзины хоста, только если в ней останется его резерв.
+# Возвращает {1, 0} при успехе или {0, миллисекунды до следующей попытки}.
+_TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+
+local function refill(key, rate, capacity)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - ts) * rate)
+end
+
+local host_rate = tonumber(ARGV[1])
+local host_capacity = tonumber(ARGV[2])
+local class_rate = tonumber(ARGV[3])
+local class_capacity = tonumber(ARGV[4])
+local reserve = tonumber(ARGV[5])
+local cost = tonumber(ARGV[6])
+
+local host_tokens = refill(KEYS[1], host_rate, host_capacity)
+local class_tokens = refill(KEYS[2], class_rate, class_capacity)
+
+local allowed = host_tokens - cost >= reserve and class_tokens >= cost
+if allowed then
+    host_tokens = host_tokens - cost
+    class_tokens = class_tokens - cost
+end
+
+redis.call('HSET', KEYS[1], 'tokens', host_tokens, 'ts', now)
+redis.call('HSET', KEYS[2], 'tokens', class_tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(host_capacity / host_rate * 2000))
+redis.call('PEXPIRE', KEYS[2], math.ceil(class_capacity / class_rate * 2000))
+
+if allowed then
+    return {1, 0}
+end
+
+local wait = math.max((cost + reserve - host_tokens) / host_rate, (cost - class_tokens) / class_rate)
+return {0, math.ceil(wait * 1000)}
+"""
+
+class CRMRateLimitTimeout(requests.ConnectionError):
+    """
+    Ограничитель не выдал разрешение за max_wait: запрос к CRM не отправлялся.
+    ---
+    Наследуется от ConnectionError, чтобы существующая обработка ошибок
+    requests (и повторы Celery-задач) срабатывала как при недоступной CRM.
+    """
+
+
+_crm_priority: contextvars.ContextVar[str] = contextvars.ContextVar("crm_priority", default=PRIORITY_INTERACTIVE)
+
+
+def get_crm_priority() -> str:
+    return _crm_priority.get()
+
+
+@contextmanager
+def crm_priority(priority: str):
+    """
+    Задает класс приоритета для запросов к CRM внутри блока.
+    """
+    token = _crm_priority.set(priority)
+    try:
+        yield
+    finally:
+        _crm_priority.reset(token)
+
+
+class CRMRateLimiter:
+    """
+    Общий для всех процессов ограничитель запросов к CRM (token bucket в Redis).
+    ---
+    У каждого хоста своя корзина, у каждого класса приоритета внутри хоста - своя.
+    Фоновые задачи получают только часть бюджета и не могут выбрать резерв
+    корзины хоста, поэтому запросы веб-приложения и бота проходят первыми.
+    Если разрешение не получено за max_wait, выбрасывается CRMRateLimitTimeout:
+    пропускать ожидающих без разрешения нельзя, иначе при переполненной
+    корзине все они разом превысят лимит кластера.
+    Если Redis недоступен, запросы пропускаются без ограничения.
+    """
+
+    def __init__(
+        self,
+        rate: float = CRM_RATE_LIMIT,
+        burst: float = CRM_RATE_BURST,
+        batch_share: float = CRM_RATE_BATCH_SHARE,
+        interactive_reserve: float = CRM_RATE_INTERACTIVE_RESERVE,
+        max_wait: float = CRM_RATE_MAX_WAIT,
+        enabled: bool = CRM_RATE_LIMIT_ENABLED,
+    ):
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        # (скорость пополнения, емкость, резерв в корзине хоста) для класса
+        self.budgets = {
+            PRIORITY_INTERACTIVE: (rate, burst, 0),
+            PRIORITY_BATCH: (rate * batch_share, max(burst * batch_share, 1), burst * interactive_reserve),
+        }
+
+    def try_acquire(self, host: str, priority: str) -> tuple[bool, float]:
+        """
+        Одна попытка получить разрешение. Возвращает (разрешено, секунд до следующей попытки).
+        """
+        class_rate, class_capacity, reserve = self.budgets.get(priority, self.budgets[PRIORITY_BATCH])
+        try:
+            allowed, wait_ms = get_redis_client().eval(
+                _TOKEN_BUCKET_SCRIPT,
+                2,
+                f"crm_rate:{host}",
+                f"crm_rate:{host}:{priority}",
+                self.rate,
+                self.burst,
+                class_rate,
+                class_capacity,
+                reserve,
+                1,
+            )
+        except redis.RedisError as e:
+            logger.error(f"Ограничитель запросов недоступен, запрос выполняется без него: {e}")
+            return True, 0.0
+        return bool(allowed), int(wait_ms) / 1000
+
+    def _next_delay(self, wait: float, priority: str) -> float:
+        # Небольшой случайный сдвиг, чтобы процессы не просыпались одновременно;
+        # фоновые задачи дополнительно уступают интерактивным запросам
+        jitter = random.uniform(0, 0.05)
+        if priority != PRIORITY_INTERACTIVE:
+            jitter += random.uniform(0, 0.1)
+        return wait + jitter
+
+    def _give_up(self, host: str, priority: str, waited: float):
+        CRM_RATE_LIMIT_WAIT.observe(waited, host=host, priority=priority)
+        logger.warning(f"Ожидание ограничителя CRM превысило {self.max_wait} с, запрос не отправлен")
+        raise CRMRateLimitTimeout(f"Нет разрешения ограничителя CRM для {host} за {self.max_wait} с")
+
+    def acquire(self, host: str, priority: str | None = None) -> float:
+        """
+        Ждет разрешения на запрос к хосту. Возвращает время ожидания в секундах.
+        Если разрешения нет дольше max_wait, выбрасывает CRMRateLimitTimeout.
+        """
+        if not self.enabled:
+            return 0.0
+        priority = priority or get_crm_priority()
+        started = time.monotonic()
+        while True:
+            allowed, wait = self.try_acquire(host, priority)
+            waited = time.monotonic() - started
+            if allowed:
+                break
+            if waited + wait > self.max_wait:
+                self._give_up(host, priority, waited)
+            time.sleep(self._next_delay(wait, priority))
+
+        waited = time.monotonic() - started
+        CRM_RATE_LIMIT_WAIT.observe(waited, host=host, priority=priority)
+        return waited
+
+    async def acquire_async(self, host: str, priority: str | None = None) -> float:
+        """
+        Асинхронный вариант acquire.
+        """
+        if not self.enabled:
+            return 0.0
+        priority = priority or get_crm_priority()
+        started = time.monotonic()
+        while True:
+            # Запрос к Redis блокирующий - выполняется вне цикла событий
+            allowed, wait = await asyncio.to_thread(self.try_acquire, host, priority)
+            waited = time.monotonic() - started
+            if allowed:
+                break
+            if waited + wait > self.max_wait:
+                self._give_up(host, priority, waited)
+            await asyncio.sleep(self._next_delay(wait, priority))
+
+        waited = time.monotonic() - started
+        CRM_RATE_LIMIT_WAIT.observe(waited, host=host, priority=priority)
+        return waited
+
+
+rate_limiter = CRMRateLimiter()
+
+_task_priority_tokens: dict[str, contextvars.Token] = {}
+
+
+@task_prerun.connect
+def _set_batch_priority(task_id=None, **kwargs):
+    """
+    Все Celery-задачи обращаются к CRM с фоновым приоритетом.
+    """
+    _task_priority_tokens[task_id] = _crm_priority.set(PRIORITY_BATCH)
+
+
+@task_postrun.connect
+def _reset_batch_priority(task_id=None, **kwargs):
+    token = _task_priority_tokens.pop(task_id, None)
+    if token is not None:
+        try:
+            _crm_priority.reset(token)
+        except ValueError:
+            _crm_priority.set(PRIORITY_INTERACTIVE)
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import ClassVar, Iterable, TypeVar
+
+from app_api.utils.util_parse_date import parse_date
+
+
+def parse_crm_date(value) -> date | None:
+    """
+    Дата из ответа CRM: DD.MM.YYYY или YYYY-MM-DD (в том числе с временем).
+    ---
+    Частые форматы разбираются срезами строки без strptime,
+    остальные - через parse_date.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        if len(value) >= 10 and value[2] == "." and value[5] == ".":
+            return date(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+        if len(value) >= 10 and value[4] == "-" and value[7] == "-":
+            return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        return None
+    parsed = parse_date(value)
+    return parsed.date() if isinstance(parsed, datetime) else parsed
+
+
+def parse_crm_datetime(value) -> datetime | None:
+    """
+    Дата и время из ответа CRM (YYYY-MM-DD HH:MM:SS), для даты без времени - полночь.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        day = parse_crm_date(value)
+        return datetime(day.year, day.month, day.day) if day else None
+
+
+def _to_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_tuple(value) -> tuple:
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return (value,)
+
+
+@dataclass(slots=True)
+class CustomerRecord:
+    """
+    Клиент CRM (customer/index) с разобранными датами.
+    """
+
+    # Поля ответа CRM, из которых строится запись (для потоковой выгрузки с fields)
+    FIELDS: ClassVar[tuple] = (
+        "id", "name", "branch_ids", "is_study", "phone", "balance", "paid_count",
+        "paid_lesson_count", "paid_till", "next_lesson_date", "dob", "note",
+    )
+
+    id: int
+    name: str | None = None
+    branch_ids: tuple[int, ...] = ()
+    is_study: int = 0
+    phones: tuple[str, ...] = ()
+    balance: float | None = None
+    paid_lesson_count: int | None = None
+    paid_till: date | None = None
+    next_lesson_date: datetime | None = None
+    dob: date | None = None
+    note: str | None = None
+
+    @classmethod
+    def from_crm(cls, item: dict) -> CustomerRecord:
+        return cls(
+            id=int(item["id"]),
+            name=item.get("name"),
+            branch_ids=tuple(int(branch_id) for branch_id in _as_tuple(item.get("branch_ids"))),
+            is_study=_to_int(item.get("is_study")) or 0,
+            phones=tuple(str(phone) for phone in _as_tuple(item.get("phone")) if phone),
+            balance=_to_float(item.get("balance")),
+            paid_lesson_count=_to_int(item.get("paid_lesson_count", item.get("paid_count"))),
+            paid_till=parse_crm_date(item.get("paid_till")),
+            next_lesson_date=parse_crm_datetime(item.get("next_lesson_date")),
+            dob=parse_crm_date(item.get("dob")),
+            note=item.get("note"),
+        )
+
+
+@dataclass(slots=True)
+class LessonRecord:
+    """
+    Урок CRM (lesson/index) с разобранными датами.
+    reasons и attended - причина (reason_id) и посещение (is_attend)
+    по каждому клиенту урока из details.
+    """
+
+    # Поля ответа CRM, из которых строится запись (для потоковой выгрузки с fields)
+    FIELDS: ClassVar[tuple] = (
+        "id", "date", "time_from", "time_to", "status", "lesson_type_id", "subject_id",
+        "room_id", "group_ids", "customer_ids", "details",
+    )
+
+    id: int
+    date: date | None = None
+    time_from: datetime | None = None
+    time_to: datetime | None = None
+    status: int | None = None
+    lesson_type_id: int | None = None
+    subject_id: int | None = None
+    room_id: int | None = None
+    group_ids: tuple[int, ...] = ()
+    customer_ids: tuple[int, ...] = ()
+    reasons: dict[int, int | None] = field(default_factory=dict)
+    attended: dict[int, bool] = field(default_factory=dict)
+
+    @classmethod
+    def from_crm(cls, item: dict) -> LessonRecord:
+        reasons, attended = {}, {}
+        for detail in item.get("details") or []:
+            customer_id = _to_int(detail.get("customer_id"))
+            if customer_id is not None:
+                reasons[customer_id] = _to_int(detail.get("reason_id"))
+                attended[customer_id] = bool(_to_int(detail.get("is_attend")))
+        return cls(
+            id=int(item["id"]),
+            date=parse_crm_date(item.get("date")),
+            time_from=parse_crm_datetime(item.get("time_from")),
+            time_to=parse_crm_datetime(item.get("time_to")),
+            status=_to_int(item.get("status")),
+            lesson_type_id=_to_int(item.get("lesson_type_id")),
+            subject_id=_to_int(item.get("subject_id")),
+            room_id=_to_int(item.get("room_id")),
+            group_ids=tuple(int(group_id) for group_id in _as_tuple(item.get("group_ids"))),
+            customer_ids=tuple(int(customer_id) for customer_id in _as_tuple(item.get("customer_ids"))),
+            reasons=reasons,
+            attended=attended,
+        )
+
+    @property
+    def reason_id(self) -> int | None:
+        """
+        Причина из первой записи details (урок одного клиента).
+        """
+        return next(iter(self.reasons.values()), None)
+
+    @property
+    def all_customer_ids(self) -> tuple[int, ...]:
+        """
+        Клиенты урока: customer_ids и клиенты из details (в групповом уроке
+        details может быть заполнен только для отметившихся).
+        """
+        return tuple(dict.fromkeys((*self.customer_ids, *self.reasons)))
+
+
+@dataclass(slots=True)
+class TariffRecord:
+    """
+    Абонемент клиента (customer-tariff/index). price - цена с учетом скидки,
+    заполняется при расчете (см. get_curr_tariff).
+    """
+
+    id: int
+    tariff_id: int | None = None
+    customer_id: int | None = None
+    begin: date | None = None
+    end: date | None = None
+    price: float | None = None
+
+    @classmethod
+    def from_crm(cls, item: dict) -> TariffRecord:
+        return cls(
+            id=int(item["id"]),
+            tariff_id=_to_int(item.get("tariff_id")),
+            customer_id=_to_int(item.get("customer_id")),
+            begin=parse_crm_date(item.get("b_date")),
+            end=parse_crm_date(item.get("e_date")),
+            price=_to_float(item.get("price")),
+        )
+
+
+@dataclass(slots=True)
+class DiscountRecord:
+    """
+    Скидка клиента (discount/index), amount - в процентах.
+    """
+
+    id: int
+    amount: float = 0.0
+    customer_id: int | None = None
+    begin: date | None = None
+    end: date | None = None
+
+    @classmethod
+    def from_crm(cls, item: dict) -> DiscountRecord:
+        return cls(
+            id=int(item["id"]),
+            amount=_to_float(item.get("amount")) or 0.0,
+            customer_id=_to_int(item.get("customer_id")),
+            begin=parse_crm_date(item.get("begin")),
+            end=parse_crm_date(item.get("end")),
+        )
+
+
+Record = TypeVar("Record", CustomerRecord, LessonRecord, TariffRecord, DiscountRecord)
+
+
+def to_records(items: Iterable[dict] | None, record_class: type[Record]) -> list[Record]:
+    """
+    Записи из items ответа CRM; элементы без id пропускаются.
+    """
+    return [record_class.from_crm(item) for item in items or () if item.get("id") is not None]
+
+
+def active_on(records: Iterable[Record], day: date) -> Record | None:
+    """
+    Запись (абонемент или скидка), действующая в день day;
+    из нескольких - с самой ранней датой окончания.
+    """
+    current = [record for record in records if record.begin and record.end and record.begin <= day <= record.end]
+    return min(current, key=lambda record: record.end, default=None)
+
+
+def lessons_in_month(records: Iterable[LessonRecord], day: date) -> list[LessonRecord]:
+    """
+    Уроки того же месяца, что и day.
+    """
+    return [record for record in records if record.date and (record.date.year, record.date.month) == (day.year, day.month)]
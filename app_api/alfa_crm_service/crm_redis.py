@@ -0,0 +1,13 @@
+import redis
+
+_redis_pool: redis.ConnectionPool | None = None
+
+
+def get_redis_client():
+    """
+    Возвращает клиент Redis на общем для процесса пуле соединений.
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis.ConnectionPool(host="localhost", port=6379, db=0, decode_responses=True)
+    return redis.StrictRedis(connection_pool=_redis_pool)
@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CRM_REFERENCE_LOCAL_TTL = int(os.getenv("CRM_REFERENCE_LOCAL_TTL", 60))  # Сколько секунд справочник живет в памяти процесса
+CRM_REFERENCE_RELOAD_INTERVAL = int(os.getenv("CRM_REFERENCE_RELOAD_INTERVAL", 60))  # Не чаще одной перезагрузки на промах за интервал
+
+
+class CRMReferenceCache:
+    """
+    Справочник CRM по филиалу в виде словаря id -> запись.
+    ---
+    Словарь загружается целиком функцией loader(branch_id) и хранится
+    в общем кэше Django с TTL, а поверх него - в памяти процесса,
+    поэтому поиск по id - это обращение к словарю без запросов к CRM.
+    Если задан refresh_after, справочник старше этого возраста отдается
+    как есть и одновременно перезагружается в фоновом потоке.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[int], dict | None],
+        ttl: int,
+        local_ttl: int = CRM_REFERENCE_LOCAL_TTL,
+        refresh_after: int | None = None,
+    ):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.refresh_after = refresh_after
+        self._local: dict[str, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, branch_id) -> str:
+        return f"crm_ref:{self.name}:{branch_id}"
+
+    def get(self, branch_id) -> dict:
+        """
+        Возвращает справочник филиала, загружая его при отсутствии в кэше.
+        """
+        key = self._key(branch_id)
+        local = self._read_local(key)
+        if local is not None:
+            return local
+
+        entry = self._read_shared(key)
+        if entry is None:
+            with self._lock:
+                # Пока ждали блокировку, справочник мог загрузить другой поток
+                local = self._read_local(key)
+                if local is not None:
+                    return local
+                entry = self._read_shared(key)
+                if entry is None:
+                    data = self._load(branch_id)
+                    return data if data is not None else {}
+
+        loaded_at, data = entry
+        self._remember(key, data)
+        if self.refresh_after is not None and time.time() - loaded_at > self.refresh_after:
+            self._refresh_in_background(branch_id)
+        return data
+
+    def lookup(self, branch_id, item_id, reload_on_miss: bool = True):
+        """
+        Поиск записи по id. Если записи нет, справочник перезагружается
+        (не чаще раза в CRM_REFERENCE_RELOAD_INTERVAL) - она могла появиться в CRM недавно.
+        """
+        item_id = int(item_id)
+        item = self.get(branch_id).get(item_id)
+        if item is None and reload_on_miss and self._may_reload(branch_id):
+            logger.info(f"Запись {item_id} не найдена в справочнике {self.name} филиала {branch_id}, перезагрузка")
+            item = self.reload(branch_id).get(item_id)
+        return item
+
+    def reload(self, branch_id) -> dict:
+        """
+        Загружает справочник филиала из CRM и обновляет кэш.
+        """
+        with self._lock:
+            data = self._load(branch_id)
+        return data if data is not None else {}
+
+    def invalidate(self, branch_ids):
+        """
+        Удаляет справочник указанных филиалов из кэша.
+        """
+        keys = [self._key(branch_id) for branch_id in branch_ids]
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        try:
+            cache.delete_many(keys)
+        except Exception as e:
+            logger.error(f"Не удалось очистить кэш справочника {self.name}: {e}")
+        logger.info(f"Справочник {self.name} сброшен для филиалов: {list(branch_ids)}")
+
+    def _may_reload(self, branch_id, reason: str = "reload") -> bool:
+        try:
+            return cache.add(f"{self._key(branch_id)}:{reason}", 1, CRM_REFERENCE_RELOAD_INTERVAL)
+        except Exception:
+            return False
+
+    def _refresh_in_background(self, branch_id):
+        # Обновление запускает только один процесс за интервал
+        if not self._may_reload(branch_id, reason="refresh"):
+            return
+        logger.info(f"Справочник {self.name} филиала {branch_id} устарел, фоновое обновление")
+        threading.Thread(target=self.reload, args=(branch_id,), daemon=True).start()
+
+    def _read_local(self, key: str) -> dict | None:
+        local = self._local.get(key)
+        if local and local[0] > time.monotonic():
+            return local[1]
+        return None
+
+    def _read_shared(self, key: str) -> tuple[float, dict] | None:
+        try:
+            return cache.get(key)
+        except Exception as e:
+            logger.error(f"Кэш справочника {self.name} недоступен: {e}")
+            return None
+
+    def _remember(self, key: str, data: dict):
+        self._local[key] = (time.monotonic() + self.local_ttl, data)
+
+    def _load(self, branch_id) -> dict | None:
+        key = self._key(branch_id)
+        started = time.monotonic()
+        data = self.loader(branch_id)
+        if data is None:
+            logger.error(f"Не удалось загрузить справочник {self.name} для филиала {branch_id}")
+            return None
+
+        try:
+            cache.set(key, (time.time(), data), self.ttl)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить справочник {self.name} в кэш: {e}")
+        self._remember(key, data)
+        logger.info(
+            f"Справочник {self.name} филиала {branch_id} загружен: {len(data)} записей за {time.monotonic() - started:.2f} с"
+        )
+        return data
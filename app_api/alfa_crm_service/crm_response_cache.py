@@ -0,0 +1,114 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from django.core.cache import cache
+
+from app_api.alfa_crm_service.crm_circuit_breaker import crm_available
+
+logger = logging.getLogger(__name__)
+
+CRM_RESPONSE_REFRESH_LOCK_TTL = int(os.getenv("CRM_RESPONSE_REFRESH_LOCK_TTL", 30))  # Не чаще одного фонового обновления ключа
+CRM_RESPONSE_OUTAGE_TTL = int(os.getenv("CRM_RESPONSE_OUTAGE_TTL", 60 * 60))  # Сколько еще хранить ответ на случай недоступности CRM
+
+
+def _customer_version_key(branch_id, customer_id) -> str:
+    return f"crm_resp_version:{branch_id}:{customer_id}"
+
+
+def invalidate_customer_responses(branch_id, customer_id):
+    """
+    Сбрасывает все кэшированные ответы CRM по клиенту (после записи в CRM).
+    ---
+    Ответы не удаляются по одному: меняется версия клиента, которая входит
+    в ключи, и старые ответы просто истекают.
+    """
+    key = _customer_version_key(branch_id, customer_id)
+    try:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+    except ValueError:
+        # Версия истекла между add и incr
+        cache.set(key, 1, None)
+    except Exception as e:
+        logger.error(f"Не удалось сбросить кэш ответов CRM для клиента {customer_id}: {e}")
+        return
+    logger.info(f"Кэш ответов CRM сброшен для клиента {customer_id} филиала {branch_id}")
+
+
+class CRMResponseCache:
+    """
+    Кэш ответов метода чтения CRM по клиенту.
+    ---
+    Ответ моложе ttl отдается из кэша. Ответ старше ttl, но моложе
+    ttl + stale_ttl, тоже отдается сразу, а в фоновом потоке запрашивается
+    свежий (stale-while-revalidate). Пустые ответы (None) не кэшируются.
+    Пока предохранитель группы методов family разомкнут, отдается любой
+    сохраненный ответ не старше CRM_RESPONSE_OUTAGE_TTL сверх этих сроков.
+    """
+
+    def __init__(self, name: str, family: str, ttl: int, stale_ttl: int = 0):
+        self.name = name
+        self.family = family
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def _key(self, branch_id, customer_id, version, params: dict) -> str:
+        digest = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return f"crm_resp:{self.name}:{branch_id}:{customer_id}:{version}:{digest}"
+
+    def get_or_fetch(self, branch_id, customer_id, params: dict, fetch: Callable[[], Any]) -> Any:
+        """
+        Возвращает ответ из кэша или вызывает fetch() и кэширует результат.
+        params - параметры запроса, от которых зависит ответ.
+        """
+        if self.ttl <= 0:
+            return fetch()
+
+        try:
+            version = cache.get(_customer_version_key(branch_id, customer_id), 0)
+            key = self._key(branch_id, customer_id, version, params)
+            entry = cache.get(key)
+        except Exception as e:
+            logger.error(f"Кэш ответов CRM {self.name} недоступен: {e}")
+            return fetch()
+
+        if entry is not None:
+            fetched_at, value = entry
+            age = time.time() - fetched_at
+            if age <= self.ttl:
+                return value
+            if not crm_available(self.family):
+                logger.warning(f"CRM недоступна, отдается сохраненный ответ {self.name} ({int(age)} с)")
+                return value
+            if age <= self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, fetch)
+                return value
+
+        return self._fetch_and_store(key, fetch)
+
+    def _fetch_and_store(self, key: str, fetch: Callable[[], Any]) -> Any:
+        value = fetch()
+        if value is not None:
+            try:
+                cache.set(key, (time.time(), value), self.ttl + self.stale_ttl + CRM_RESPONSE_OUTAGE_TTL)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить ответ CRM {self.name} в кэш: {e}")
+        return value
+
+    def _refresh_in_background(self, key: str, fetch: Callable[[], Any]):
+        # Обновление запускает только один процесс за интервал
+        try:
+            if not cache.add(f"{key}:refresh", 1, CRM_RESPONSE_REFRESH_LOCK_TTL):
+                return
+        except Exception:
+            return
+        logger.debug(f"Ответ CRM {self.name} устарел, фоновое обновление")
+        # Контекст (например, приоритет запросов к CRM) переносится в фоновый поток
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._fetch_and_store, key, fetch), daemon=True).start()
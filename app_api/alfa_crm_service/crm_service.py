@@ -1,13 +1,51 @@
 import json
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
+from dataclasses import replace
+from datetime import date, timedelta
 from time import sleep
 import requests
-import redis
+from celery.signals import worker_ready
+from django.core.cache import cache
 from dotenv import load_dotenv
 
+from app_api.alfa_crm_service.crm_async_service import (
+    find_clients_by_id_async,
+    find_clients_by_ids_async,
+    fetch_all_items_async,
+    find_user_by_phone_async,
+    run_async,
+    stream_all_items,
+)
+from app_api.alfa_crm_service.crm_caller import get_crm_caller
+from app_api.alfa_crm_service.crm_coalescing import is_read_request, request_coalescer, request_key
+from app_api.alfa_crm_service.crm_lesson_mirror import (
+    LESSON_MIRROR_BACKFILL_DAYS,
+    LESSON_MIRROR_DAYS_AHEAD,
+    LESSON_MIRROR_DAYS_BEFORE,
+    LESSON_MIRROR_HISTORY_DAYS,
+    LESSON_MIRROR_HISTORY_START,
+    LESSON_TAUGHT,
+    history_branch_ids,
+    mirror_branch_lessons,
+    scheduled_branch_ids,
+)
+from app_api.alfa_crm_service.crm_logging import Truncated, response_body
+from app_api.alfa_crm_service.crm_metrics import observe_crm_retry
+from app_api.alfa_crm_service.crm_phone_index import (
+    PHONE_INDEX_FIELDS,
+    forget_phone_missing,
+    get_phone_targets,
+    index_customers,
+    is_phone_missing,
+    remember_phone_missing,
+)
+from app_api.alfa_crm_service.crm_records import DiscountRecord, LessonRecord, TariffRecord, active_on, to_records
+from app_api.alfa_crm_service.crm_reference_cache import CRMReferenceCache
+from app_api.alfa_crm_service.crm_response_cache import CRMResponseCache, invalidate_customer_responses
+from app_api.alfa_crm_service.crm_token import token_manager
+from app_api.alfa_crm_service.crm_transport import crm_url, get_crm_transport
+from app_api.utils.util_phone import normalize_phone
 from app_kiberclub.models import Branch
 from celery_app import app
 
@@ -15,30 +53,23 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-CRM_HOSTNAME = os.getenv("CRM_HOSTNAME")
 CRM_EMAIL = os.getenv("CRM_EMAIL")
 CRM_API_KEY = os.getenv("CRM_API_KEY")
 
-BASE_HEADERS = {
-    "Content-Type": "application/json",
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
-    "Accept-Encoding": "gzip, deflate, br",
-    "Accept": "application/json, text/plain, */*",
-}
-
 branches = [1, 2, 3, 4]
 client_is_study_statuses = [0, 1]
 
-REQUEST_LIMIT = 2  # Максимальное количество одновременных запросов
 MAX_RETRIES = 5  # Максимальное количество попыток
 RETRY_DELAY = 2  # Начальная задержка между попытками
 
-
-def get_redis_client():
-    """
-    Создает и возвращает клиент Redis.
-    """
-    return redis.StrictRedis(host="localhost", port=6379, db=0, decode_responses=True)
+CRM_TARIFF_CACHE_TTL = int(os.getenv("CRM_TARIFF_CACHE_TTL", 6 * 60 * 60))  # Тарифы меняются редко
+CRM_MANAGER_CACHE_TTL = int(os.getenv("CRM_MANAGER_CACHE_TTL", 2 * 60 * 60))  # Обновляется задачей refresh_manager_index
+CRM_METADATA_CACHE_TTL = int(os.getenv("CRM_METADATA_CACHE_TTL", 24 * 60 * 60))  # Предметы и группы
+CRM_METADATA_REFRESH_AFTER = int(os.getenv("CRM_METADATA_REFRESH_AFTER", 30 * 60))  # Возраст для фонового обновления
+CRM_LESSONS_CACHE_TTL = int(os.getenv("CRM_LESSONS_CACHE_TTL", 60))  # Ответы lesson/index по клиенту
+CRM_LESSONS_STALE_TTL = int(os.getenv("CRM_LESSONS_STALE_TTL", 5 * 60))  # Сколько еще отдавать устаревший ответ, обновляя его в фоне
+CRM_BONUS_CACHE_TTL = int(os.getenv("CRM_BONUS_CACHE_TTL", 15))  # Баланс киберонов, без устаревших ответов
+LESSON_MIRROR_BOOTSTRAP_LOCK_TTL = int(os.getenv("LESSON_MIRROR_BOOTSTRAP_LOCK_TTL", 60 * 60))  # Как часто воркеры могут ставить загрузку зеркала уроков
 
 
 @app.task
@@ -46,11 +77,8 @@ def update_crm_token():
     """
     Задача для обновления токена в Redis.
     """
-    token = login_to_alfa_crm()
+    token = token_manager.refresh()
     if token:
-        # Сохраняем токен в Redis с TTL 55 минут (3300 секунд)
-        redis_client = get_redis_client()
-        redis_client.set("crm_token", token, ex=3300)
         logger.info("Токен успешно обновлен и сохранен в Redis.")
     else:
         logger.error("Не удалось обновить токен.")
@@ -58,121 +86,66 @@ def update_crm_token():
 
 def get_crm_token():
     """
-    Получение токена из Redis или через авторизацию.
-    """
-    redis_client = get_redis_client()
-    token = redis_client.get("crm_token")
-
-    if token:
-        logger.info("Токен успешно получен из Redis.")
-        return token
-    else:
-        logger.info("Токен отсутствует в Redis. Запрашиваем новый токен...")
-        token = login_to_alfa_crm()
-        if token:
-            # Сохраняем токен в Redis с TTL 55 минут (3300 секунд)
-            redis_client.set("crm_token", token, ex=3300)
-            logger.info("Новый токен сохранен в Redis.")
-            return token
-        else:
-            logger.error("Не удалось получить токен.")
-            return None
-
-
-def login_to_alfa_crm():
-    """
-    Авторизация в CRM и получение токена.
+    Получение токена из памяти процесса, Redis или через авторизацию.
     """
-    email = os.getenv("CRM_EMAIL")
-    api_key = os.getenv("CRM_API_KEY")
-    logger.info(f"Начинается авторизация в CRM с email: {email}...")
-
-    data = {"email": email, "api_key": api_key}
-    url = f"https://{CRM_HOSTNAME}/v2api/auth/login"
-    logger.debug(f"URL для авторизации: {url}")
-    logger.debug(f"Данные для авторизации: {data}")
-
-    try:
-        logger.info("Отправка POST-запроса для авторизации...")
-        response = requests.post(url, headers=BASE_HEADERS, json=data)
-        logger.debug(
-            f"Получен ответ от сервера: статус {response.status_code}, тело: {response.text}"
-        )
-
-        if response.status_code == 200:
-            token_data = response.json()
-            token = token_data.get("token")
-            logger.info(f"Токен успешно получен: {token[:10]}... (первые 10 символов)")
-            return token
-        else:
-            logger.error(f"Ошибка авторизации: статус {response.status_code}")
-            return None
-    except Exception as e:
-        logger.error(f"Произошла ошибка при отправке запроса для авторизации: {e}")
-        return None
+    return token_manager.get_token()
 
 
 def find_user_by_phone(phone_number: str) -> dict | None:
     """
     Поиск пользователя по номеру телефона.
+    ---
+    1. Если номер есть в локальном индексе телефонов, запрашиваются
+       только филиалы и статус (is_study), которые в нем указаны;
+       при промахе - другие статусы тех же филиалов (клиент мог
+       перейти из лидов в клиенты).
+    2. Иначе (или если индекс устарел) запросы по остальным филиалам
+       и статусам выполняются одновременно. Номера, которых нет в CRM,
+       запоминаются на CRM_PHONE_NEGATIVE_TTL секунд.
     """
     logger.info(f"Начинается поиск пользователя по номеру телефона: {phone_number}")
-
-    def fetch_data(branch: str, status: int) -> dict | None:
-        """
-        Выполнение одного запроса к CRM.
-        """
-        data = {"is_study": status, "page": 0, "phone": phone_number}
-        url = f"https://{CRM_HOSTNAME}/v2api/{branch}/customer/index"
-        logger.info(
-            f"Выполняется запрос для branch={branch}, status={status}, URL: {url}"
-        )
-        logger.debug(f"Данные для запроса: {data}")
-
-        response = send_request_to_crm(url=url, data=data, params=None)
-        if response:
-            logger.info(f"Успешный ответ для branch={branch}, status={status}")
-        else:
-            logger.warning(
-                f"Не удалось получить данные для branch={branch}, status={status}"
-            )
-        return response
-
-    tasks = [
-        (str(branch), status)
+    phone = normalize_phone(phone_number)
+    queried, failed_requests = set(), 0
+
+    def search(targets: list[tuple[int, int]]) -> dict:
+        nonlocal failed_requests
+        queried.update(targets)
+        result = run_async(find_user_by_phone_async(phone_number, targets))
+        failed_requests += result.pop("failed_requests")
+        if result["total"] > 0:
+            index_customers(result["items"])
+        return result
+
+    if phone:
+        if is_phone_missing(phone):
+            logger.info(f"Номер {phone} недавно не найден в CRM, повторный поиск пропущен")
+            return {"total": 0, "count": 0, "items": []}
+
+        indexed = get_phone_targets(phone)
+        if indexed:
+            indexed_branches = sorted({branch for branch, _ in indexed})
+            other_statuses = [
+                (branch, status)
+                for branch in indexed_branches
+                for status in client_is_study_statuses
+                if (branch, status) not in indexed
+            ]
+            for targets in (indexed, other_statuses):
+                if targets:
+                    result = search(targets)
+                    if result["total"] > 0:
+                        return result
+            logger.info(f"Номер {phone} не найден в филиалах из индекса {indexed_branches}, поиск по всем филиалам")
+
+    result = search([
+        (branch, status)
         for status in client_is_study_statuses
         for branch in branches
-    ]
-    logger.info(
-        f"Сформированы задачи для выполнения: {len(tasks)} комбинаций филиалов и статусов."
-    )
-
-    results = []
-    with ThreadPoolExecutor(max_workers=REQUEST_LIMIT) as executor:
-        logger.info(
-            f"Запуск выполнения задач с ограничением {REQUEST_LIMIT} одновременных запросов."
-        )
-        futures = [
-            executor.submit(fetch_data, branch, status) for branch, status in tasks
-        ]
-        for future in futures:
-            result = future.result()
-            if result is not None:
-                results.append(result)
-            else:
-                logger.warning("Получен пустой результат, пропускаем.")
-
-    # Обработка результатов
-    total_sum = sum(int(result.get("total", 0)) for result in results)
-    count_sum = sum(int(result.get("count", 0)) for result in results)
-    all_items = [item for result in results for item in result.get("items", [])]
-
-    result_answer = {
-        "total": total_sum,
-        "count": count_sum,
-        "items": all_items,
-    }
-    return result_answer
+        if (branch, status) not in queried
+    ])
+    if result["total"] == 0 and phone and not failed_requests:
+        remember_phone_missing(phone)
+    return result
 
 
 def create_user_in_crm(user_data) -> dict | None:
@@ -192,13 +165,20 @@ def create_user_in_crm(user_data) -> dict | None:
         "is_study": 0,
         "note": "created by Telegram BOT",
     }
-    url = f"https://{CRM_HOSTNAME}/v2api/1/customer/create"
+    url = crm_url("1/customer/create")
 
-    logger.info(f"Отправка данных для создания пользователя: {data}")
+    logger.info("Отправка данных для создания пользователя: %s", Truncated(data))
     try:
         response: dict = send_request_to_crm(url=url, data=data, params=None)
         if response:
             logger.info("Пользователь успешно создан.")
+            customer = response.get("model")
+            if customer:
+                index_customers([customer], branch_id=1)
+                invalidate_customer_responses(1, customer["id"])
+            phone = normalize_phone(user_data["phone_number"])
+            if phone:
+                forget_phone_missing(phone)
             return response
         else:
             logger.error(f"Ошибка создания пользователя, тело: {response}")
@@ -209,67 +189,76 @@ def create_user_in_crm(user_data) -> dict | None:
 
 
 def send_request_to_crm(url: str, data: dict, params: dict | None) -> dict | None:
+    """
+    Запрос к CRM. Одинаковые одновременные запросы на чтение
+    выполняются один раз (см. RequestCoalescer).
+    """
+    if is_read_request(url):
+        return request_coalescer.run(
+            request_key(url, data, params), lambda: _send_request_to_crm(url, data, params)
+        )
+    return _send_request_to_crm(url, data, params)
+
+
+def _send_request_to_crm(url: str, data: dict, params: dict | None) -> dict | None:
     token = get_crm_token()
     if not token:
         logger.error("Токен отсутствует. Отмена запроса.")
         return None
 
-    headers = {**BASE_HEADERS, "X-ALFACRM-TOKEN": token}
+    headers = {"X-ALFACRM-TOKEN": token}
     retry_delay = RETRY_DELAY
-    logger.info(
-        f"Начинается отправка запроса к CRM. URL: {url}, Данные: {data}, Параметры: {params}"
-    )
+    token_renewed = False
+    logger.debug("Запрос к CRM: %s, данные: %s, параметры: %s", url, Truncated(data), params)
 
     for attempt in range(MAX_RETRIES):
         try:
-            logger.info(
-                f"Попытка {attempt + 1}/{MAX_RETRIES}. Отправка POST-запроса..."
-            )
-            with ThreadPoolExecutor(max_workers=REQUEST_LIMIT) as executor:
-                future = executor.submit(
-                    requests.post,
-                    url,
-                    headers=headers,
-                    json=data,
-                    params=params,
-                    timeout=10,
-                )
-                response = future.result()
-
-            logger.debug(
-                f"Получен ответ от сервера: статус {response.status_code}, тело: {response.text}"
+            response = get_crm_transport().post(
+                url,
+                json=data,
+                params=params,
+                headers=headers,
             )
 
             if response.status_code == 200:
-                logger.info("Запрос успешно выполнен.")
                 try:
                     return response.json()
                 except json.JSONDecodeError:
-                    logger.error("Ошибка декодирования JSON. Ответ: %s", response.text)
+                    logger.error("Ошибка декодирования JSON. Ответ: %s", response_body(response))
                     return None
             elif response.status_code == 401:
+                if not token_renewed:
+                    logger.warning("CRM отклонила токен. Повторная авторизация...")
+                    token_manager.invalidate(token)
+                    token = token_manager.get_token()
+                    if token:
+                        headers["X-ALFACRM-TOKEN"] = token
+                        token_renewed = True
+                        observe_crm_retry(url, 401, get_crm_caller())
+                        continue
                 logger.error("Неавторизованный запрос. Отмена запроса.")
                 return None
             elif response.status_code == 429:
-                logger.warning(
-                    f"Слишком много запросов. Повторная попытка через {retry_delay} секунд..."
-                )
+                logger.warning("Слишком много запросов. Повторная попытка через %s секунд...", retry_delay)
+                observe_crm_retry(url, 429, get_crm_caller())
                 sleep(retry_delay)
                 retry_delay *= 2
                 continue
             else:
-                logger.error(
-                    f"Неожиданный статус: {response.status_code}. Тело: {response.text}"
-                )
+                logger.error("Неожиданный статус: %s. Тело: %s", response.status_code, response_body(response))
                 return None
         except requests.RequestException as e:
-            logger.error(f"Ошибка при отправке запроса: {e}")
+            logger.error("Ошибка при отправке запроса: %s", e)
             return None
 
     logger.error("Достигнуто максимальное количество попыток. Запрос не выполнен.")
     return None
 
 
+lessons_cache = CRMResponseCache("lessons", "lesson", CRM_LESSONS_CACHE_TTL, CRM_LESSONS_STALE_TTL)
+bonus_balance_cache = CRMResponseCache("bonus_balance", "bonus", CRM_BONUS_CACHE_TTL)
+
+
 def get_client_lessons(
     user_crm_id: int,
     branch_id: int,
@@ -284,9 +273,11 @@ def get_client_lessons(
         "page": 0 if page is None else page,
     }
 
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/lesson/index"
+    url = crm_url(f"{branch_id}/lesson/index")
 
-    response_data: dict | None = send_request_to_crm(url, data, params=None)
+    response_data: dict | None = lessons_cache.get_or_fetch(
+        branch_id, user_crm_id, data, lambda: send_request_to_crm(url, data, params=None)
+    )
     if response_data:
         if isinstance(response_data, dict) and "total" in response_data:
             logger.info(f"Получено уроков: {response_data.get('total')}")
@@ -299,88 +290,133 @@ def get_client_lessons(
         return {"total": 0}
 
 
-def get_taught_trial_lesson(customer_id, branch_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/lesson/index"
+def get_curr_tariff(user_crm_id, branch_id, curr_date) -> TariffRecord | None:
+    """
+    Абонемент клиента, действующий в curr_date, с ценой за вычетом текущей скидки.
+    """
+    url = crm_url(f"{branch_id}/customer-tariff/index?customer_id={user_crm_id}")
+    customer_tariffs = send_request_to_crm(url, {}, None)
+    tariff = active_on(to_records(customer_tariffs.get("items"), TariffRecord), curr_date)
+    if tariff:
+        price = float(get_tariff_price(branch_id, tariff.tariff_id))
+        discount = float(get_curr_discount(branch_id, user_crm_id, curr_date))
+        return replace(tariff, price=price * (1 - discount / 100))
+
+
+def fetch_all_items(url: str, data: dict | None = None, fields: tuple | None = None) -> list[dict] | None:
+    """
+    Загружает все страницы метода *index* (остальные страницы - одновременно).
+    fields - какие поля записей оставить, остальные отбрасываются при разборе.
+    """
+    return run_async(fetch_all_items_async(url, data, fields))
 
-    data = {
-        "customer_id": customer_id,
-        "status": 3,  # 1 - запланирован урок, 2 - отменен, 3 - проведен
-        "lesson_type_id": 3  # 3 - пробник, 2 - групповой
-    }
 
-    # lessons = requests.post(url, json=data, headers=headers)
-    lessons_response = send_request_to_crm(url=url, data=data, params=None)
+def load_tariff_catalog(branch_id) -> dict | None:
+    """
+    Загружает все тарифы филиала одним проходом по страницам /tariff/index.
+    """
+    tariffs = fetch_all_items(crm_url(f"{branch_id}/tariff/index"))
+    if tariffs is None:
+        return None
+    return {int(tariff["id"]): tariff for tariff in tariffs if tariff.get("id") is not None}
 
-    return lessons_response
 
+tariff_catalog = CRMReferenceCache("tariffs", load_tariff_catalog, ttl=CRM_TARIFF_CACHE_TTL)
 
-def get_curr_tariff(user_crm_id, branch_id, curr_date):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer-tariff/index?customer_id={user_crm_id}"
-    customer_tariffs = send_request_to_crm(url, {}, None)
-    for tariff in sorted(customer_tariffs.get("items"), key=lambda x: datetime.strptime(x.get("e_date"), "%d.%m.%Y")):
-        tariff_end_date = datetime.strptime(tariff.get("e_date"), "%d.%m.%Y")
-        tariff_begin_date = datetime.strptime(tariff.get("b_date"), "%d.%m.%Y")
-        if tariff_end_date.date() >= curr_date >= tariff_begin_date.date():
-            price = float(get_tariff_price(branch_id, tariff.get("tariff_id")))
-            discount = float(get_curr_discount(branch_id, user_crm_id, curr_date))
-            tariff.update({"price": price * (1 - discount / 100)})
-            return tariff
+
+def invalidate_tariff_catalog(branch_id=None):
+    """
+    Сбрасывает кэш тарифов филиала (или всех филиалов).
+    """
+    branch_ids = [branch_id] if branch_id is not None else get_branch_ids()
+    tariff_catalog.invalidate(branch_ids)
 
 
 def get_tariff_price(branch_id, tariff_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/tariff/index"
-    page = 0
-    data = {"page": 0}
-    tariff_objects = send_request_to_crm(url, data, None)
-    tariff_objects_items = tariff_objects.get("items")
-    last_page = 1
-    if tariff_objects.get("count") is not None and int(tariff_objects.get("count")) != 0:
-        last_page = int(tariff_objects.get("total", 0)) // int(tariff_objects.get("count", 1))
-    while page <= last_page:
-        for tariff in tariff_objects_items:
-            if tariff.get("id") == tariff_id:
-                return tariff.get("price")
-        page += 1
-        data = {"page": page}
-        tariff_objects_items = send_request_to_crm(url, data, None).get("items")
+    tariff = tariff_catalog.lookup(branch_id, tariff_id)
+    if tariff:
+        return tariff.get("price")
     return 0
 
 
 def get_curr_discount(branch_id, user_crm_id, curr_date):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/discount/index"
+    url = crm_url(f"{branch_id}/discount/index")
     page = 0
     data = {"customer_id": user_crm_id, "page": 0}
     discounts = send_request_to_crm(url, data, None)
-    discounts_items = discounts.get("items")
     last_page = 1
     if discounts.get("count") is not None and int(discounts.get("count")) != 0:
         last_page = int(discounts.get("total", 0)) // int(discounts.get("count", 1))
     while page < last_page:
-        for discount in sorted(
-            discounts_items, key=lambda x: datetime.strptime(x.get("end"), "%d.%m.%Y")
-        ):
-            discount_end_date = datetime.strptime(discount.get("end"), "%d.%m.%Y")
-            discount_begin_date = datetime.strptime(discount.get("begin"), "%d.%m.%Y")
-            if discount_end_date.date() >= curr_date >= discount_begin_date.date():
-                return discount.get("amount")
+        discount = active_on(to_records(discounts.get("items"), DiscountRecord), curr_date)
+        if discount:
+            return discount.amount
         page += 1
         data.update({"page": page})
         discounts = send_request_to_crm(url, data, None)
-        discounts_items = discounts.get("items")
     return 0
 
 
-def get_client_lesson_name(branch_id: int, subject_id: int | None = None) -> dict | None:
-    data = {"id": subject_id, "active": True, "page": 0}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/subject/index"
-    response_data = send_request_to_crm(
-        url,
-        data,
-        params=None,
-    )
-    if response_data and response_data.get("total") != 0:
-        return response_data
-    return {"total": 0}
+def load_subject_names(branch_id) -> dict | None:
+    """
+    Загружает активные предметы филиала: subject_id -> название.
+    """
+    subjects = fetch_all_items(crm_url(f"{branch_id}/subject/index"), {"active": True})
+    if subjects is None:
+        return None
+    return {int(subject["id"]): subject.get("name", "") for subject in subjects if subject.get("id") is not None}
+
+
+def load_group_notes(branch_id) -> dict | None:
+    """
+    Загружает группы филиала: group_id -> примечание (ссылка на чат группы).
+    """
+    groups = fetch_all_items(crm_url(f"{branch_id}/group/index"))
+    if groups is None:
+        return None
+    return {int(group["id"]): group.get("note") for group in groups if group.get("id") is not None}
+
+
+subject_names = CRMReferenceCache(
+    "subjects", load_subject_names, ttl=CRM_METADATA_CACHE_TTL, refresh_after=CRM_METADATA_REFRESH_AFTER
+)
+group_notes = CRMReferenceCache(
+    "groups", load_group_notes, ttl=CRM_METADATA_CACHE_TTL, refresh_after=CRM_METADATA_REFRESH_AFTER
+)
+
+
+def get_subject_name(branch_id, subject_id) -> str | None:
+    """
+    Название предмета из кэшированного справочника филиала.
+    """
+    if subject_id is None:
+        return None
+    return subject_names.lookup(branch_id, subject_id)
+
+
+def get_group_note(branch_id, group_id) -> str | None:
+    """
+    Примечание группы (ссылка на чат) из кэшированного справочника филиала.
+    """
+    if group_id is None:
+        return None
+    return group_notes.lookup(branch_id, group_id)
+
+
+def invalidate_crm_metadata(branch_id=None):
+    branch_ids = [branch_id] if branch_id is not None else get_branch_ids()
+    subject_names.invalidate(branch_ids)
+    group_notes.invalidate(branch_ids)
+
+
+@app.task
+def refresh_crm_metadata():
+    """
+    Задача для предзагрузки справочников предметов и групп всех филиалов.
+    """
+    for branch_id in get_branch_ids():
+        subject_names.reload(branch_id)
+        group_notes.reload(branch_id)
 
 
 def get_user_groups_from_crm(branch_id: int, user_crm_id: int) -> dict | None:
@@ -388,7 +424,7 @@ def get_user_groups_from_crm(branch_id: int, user_crm_id: int) -> dict | None:
     params = {
         "customer_id": user_crm_id,
     }
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/cgi/customer"
+    url = crm_url(f"{branch_id}/cgi/customer")
 
     logger.debug("Попытка получить группы пользователя (ID)")
     response_data = send_request_to_crm(url=url, data=data, params=params)
@@ -397,20 +433,6 @@ def get_user_groups_from_crm(branch_id: int, user_crm_id: int) -> dict | None:
     return {"total": 0}
 
 
-def get_group_link_from_crm(branch_id: int, group_id: int) -> dict | None:
-    data = {"id": group_id, "page": 0}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/group/index"
-
-    response_data = send_request_to_crm(url=url, data=data, params=None)
-    if response_data:
-        if response_data.get("total") != 0:
-            return response_data
-        return {"total": 0}
-    else:
-        logger.debug("Не удалось получить ссылку на группу.")
-        return {"total": 0}
-
-
 def find_client_by_id(branch_id, crm_id) -> dict | None:
     # Добавляем обязательные параметры фильтрации
     data = {
@@ -419,7 +441,7 @@ def find_client_by_id(branch_id, crm_id) -> dict | None:
         "page": 0
     }
     
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer/index"
+    url = crm_url(f"{branch_id}/customer/index")
     
     try:
         response = send_request_to_crm(url=url, data=data, params=None)
@@ -446,29 +468,68 @@ def find_client_by_id(branch_id, crm_id) -> dict | None:
         return None
 
 
-def get_manager_from_crm(branch_id, page=0):
-    data = {"page": page}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/user/index"
-    try:
-        response: dict = send_request_to_crm(url=url, data=data, params=None)
-        if response:
-            logger.info("Менеджеры получены")
-            return response
-        else:
-            logger.error(f"Менеджер не найден: {response}")
-            return None
-    except Exception as e:
+def find_clients_by_id(clients: list[tuple]) -> list[dict | None]:
+    """
+    Поиск нескольких клиентов по парам (branch_id, crm_id) минимальным числом запросов.
+    Результаты возвращаются в порядке переданных пар.
+    """
+    if not clients:
+        return []
+    return run_async(find_clients_by_id_async(clients))
+
+
+def find_clients_by_ids(branch_id, crm_ids) -> dict[int, dict]:
+    """
+    Загрузка клиентов филиала по списку id. Возвращает словарь id -> запись клиента.
+    """
+    if not crm_ids:
+        return {}
+    return run_async(find_clients_by_ids_async(branch_id, crm_ids))
+
+
+def load_manager_index(branch_id) -> dict | None:
+    """
+    Загружает всех менеджеров филиала (/user/index), страницы - одновременно.
+    """
+    managers = fetch_all_items(crm_url(f"{branch_id}/user/index"))
+    if managers is None:
         return None
+    return {int(manager["id"]): manager for manager in managers if manager.get("id") is not None}
+
+
+manager_index = CRMReferenceCache("managers", load_manager_index, ttl=CRM_MANAGER_CACHE_TTL)
+
+
+def find_manager_by_id(branch_id, manager_id) -> dict | None:
+    """
+    Поиск менеджера по id в кэшированном справочнике филиала.
+    """
+    return manager_index.lookup(branch_id, manager_id)
+
+
+def invalidate_manager_index(branch_id=None):
+    branch_ids = [branch_id] if branch_id is not None else get_branch_ids()
+    manager_index.invalidate(branch_ids)
+
+
+@app.task
+def refresh_manager_index():
+    """
+    Задача для фонового обновления справочника менеджеров всех филиалов.
+    """
+    for branch_id in get_branch_ids():
+        manager_index.reload(branch_id)
 
 
 def set_client_kiberons(branch_id, customer_id, kiberons_from_kiberclub):
     try:
-        url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/bonus/bonus-add?customer_id={customer_id}"
+        url = crm_url(f"{branch_id}/bonus/bonus-add?customer_id={customer_id}")
         data = {
             "amount": kiberons_from_kiberclub 
         }
         response: dict = send_request_to_crm(url=url, data=data, params=None)
 
+        invalidate_customer_responses(branch_id, customer_id)
         if response:
             logger.info("Запрос для установки числа киберонов успешный")
             return response
@@ -482,13 +543,14 @@ def set_client_kiberons(branch_id, customer_id, kiberons_from_kiberclub):
 
 def spent_client_kiberons(branch_id, customer_id, count, note=""):
     try:
-        url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/bonus/bonus-spend?customer_id={customer_id}"
+        url = crm_url(f"{branch_id}/bonus/bonus-spend?customer_id={customer_id}")
         data = {
             "amount": count,
             "note": note,
             }
         response: dict = send_request_to_crm(url=url, data=data, params=None)
 
+        invalidate_customer_responses(branch_id, customer_id)
         if response:
             logger.info("Запрос для списания Киберонов успешный")
             return response
@@ -501,9 +563,11 @@ def spent_client_kiberons(branch_id, customer_id, count, note=""):
 
 
 def get_client_kiberons(branch_id, customer_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/bonus/balance-bonus?customer_id={customer_id}"
+    url = crm_url(f"{branch_id}/bonus/balance-bonus?customer_id={customer_id}")
     
-    response: dict = send_request_to_crm(url=url, data=None, params=None)
+    response: dict = bonus_balance_cache.get_or_fetch(
+        branch_id, customer_id, {}, lambda: send_request_to_crm(url=url, data=None, params=None)
+    )
     if response:
         logger.info("Запрос для получения числа киберонов успешный")
         if 'balance_bonus' in response:
@@ -514,50 +578,136 @@ def get_client_kiberons(branch_id, customer_id):
         return None
 
 
-def get_all_clients(branch_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer/index"
-    
-    page = 0
-    count = 1
-    
-    while count > 0:
-        data = {
-            "is_study": 0,
-            "page": page
-        }
-        clients_response = send_request_to_crm(url=url, data=data, params=None)
-        
-        if not clients_response:
-            logger.error(f"Не удалось получить клиентов для филиала {branch_id}, страница {page}")
-            break
-            
-        if "items" in clients_response:
-            clients = clients_response["items"]
-            count = clients_response.get("count", 0)
-            logger.info(f"Получено {len(clients)} клиентов для филиала {branch_id}, страница {page}")
-            
-            # Возвращаем клиентов по одному через yield
-            for client in clients:
-                yield client
-                
-        else:
-            logger.error(f"Неверный формат ответа от CRM для филиала {branch_id}, страница {page}")
-            break
-            
-        page += 1
-    
-    logger.info(f"Завершено получение клиентов для филиала {branch_id}")
+def get_all_clients(branch_id, is_study: int = 0, fields: tuple | None = None):
+    """
+    Все клиенты филиала. Записи отдаются по одной, страницы загружаются
+    одновременно (см. stream_all_items). Если заданы fields, в записях
+    остаются только эти поля (например, ("id", "name", "branch_ids")).
+    """
+    yield from get_all_clients_in_branches([branch_id], is_study, fields)
+
+
+def get_all_clients_in_branches(branch_ids, is_study: int = 0, fields: tuple | None = None):
+    """
+    Клиенты нескольких филиалов: филиалы загружаются одновременно,
+    записи отдаются по филиалам в переданном порядке.
+    """
+    sources = [(crm_url(f"{branch_id}/customer/index"), {"is_study": is_study}) for branch_id in branch_ids]
+    yield from stream_all_items(sources, fields=fields)
+
+
+@app.task
+def rebuild_customer_phone_index():
+    """
+    Задача для полной перестройки индекса телефонов по всем клиентам и лидам CRM.
+    """
+    indexed = 0
+    for is_study in client_is_study_statuses:
+        indexed += index_customers(get_all_clients_in_branches(get_branch_ids(), is_study, PHONE_INDEX_FIELDS))
+    logger.info(f"Индекс телефонов перестроен: {indexed} записей")
+    return indexed
+
+
+def mirror_lessons(date_from: date, date_to: date, status: int | None = None) -> int:
+    """
+    Обновляет зеркало уроков всех филиалов за даты date_from..date_to:
+    один проход по страницам lesson/index на филиал вместо запросов по клиентам.
+    Филиал, выгрузка которого не удалась, сохраняет прежние данные.
+    """
+    data = {"date_from": date_from.isoformat(), "date_to": date_to.isoformat()}
+    if status is not None:
+        data["status"] = status
+    mirrored = 0
+    for branch_id in get_branch_ids():
+        lessons = fetch_all_items(crm_url(f"{branch_id}/lesson/index"), data, LessonRecord.FIELDS)
+        if lessons is None:
+            logger.error(f"Не удалось выгрузить уроки филиала {branch_id} за {date_from}..{date_to}")
+            continue
+        mirrored += mirror_branch_lessons(int(branch_id), lessons, date_from, date_to, status)
+    return mirrored
+
+
+@app.task
+def refresh_lesson_schedule():
+    """
+    Задача для обновления зеркала уроков за скользящее окно
+    (LESSON_MIRROR_DAYS_BEFORE дней назад - LESSON_MIRROR_DAYS_AHEAD дней вперед).
+    """
+    today = date.today()
+    mirrored = mirror_lessons(today - timedelta(days=LESSON_MIRROR_DAYS_BEFORE), today + timedelta(days=LESSON_MIRROR_DAYS_AHEAD))
+    logger.info(f"Расписание уроков обновлено: {mirrored} записей")
+    return mirrored
+
+
+@app.task
+def refresh_lesson_history():
+    """
+    Задача для обновления проведенных уроков в зеркале за LESSON_MIRROR_HISTORY_DAYS дней.
+    """
+    today = date.today()
+    mirrored = mirror_lessons(today - timedelta(days=LESSON_MIRROR_HISTORY_DAYS), today, status=LESSON_TAUGHT)
+    logger.info(f"История проведенных уроков обновлена: {mirrored} записей")
+    return mirrored
+
+
+@app.task
+def backfill_lesson_history(date_from: str | None = None, follow: bool = True) -> int:
+    """
+    Задача для загрузки полной истории проведенных уроков в зеркало:
+    окно LESSON_MIRROR_BACKFILL_DAYS дней с date_from (по умолчанию
+    с LESSON_MIRROR_HISTORY_START).
+    ---
+    С follow следующее окно ставится отдельной задачей, чтобы каждая
+    укладывалась в лимит времени. Окна идут от старых к новым, поэтому
+    история филиала становится полной после загрузки последнего окна.
+    """
+    start = date.fromisoformat(date_from) if date_from else LESSON_MIRROR_HISTORY_START
+    today = date.today()
+    end = min(start + timedelta(days=LESSON_MIRROR_BACKFILL_DAYS - 1), today)
+    mirrored = mirror_lessons(start, end, status=LESSON_TAUGHT)
+    logger.info(f"История проведенных уроков за {start}..{end} загружена: {mirrored} записей")
+    if follow and end < today:
+        backfill_lesson_history.delay((end + timedelta(days=1)).isoformat())
+    return mirrored
+
+
+@worker_ready.connect
+def bootstrap_lesson_mirror(sender=None, **kwargs):
+    """
+    При старте воркера ставит загрузку зеркала уроков, если у каких-то
+    филиалов еще не загружены расписание или полная история.
+    ---
+    Загрузку ставит только один воркер за LESSON_MIRROR_BOOTSTRAP_LOCK_TTL.
+    """
+    try:
+        branch_ids = {int(branch_id) for branch_id in get_branch_ids()}
+        scheduled = set(scheduled_branch_ids().values_list("crm_branch_id", flat=True))
+        covered = set(history_branch_ids(fresh=False).values_list("crm_branch_id", flat=True))
+        if branch_ids <= scheduled and branch_ids <= covered:
+            return
+        if not cache.add("crm:lesson_mirror:bootstrap", 1, LESSON_MIRROR_BOOTSTRAP_LOCK_TTL):
+            return
+    except Exception as e:
+        logger.error(f"Не удалось проверить зеркало уроков при старте воркера: {e}")
+        return
+
+    if not branch_ids <= scheduled:
+        logger.info(f"Загрузка расписания уроков филиалов: {sorted(branch_ids - scheduled)}")
+        refresh_lesson_schedule.delay()
+    if not branch_ids <= covered:
+        logger.info(f"Загрузка полной истории уроков филиалов: {sorted(branch_ids - covered)}")
+        backfill_lesson_history.delay()
 
 
 def get_teacher(branch, phone_number):
-    url = f"https://kiberoneminsk.s20.online/v2api/{branch}/teacher/index"
+    url = crm_url(f"{branch}/teacher/index")
     data = {"phone": phone_number}
     response = send_request_to_crm(url=url, data=data, params=None)
     return response
 
 
 def get_teacher_group(branch, teacher_id):
-    url = f"https://kiberoneminsk.s20.online/v2api/{branch}/group/index"
+    url = crm_url(f"{branch}/group/index")
 
     data = {
         "teacher_id": teacher_id
@@ -576,50 +726,22 @@ def get_teacher_group(branch, teacher_id):
 
 
 def get_clients_in_group(group_id, branch):
-    url = f"https://kiberoneminsk.s20.online/v2api/{branch}/cgi/index?group_id={group_id}"
+    url = crm_url(f"{branch}/cgi/index?group_id={group_id}")
 
     cgi_res = send_request_to_crm(url=url, data=None, params=None)
     customer_ids = [customer_id['customer_id'] for customer_id in cgi_res.get('items', [])]
-    client_names = []
-    
+    customers = find_clients_by_ids(branch, customer_ids)
+
+    clients_in_group = []
     for customer_id in customer_ids:
-        client_data = find_client_by_id(branch, int(customer_id))
+        client_data = customers.get(int(customer_id))
         if client_data:
             client_name = client_data.get('name', 'Неизвестный клиент')
-            client_names.append(client_name)
         else:
-            client_names.append('Клиент не найден')
-    
-    clients_in_group = [{'customer_id': customer_id, 'client_name': client_name} 
-                       for customer_id, client_name in zip(customer_ids, client_names)]
+            client_name = 'Клиент не найден'
+        clients_in_group.append({'customer_id': customer_id, 'client_name': client_name})
     return clients_in_group
 
 
-def get_all_groups():
-    try:
-        branches_ = Branch.objects.all()
-    except Branch.DoesNotExist:
-        return []
-
-    all_items = []
-    for branch in branches_:
-        url = f"https://kiberoneminsk.s20.online/v2api/{branch.branch_id}/group/index"
-        page = 0
-
-        while True:
-            response: dict = send_request_to_crm(url=url, data={"page": page}, params=None)
-            items = response.get("items", [])
-            current_page_count = len(items)  # или response.get("count", 0), если API возвращает это поле
-            total = response.get("total", 0)
-
-            if current_page_count == 0:
-                break  # больше нет данных
-
-            all_items.extend(items)
-            page += 1
-
-            # Дополнительная защита: если уже собрали все записи
-            if len(all_items) >= total > 0:
-                break
-
-    return all_items
+def get_branch_ids() -> list:
+    return [branch.branch_id for branch in Branch.objects.exclude(branch_id__isnull=True)]
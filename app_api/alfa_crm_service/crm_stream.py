@@ -0,0 +1,134 @@
+import codecs
+import json
+
+_WHITESPACE = " \t\n\r"
+
+
+class ItemsStreamDecoder:
+    """
+    Потоковый разбор ответа метода *index*: {"total": ..., "items": [...], ...}.
+    ---
+    Ответ подается кусками через feed() по мере чтения из сети. Каждая
+    запись массива items разбирается, как только получена целиком, и из нее
+    сразу остаются только поля fields (если заданы), поэтому в памяти
+    не держатся ни весь текст страницы, ни полные записи. Остальные поля
+    верхнего уровня (total, count, page) собираются в meta.
+    """
+
+    def __init__(self, fields: tuple | list | None = None):
+        self.fields = tuple(fields) if fields is not None else None
+        self.meta: dict = {}
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        # start -> key -> colon -> value (или items -> item_comma -> ...) -> comma -> key ... -> done
+        self._state = "start"
+        self._key = None
+
+    def project(self, item):
+        if self.fields is None or not isinstance(item, dict):
+            return item
+        return {field: item.get(field) for field in self.fields}
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Добавляет кусок ответа и возвращает записи items, полученные целиком.
+        """
+        self._buffer = self._buffer[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        return self._parse()
+
+    def close(self) -> dict:
+        """
+        Завершает разбор и возвращает поля верхнего уровня.
+        Выбрасывает ValueError, если ответ оборвался или некорректен.
+        """
+        self._buffer = self._buffer[self._pos:] + self._text.decode(b"", final=True)
+        self._pos = 0
+        self._parse()
+        if self._state != "done":
+            raise ValueError("Ответ CRM оборвался до конца JSON")
+        return self.meta
+
+    def _skip_whitespace(self) -> bool:
+        buffer, pos = self._buffer, self._pos
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buffer)
+
+    def _expect(self, char: str):
+        if self._buffer[self._pos] != char:
+            raise ValueError(f"Некорректный JSON в ответе CRM: ожидался '{char}' в позиции {self._pos}")
+        self._pos += 1
+
+    def _decode_value(self):
+        """
+        Разбирает значение с текущей позиции или возвращает (False, None),
+        если оно еще не получено целиком.
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            return False, None
+        # Число в конце буфера может продолжиться в следующем куске
+        if end == len(self._buffer) and self._buffer[end - 1] not in "}]\"el":
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _parse(self) -> list:
+        items = []
+        while self._state != "done" and self._skip_whitespace():
+            char = self._buffer[self._pos]
+            if self._state == "start":
+                self._expect("{")
+                self._state = "key"
+            elif self._state == "key":
+                if char == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                ready, self._key = self._decode_value()
+                if not ready:
+                    break
+                self._state = "colon"
+            elif self._state == "colon":
+                self._expect(":")
+                self._state = "value"
+            elif self._state == "value":
+                if self._key == "items" and char == "[":
+                    self._pos += 1
+                    self._state = "items"
+                    continue
+                ready, value = self._decode_value()
+                if not ready:
+                    break
+                self.meta[self._key] = value
+                self._state = "comma"
+            elif self._state == "items":
+                if char == "]":
+                    self._pos += 1
+                    self._state = "comma"
+                    continue
+                ready, item = self._decode_value()
+                if not ready:
+                    break
+                items.append(self.project(item))
+                self._state = "item_comma"
+            elif self._state == "item_comma":
+                if char == "]":
+                    self._pos += 1
+                    self._state = "comma"
+                    continue
+                self._expect(",")
+                self._state = "items"
+            elif self._state == "comma":
+                if char == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                self._expect(",")
+                self._state = "key"
+        return items
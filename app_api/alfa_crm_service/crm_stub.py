@@ -0,0 +1,359 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+STUB_TOKEN = "stub-token"
+STUB_PAGE_SIZE = 50  # Размер страницы методов *index*, как в AlfaCRM
+
+FIRST_NAMES = ["Иван", "Анна", "Максим", "София", "Артем", "Мария", "Михаил", "Алиса", "Даниил", "Ева"]
+LAST_NAMES = ["Иванов", "Петров", "Сидоров", "Козлов", "Новиков", "Морозов", "Волков", "Соловьев", "Лебедев", "Егоров"]
+SUBJECTS = ["Программирование", "Робототехника", "Геймдизайн", "3D-моделирование", "Анимация", "Кибербезопасность"]
+
+
+def _crm_date(value: date) -> str:
+    return value.strftime("%d.%m.%Y")
+
+
+def generate_dataset(branch_ids=(1, 2, 3, 4), parents_per_branch: int = 100, seed: int = 1) -> dict:
+    """
+    Синтетические данные CRM: клиенты (по 1-3 ребенка на телефон родителя),
+    группы, уроки, тарифы, скидки, менеджеры, преподаватели и кибероны.
+    """
+    rnd = random.Random(seed)
+    today = date.today()
+    data = {
+        "customers": {}, "groups": {}, "lessons": [], "subjects": {}, "tariffs": {}, "customer_tariffs": [],
+        "discounts": [], "users": {}, "teachers": {}, "cgi": [], "bonuses": {},
+    }
+    next_id = iter(range(1, 10 ** 9))
+
+    for branch_id in branch_ids:
+        subject_ids = []
+        for name in SUBJECTS:
+            subject_id = next(next_id)
+            data["subjects"][subject_id] = {"id": subject_id, "name": name, "branch_ids": [branch_id], "active": True}
+            subject_ids.append(subject_id)
+
+        tariff_ids = []
+        for price in (180, 220, 260):
+            tariff_id = next(next_id)
+            data["tariffs"][tariff_id] = {"id": tariff_id, "name": f"Абонемент {price}", "price": price, "branch_ids": [branch_id]}
+            tariff_ids.append(tariff_id)
+
+        manager_ids = []
+        for index in range(3):
+            user_id = next(next_id)
+            data["users"][user_id] = {"id": user_id, "name": f"Менеджер {branch_id}-{index}", "branch_ids": [branch_id]}
+            manager_ids.append(user_id)
+
+        teacher_ids = []
+        for index in range(4):
+            teacher_id = next(next_id)
+            phone = f"+37529{rnd.randint(1000000, 9999999)}"
+            data["teachers"][teacher_id] = {
+                "id": teacher_id, "name": f"Тьютор {branch_id}-{index}", "phone": [phone], "branch_ids": [branch_id],
+            }
+            teacher_ids.append(teacher_id)
+
+        group_ids = []
+        for index in range(10):
+            group_id = next(next_id)
+            data["groups"][group_id] = {
+                "id": group_id,
+                "name": f"Группа {branch_id}-{index}",
+                "note": f"https://t.me/+stub{group_id}",
+                "branch_ids": [branch_id],
+                "teachers": [{"id": rnd.choice(teacher_ids)}],
+                "subject_id": rnd.choice(subject_ids),
+                "room_id": rnd.randint(1, 10),
+            }
+            group_ids.append(group_id)
+
+        for _ in range(parents_per_branch):
+            phone = f"+375{rnd.choice(['29', '33', '44', '25'])}{rnd.randint(1000000, 9999999)}"
+            last_name = rnd.choice(LAST_NAMES)
+            for _ in range(rnd.choice((1, 1, 2, 3))):
+                customer_id = next(next_id)
+                is_study = 1 if rnd.random() < 0.7 else 0
+                group_id = rnd.choice(group_ids) if is_study else None
+                data["customers"][customer_id] = {
+                    "id": customer_id,
+                    "name": f"{last_name} {rnd.choice(FIRST_NAMES)}",
+                    "branch_ids": [branch_id],
+                    "is_study": is_study,
+                    "phone": [phone],
+                    "dob": _crm_date(today - timedelta(days=rnd.randint(7 * 365, 14 * 365))),
+                    "balance": str(rnd.choice([-220, 0, 180, 440, 660])),
+                    "paid_lesson_count": rnd.randint(0, 8),
+                    "paid_till": _crm_date(today + timedelta(days=rnd.randint(-10, 40))),
+                    "next_lesson_date": (today + timedelta(days=rnd.randint(0, 7))).isoformat(),
+                    "assigned_id": rnd.choice(manager_ids),
+                    "note": "",
+                }
+                data["bonuses"][customer_id] = rnd.randint(0, 300)
+                data["customer_tariffs"].append({
+                    "customer_id": customer_id,
+                    "tariff_id": rnd.choice(tariff_ids),
+                    "b_date": _crm_date(today - timedelta(days=60)),
+                    "e_date": _crm_date(today + timedelta(days=300)),
+                })
+                if rnd.random() < 0.2:
+                    data["discounts"].append({
+                        "customer_id": customer_id,
+                        "amount": rnd.choice([5, 10, 15]),
+                        "begin": _crm_date(today - timedelta(days=30)),
+                        "end": _crm_date(today + timedelta(days=60)),
+                    })
+                if group_id is None:
+                    continue
+
+                group = data["groups"][group_id]
+                data["cgi"].append({"customer_id": customer_id, "group_id": group_id, "branch_id": branch_id})
+                for week in range(-8, 4):
+                    lesson_date = today + timedelta(days=7 * week)
+                    taught = lesson_date < today
+                    data["lessons"].append({
+                        "id": next(next_id),
+                        "branch_id": branch_id,
+                        "date": lesson_date.isoformat(),
+                        "time_from": f"{lesson_date.isoformat()} 15:00:00",
+                        "time_to": f"{lesson_date.isoformat()} 16:30:00",
+                        "status": 3 if taught else 1,
+                        "lesson_type_id": 2,
+                        "subject_id": group["subject_id"],
+                        "room_id": group["room_id"],
+                        "group_ids": [group_id],
+                        "customer_ids": [customer_id],
+                        "details": [{"customer_id": customer_id, "is_attend": 1 if taught else 0, "reason_id": None}],
+                    })
+    return data
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _digits(value) -> str:
+    return re.sub(r"\D", "", str(value))
+
+
+class CRMStub:
+    """
+    Локальная замена AlfaCRM для нагрузочных тестов.
+    ---
+    Реализует методы v2api, которые использует crm_service, поверх
+    синтетических данных. latency и jitter задают задержку ответа
+    в секундах, rate_429 - долю ответов 429. Число вызовов по методам
+    доступно в calls и по GET /__stats.
+    """
+
+    def __init__(self, data: dict, latency: float = 0.05, jitter: float = 0.3, rate_429: float = 0.0, seed: int = 1):
+        self.data = data
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    # --- методы API ---
+
+    def _page(self, items: list, body: dict) -> dict:
+        page = int(body.get("page") or 0)
+        page_items = items[page * STUB_PAGE_SIZE:(page + 1) * STUB_PAGE_SIZE]
+        return {"total": len(items), "count": len(page_items), "page": page, "items": page_items}
+
+    def _branch_items(self, items, branch_id: int) -> list:
+        return [item for item in items if branch_id in item.get("branch_ids", [item.get("branch_id")])]
+
+    def customer_index(self, branch_id: int, body: dict, query: dict) -> dict:
+        items = self._branch_items(self.data["customers"].values(), branch_id)
+        ids = {int(customer_id) for customer_id in _as_list(body.get("id"))}
+        if ids:
+            items = [item for item in items if item["id"] in ids]
+        is_study = body.get("is_study")
+        if is_study is not None and int(is_study) != 2:
+            items = [item for item in items if item["is_study"] == int(is_study)]
+        if body.get("phone"):
+            phone = _digits(body["phone"])[-9:]
+            items = [item for item in items if any(_digits(value).endswith(phone) for value in item["phone"])]
+        return self._page(items, body)
+
+    def customer_create(self, branch_id: int, body: dict, query: dict) -> dict:
+        with self._lock:
+            customer_id = max(self.data["customers"], default=0) + 1
+            customer = {
+                "id": customer_id, "name": body.get("name"), "branch_ids": [branch_id],
+                "is_study": int(body.get("is_study") or 0), "phone": _as_list(body.get("phone")),
+                "balance": "0", "paid_lesson_count": 0, "note": body.get("note", ""),
+            }
+            self.data["customers"][customer_id] = customer
+            self.data["bonuses"][customer_id] = 0
+        return {"success": True, "model": customer}
+
+    def lesson_index(self, branch_id: int, body: dict, query: dict) -> dict:
+        items = [lesson for lesson in self.data["lessons"] if lesson["branch_id"] == branch_id]
+        if body.get("customer_id"):
+            items = [lesson for lesson in items if int(body["customer_id"]) in lesson["customer_ids"]]
+        for field in ("status", "lesson_type_id"):
+            if body.get(field):
+                items = [lesson for lesson in items if lesson[field] == int(body[field])]
+        if body.get("group_id"):
+            items = [lesson for lesson in items if int(body["group_id"]) in lesson["group_ids"]]
+        if body.get("date_from"):
+            items = [lesson for lesson in items if lesson["date"] >= body["date_from"]]
+        if body.get("date_to"):
+            items = [lesson for lesson in items if lesson["date"] <= body["date_to"]]
+        return self._page(items, body)
+
+    def by_customer(self, name: str):
+        def handler(branch_id: int, body: dict, query: dict) -> dict:
+            customer_id = int(query.get("customer_id") or body.get("customer_id") or 0)
+            return self._page([item for item in self.data[name] if item["customer_id"] == customer_id], body)
+        return handler
+
+    def catalog(self, name: str):
+        def handler(branch_id: int, body: dict, query: dict) -> dict:
+            items = self._branch_items(self.data[name].values(), branch_id)
+            if body.get("id"):
+                items = [item for item in items if item["id"] == int(body["id"])]
+            if body.get("phone"):
+                phone = _digits(body["phone"])[-9:]
+                items = [item for item in items if any(_digits(value).endswith(phone) for value in item.get("phone", []))]
+            return self._page(items, body)
+        return handler
+
+    def cgi_index(self, branch_id: int, body: dict, query: dict) -> dict:
+        group_id = int(query.get("group_id") or body.get("group_id") or 0)
+        return self._page([item for item in self.data["cgi"] if item["group_id"] == group_id], body)
+
+    def cgi_customer(self, branch_id: int, body: dict, query: dict) -> dict:
+        customer_id = int(query.get("customer_id") or body.get("customer_id") or 0)
+        return self._page([item for item in self.data["cgi"] if item["customer_id"] == customer_id], body)
+
+    def balance_bonus(self, branch_id: int, body: dict, query: dict) -> dict:
+        return {"balance_bonus": self.data["bonuses"].get(int(query.get("customer_id", 0)), 0)}
+
+    def change_bonus(self, sign: int):
+        def handler(branch_id: int, body: dict, query: dict) -> dict:
+            customer_id = int(query.get("customer_id", 0))
+            with self._lock:
+                self.data["bonuses"][customer_id] = self.data["bonuses"].get(customer_id, 0) + sign * int(body.get("amount", 0))
+            return {"success": True, "balance_bonus": self.data["bonuses"][customer_id]}
+        return handler
+
+    def routes(self) -> dict:
+        return {
+            "customer/index": self.customer_index,
+            "customer/create": self.customer_create,
+            "lesson/index": self.lesson_index,
+            "customer-tariff/index": self.by_customer("customer_tariffs"),
+            "discount/index": self.by_customer("discounts"),
+            "tariff/index": self.catalog("tariffs"),
+            "subject/index": self.catalog("subjects"),
+            "group/index": self.catalog("groups"),
+            "user/index": self.catalog("users"),
+            "teacher/index": self.catalog("teachers"),
+            "cgi/index": self.cgi_index,
+            "cgi/customer": self.cgi_customer,
+            "bonus/balance-bonus": self.balance_bonus,
+            "bonus/bonus-add": self.change_bonus(1),
+            "bonus/bonus-spend": self.change_bonus(-1),
+        }
+
+    # --- HTTP ---
+
+    def handle(self, method: str, raw_path: str, headers, body: bytes) -> tuple[int, dict]:
+        url = urlsplit(raw_path)
+        query = dict(parse_qsl(url.query))
+        if url.path == "/__stats":
+            with self._lock:
+                return 200, {"calls": dict(self.calls), "total": sum(self.calls.values())}
+        if url.path == "/__reset":
+            with self._lock:
+                self.calls.clear()
+            return 200, {"success": True}
+
+        path = url.path.split("/v2api/", 1)[-1].strip("/")
+        parts = path.split("/")
+        branch_id = int(parts.pop(0)) if parts and parts[0].isdigit() else 0
+        endpoint = "/".join(parts)
+        with self._lock:
+            self.calls[endpoint] += 1
+            throttled = self._random.random() < self.rate_429
+            delay = max(0.0, self._random.gauss(self.latency, self.latency * self.jitter))
+        time.sleep(delay)
+
+        if throttled:
+            return 429, {"message": "Too many requests"}
+        try:
+            payload = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return 400, {"message": "Bad JSON"}
+
+        if endpoint == "auth/login":
+            return 200, {"token": STUB_TOKEN}
+        if headers.get("X-ALFACRM-TOKEN") != STUB_TOKEN:
+            return 401, {"message": "Unauthorized"}
+
+        handler = self.routes().get(endpoint)
+        if handler is None:
+            return 404, {"message": f"Unknown method {endpoint}"}
+        return 200, handler(branch_id, payload or {}, query)
+
+    def make_server(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                status, payload = stub.handle(self.command, self.path, self.headers, self.rfile.read(length))
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # Очередь по умолчанию (5) переполняется одновременными запросами
+            # асинхронного клиента, и соединения сбрасываются (httpx.ReadError)
+            request_queue_size = 128
+
+        self._server = Server((host, port), Handler)
+        return self._server
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Запускает сервер в фоновом потоке. Возвращает адрес host:port.
+        """
+        server = self.make_server(host, port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"{server.server_address[0]}:{server.server_address[1]}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+import time
+
+import redis
+from redis.exceptions import LockError
+
+from app_api.alfa_crm_service.crm_logging import response_body
+from app_api.alfa_crm_service.crm_redis import get_redis_client
+from app_api.alfa_crm_service.crm_transport import crm_url, get_crm_transport
+
+logger = logging.getLogger(__name__)
+
+CRM_TOKEN_KEY = "crm_token"
+CRM_TOKEN_LOCK_KEY = "crm_token_lock"
+CRM_TOKEN_TTL = int(os.getenv("CRM_TOKEN_TTL", 3300))  # 55 минут
+CRM_TOKEN_LOCK_TIMEOUT = 30  # Сколько секунд держится блокировка на время авторизации
+CRM_TOKEN_WAIT_TIMEOUT = 15  # Сколько секунд ждать, пока другой процесс получит токен
+CRM_TOKEN_EXPIRY_MARGIN = 30  # Локальная копия считается устаревшей на 30 секунд раньше Redis
+
+# Удаляет токен из Redis, только если там все еще лежит отклоненный токен
+_DELETE_IF_EQUALS = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def login_to_alfa_crm():
+    """
+    Авторизация в CRM и получение токена.
+    """
+    email = os.getenv("CRM_EMAIL")
+    api_key = os.getenv("CRM_API_KEY")
+    logger.info(f"Начинается авторизация в CRM с email: {email}...")
+
+    data = {"email": email, "api_key": api_key}
+    url = crm_url("auth/login")
+    logger.debug("URL для авторизации: %s", url)
+
+    try:
+        response = get_crm_transport().post(url, json=data)
+
+        if response.status_code == 200:
+            token_data = response.json()
+            token = token_data.get("token")
+            logger.info(f"Токен успешно получен: {token[:10]}... (первые 10 символов)")
+            return token
+        else:
+            logger.error("Ошибка авторизации: статус %s. Тело: %s", response.status_code, response_body(response))
+            return None
+    except Exception as e:
+        logger.error(f"Произошла ошибка при отправке запроса для авторизации: {e}")
+        return None
+
+
+class CRMTokenManager:
+    """
+    Менеджер токена CRM.
+    ---
+    1. Токен хранится в памяти процесса вместе со временем истечения,
+       поэтому обычный запрос к CRM не обращается к Redis.
+    2. При промахе токен читается из Redis; если его нет и там,
+       авторизуется только процесс, захвативший блокировку в Redis,
+       остальные ждут блокировку и забирают готовый токен.
+    3. Отклоненный CRM токен (401) сбрасывается через invalidate().
+    """
+
+    def __init__(self, login_func=login_to_alfa_crm, ttl: int = CRM_TOKEN_TTL):
+        self.login_func = login_func
+        self.ttl = ttl
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str | None:
+        token = self._local_token()
+        if token:
+            return token
+
+        with self._lock:
+            token = self._local_token()
+            if token:
+                return token
+            return self._load_or_login()
+
+    def refresh(self) -> str | None:
+        """
+        Принудительная авторизация с сохранением токена в Redis.
+        """
+        with self._lock:
+            self._forget()
+            return self._load_or_login(force=True)
+
+    def invalidate(self, token: str):
+        """
+        Сбрасывает токен, отклоненный CRM, локально и в Redis.
+        """
+        with self._lock:
+            if self._token == token:
+                self._forget()
+        try:
+            get_redis_client().eval(_DELETE_IF_EQUALS, 1, CRM_TOKEN_KEY, token)
+        except redis.RedisError as e:
+            logger.error(f"Не удалось удалить токен из Redis: {e}")
+
+    def use_token(self, token: str, ttl: int | None = None):
+        """
+        Задает токен процесса без авторизации и Redis (например, для заглушки CRM).
+        """
+        with self._lock:
+            self._remember(token, ttl or self.ttl)
+
+    def _local_token(self) -> str | None:
+        if self._token and time.monotonic() < self._expires_at:
+            return self._token
+        return None
+
+    def _remember(self, token: str, ttl: int):
+        self._token = token
+        self._expires_at = time.monotonic() + max(ttl - CRM_TOKEN_EXPIRY_MARGIN, 0)
+
+    def _forget(self):
+        self._token = None
+        self._expires_at = 0.0
+
+    def _read_redis(self, redis_client) -> str | None:
+        pipe = redis_client.pipeline()
+        pipe.get(CRM_TOKEN_KEY)
+        pipe.ttl(CRM_TOKEN_KEY)
+        token, ttl = pipe.execute()
+        if token and ttl and ttl > 0:
+            self._remember(token, ttl)
+            return token
+        return None
+
+    def _login_and_store(self, redis_client) -> str | None:
+        token = self.login_func()
+        if not token:
+            logger.error("Не удалось получить токен.")
+            return None
+        redis_client.set(CRM_TOKEN_KEY, token, ex=self.ttl)
+        self._remember(token, self.ttl)
+        logger.info("Новый токен сохранен в Redis.")
+        return token
+
+    def _load_or_login(self, force: bool = False) -> str | None:
+        try:
+            redis_client = get_redis_client()
+            if not force:
+                token = self._read_redis(redis_client)
+                if token:
+                    logger.info("Токен успешно получен из Redis.")
+                    return token
+
+            logger.info("Токен отсутствует в Redis. Запрашиваем новый токен...")
+            lock = redis_client.lock(
+                CRM_TOKEN_LOCK_KEY,
+                timeout=CRM_TOKEN_LOCK_TIMEOUT,
+                blocking_timeout=CRM_TOKEN_WAIT_TIMEOUT,
+            )
+            if not lock.acquire():
+                # Авторизация в другом процессе затянулась: пробуем забрать ее результат
+                token = self._read_redis(redis_client)
+                if not token:
+                    logger.error("Не дождались токена от другого процесса.")
+                return token
+
+            try:
+                if not force:
+                    # Пока ждали блокировку, токен мог получить другой процесс
+                    token = self._read_redis(redis_client)
+                    if token:
+                        logger.info("Токен получен другим процессом.")
+                        return token
+                return self._login_and_store(redis_client)
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    logger.warning("Блокировка токена истекла до завершения авторизации.")
+
+        except redis.RedisError as e:
+            logger.error(f"Redis недоступен, авторизация без общего кэша токена: {e}")
+            token = self.login_func()
+            if token:
+                self._remember(token, self.ttl)
+            return token
+
+
+token_manager = CRMTokenManager()
@@ -0,0 +1,191 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app_api.alfa_crm_service.crm_caller import get_crm_caller
+from app_api.alfa_crm_service.crm_circuit_breaker import CRMUnavailableError, get_circuit_breaker
+from app_api.alfa_crm_service.crm_logging import log_crm_call
+from app_api.alfa_crm_service.crm_metrics import observe_crm_request
+from app_api.alfa_crm_service.crm_metrics_publisher import maybe_publish_metrics
+from app_api.alfa_crm_service.crm_rate_limiter import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+CRM_SCHEME = os.getenv("CRM_SCHEME", "https")
+CRM_HOSTNAME = os.getenv("CRM_HOSTNAME", "kiberoneminsk.s20.online")
+
+CRM_POOL_SIZE = int(os.getenv("CRM_POOL_SIZE", 10))  # Размер пула соединений на один хост
+CRM_CONNECT_TIMEOUT = float(os.getenv("CRM_CONNECT_TIMEOUT", 3.05))  # Таймаут установки соединения
+CRM_READ_TIMEOUT = float(os.getenv("CRM_READ_TIMEOUT", 10))  # Таймаут чтения ответа
+
+BASE_HEADERS = {
+    "Content-Type": "application/json",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept": "application/json, text/plain, */*",
+}
+
+
+class CRMTransport:
+    """
+    Общий HTTP-транспорт для запросов к AlfaCRM.
+    ---
+    Держит по одной keep-alive сессии с пулом соединений на каждый хост.
+    Сессии создаются заново после fork (gunicorn/celery prefork),
+    чтобы процессы не делили между собой сокеты.
+    """
+
+    def __init__(
+        self,
+        scheme: str = CRM_SCHEME,
+        hostname: str = CRM_HOSTNAME,
+        pool_size: int = CRM_POOL_SIZE,
+        connect_timeout: float = CRM_CONNECT_TIMEOUT,
+        read_timeout: float = CRM_READ_TIMEOUT,
+    ):
+        self.scheme = scheme
+        self.hostname = hostname
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions: dict[str, requests.Session] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return self.connect_timeout, self.read_timeout
+
+    def url(self, path: str) -> str:
+        """
+        Формирует полный URL метода API, например url("1/customer/index").
+        """
+        return f"{self.scheme}://{self.hostname}/v2api/{path.lstrip('/')}"
+
+    def get_session(self, url: str) -> requests.Session:
+        """
+        Возвращает сессию для хоста из URL, создавая её при первом обращении.
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            if self._pid != os.getpid():
+                # Процесс был форкнут: соединения родителя использовать нельзя
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=0,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(BASE_HEADERS)
+                self._sessions[host] = session
+                logger.info(f"Создана сессия CRM для хоста {host} (пул: {self.pool_size})")
+            return session
+
+    def post(
+        self,
+        url: str,
+        json: dict | None = None,
+        params: dict | None = None,
+        headers: dict | None = None,
+        timeout: float | tuple[float, float] | None = None,
+    ) -> requests.Response:
+        """
+        Выполняет POST-запрос через пул соединений
+        после разрешения общего ограничителя запросов.
+        Если предохранитель группы методов разомкнут, сразу
+        выбрасывает CRMUnavailableError.
+        """
+        breaker = get_circuit_breaker(url)
+        if not breaker.allow():
+            raise CRMUnavailableError(f"CRM недоступна (предохранитель '{breaker.family}' разомкнут)")
+
+        session = self.get_session(url)
+        try:
+            rate_limiter.acquire(urlsplit(url).netloc)
+        except BaseException:
+            # Запрос не отправлен: это не ошибка CRM, слот пробы освобождается
+            breaker.cancel()
+            raise
+        started = time.monotonic()
+        try:
+            response = session.post(
+                url,
+                json=json,
+                params=params,
+                headers=headers,
+                timeout=timeout or self.timeout,
+            )
+        except Exception:
+            duration = time.monotonic() - started
+            breaker.record(duration, failed=True)
+            observe_crm_request(url, "error", duration, 0, get_crm_caller())
+            log_crm_call(url, "error", duration, caller=get_crm_caller())
+            raise
+        duration = time.monotonic() - started
+        breaker.record(duration, failed=response.status_code >= 500)
+        caller = get_crm_caller()
+        observe_crm_request(url, response.status_code, duration, len(response.content), caller)
+        log_crm_call(url, response.status_code, duration, len(response.content), caller, response)
+        maybe_publish_metrics()
+        return response
+
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        Создает асинхронный клиент с теми же заголовками, пулом и таймаутами.
+        ---
+        Клиент привязан к циклу событий, поэтому открывается на время одной
+        асинхронной операции (async with) и внутри неё переиспользует соединения.
+        """
+        return httpx.AsyncClient(
+            headers=BASE_HEADERS,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+        )
+
+    def close(self):
+        """
+        Закрывает все открытые сессии текущего процесса.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_transport: CRMTransport | None = None
+_transport_lock = threading.Lock()
+
+
+def get_crm_transport() -> CRMTransport:
+    """
+    Возвращает общий для процесса экземпляр транспорта CRM.
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = CRMTransport()
+    return _transport
+
+
+def crm_url(path: str) -> str:
+    """
+    Короткий доступ к CRMTransport.url для функций сервиса.
+    """
+    return get_crm_transport().url(path)
@@ -0,0 +1,22 @@
+from app_api.alfa_crm_service.crm_caller import set_crm_caller
+
+
+class CRMCallerMiddleware:
+    """
+    Подписывает запросы к CRM именем view, которое их выполняет.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = set_crm_caller("web")
+        try:
+            return self.get_response(request)
+        finally:
+            token.var.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        set_crm_caller(match.view_name if match and match.view_name else getattr(view_func, "__name__", "web"))
+        return None
@@ -1,2 +1,141 @@
 from django.db import models
 
+
+class CustomerPhone(models.Model):
+    """
+    Индекс телефонов клиентов CRM: номер в формате E.164 -> клиент.
+    ---
+    У одного номера может быть несколько клиентов (например, родитель
+    нескольких детей), в том числе в разных филиалах.
+    """
+
+    phone = models.CharField(max_length=16, db_index=True, verbose_name="Телефон (E.164)")
+    crm_branch_id = models.IntegerField(verbose_name="ID филиала в ЦРМ")
+    crm_id = models.CharField(max_length=100, verbose_name="ID клиента в ЦРМ")
+    is_study = models.IntegerField(default=0, verbose_name="Статус в ЦРМ (0 - лид, 1 - клиент)")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    def __str__(self):
+        return f"{self.phone} -> {self.crm_branch_id}/{self.crm_id}"
+
+    class Meta:
+        db_table = "crm_customer_phone"
+        verbose_name = "Телефон клиента ЦРМ"
+        verbose_name_plural = "Телефоны клиентов ЦРМ"
+        constraints = [
+            models.UniqueConstraint(fields=["phone", "crm_branch_id", "crm_id"], name="unique_customer_phone"),
+        ]
+        indexes = [
+            models.Index(fields=["crm_branch_id", "crm_id"]),
+        ]
+
+
+class CRMSyncRun(models.Model):
+    """
+    Запуск синхронизации клиентов с CRM и его контрольная точка.
+    ---
+    Курсор (филиал, страница, последний id в CRM) сдвигается после каждой
+    сохраненной пачки клиентов. Прерванный запуск (остановка воркера,
+    лимит времени, недоступность CRM) продолжается следующим запуском
+    с курсора. В шардированном режиме вместо курсора хранятся план шардов
+    и номера завершенных шардов.
+    """
+
+    STATUS_RUNNING = "running"
+    STATUS_INTERRUPTED = "interrupted"
+    STATUS_COMPLETED = "completed"
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, "Выполняется"),
+        (STATUS_INTERRUPTED, "Прерван"),
+        (STATUS_COMPLETED, "Завершен"),
+    )
+
+    mode = models.CharField(max_length=20, verbose_name="Режим")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_RUNNING, verbose_name="Статус")
+    started_at = models.DateTimeField(auto_now_add=True, verbose_name="Начат")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Контрольная точка")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="Завершен")
+    resumed_count = models.IntegerField(default=0, verbose_name="Продолжений")
+
+    cursor_branch_id = models.IntegerField(blank=True, null=True, verbose_name="Курсор: филиал")
+    cursor_page = models.IntegerField(default=0, verbose_name="Курсор: пачка клиентов")
+    cursor_crm_id = models.IntegerField(blank=True, null=True, verbose_name="Курсор: последний ID в ЦРМ")
+    shards = models.JSONField(default=list, blank=True, verbose_name="План шардов")
+    done_shards = models.JSONField(default=list, blank=True, verbose_name="Завершенные шарды")
+
+    changed = models.IntegerField(default=0, verbose_name="Изменено")
+    unchanged = models.IntegerField(default=0, verbose_name="Без изменений")
+    missing = models.IntegerField(default=0, verbose_name="Удалено")
+    failed = models.IntegerField(default=0, verbose_name="Ошибок")
+    error = models.TextField(blank=True, null=True, verbose_name="Ошибка")
+
+    def __str__(self):
+        return f"{self.mode} {self.started_at:%d.%m.%Y %H:%M} ({self.get_status_display()})"
+
+    class Meta:
+        db_table = "crm_sync_run"
+        verbose_name = "Синхронизация с ЦРМ"
+        verbose_name_plural = "Синхронизации с ЦРМ"
+        ordering = ["-started_at"]
+
+
+class Lesson(models.Model):
+    """
+    Зеркало расписания уроков CRM: строка на каждого клиента урока.
+    ---
+    Заполняется выгрузкой lesson/index филиалов за диапазон дат (см.
+    crm_lesson_mirror), уведомления о занятиях читают только эту таблицу.
+    """
+
+    crm_branch_id = models.IntegerField(verbose_name="ID филиала в ЦРМ")
+    crm_lesson_id = models.IntegerField(verbose_name="ID урока в ЦРМ")
+    crm_customer_id = models.IntegerField(verbose_name="ID клиента в ЦРМ")
+    date = models.DateField(verbose_name="Дата")
+    time_from = models.TimeField(blank=True, null=True, verbose_name="Начало")
+    time_to = models.TimeField(blank=True, null=True, verbose_name="Окончание")
+    status = models.IntegerField(blank=True, null=True, verbose_name="Статус (1 - запланирован, 2 - отменен, 3 - проведен)")
+    lesson_type_id = models.IntegerField(blank=True, null=True, verbose_name="Тип (2 - групповой, 3 - пробный)")
+    room_id = models.IntegerField(blank=True, null=True, verbose_name="ID аудитории в ЦРМ")
+    is_attend = models.BooleanField(default=False, verbose_name="Посетил")
+    reason_id = models.IntegerField(blank=True, null=True, verbose_name="Причина пропуска")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    def __str__(self):
+        return f"{self.crm_branch_id}/{self.crm_lesson_id} {self.date} -> {self.crm_customer_id}"
+
+    class Meta:
+        db_table = "crm_lesson"
+        verbose_name = "Урок ЦРМ"
+        verbose_name_plural = "Уроки ЦРМ"
+        constraints = [
+            models.UniqueConstraint(fields=["crm_branch_id", "crm_lesson_id", "crm_customer_id"], name="unique_lesson_customer"),
+        ]
+        indexes = [
+            models.Index(fields=["crm_branch_id", "crm_customer_id", "status", "lesson_type_id", "date"]),
+            models.Index(fields=["date", "status", "lesson_type_id"]),
+        ]
+
+
+class LessonMirrorBranch(models.Model):
+    """
+    Состояние зеркала уроков филиала.
+    ---
+    Уведомления о занятиях филиала отправляются, только если его расписание
+    загружено хотя бы раз. "Первое занятие" определяется по отсутствию
+    проведенных групповых уроков, поэтому требует непрерывной истории
+    history_from..history_to с начала уроков в CRM (см. backfill_lesson_history).
+    """
+
+    crm_branch_id = models.IntegerField(unique=True, verbose_name="ID филиала в ЦРМ")
+    schedule_loaded_at = models.DateTimeField(blank=True, null=True, verbose_name="Расписание загружено")
+    history_from = models.DateField(blank=True, null=True, verbose_name="Проведенные уроки загружены с")
+    history_to = models.DateField(blank=True, null=True, verbose_name="Проведенные уроки загружены по")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    def __str__(self):
+        return f"{self.crm_branch_id}: расписание {self.schedule_loaded_at}, история {self.history_from}..{self.history_to}"
+
+    class Meta:
+        db_table = "crm_lesson_mirror_branch"
+        verbose_name = "Зеркало уроков филиала"
+        verbose_name_plural = "Зеркала уроков филиалов"
@@ -5,11 +5,13 @@ from django.conf import settings
 
 from app_kiberclub.models import Client, AppUser, Location
 from app_kiberclub.models import GiftLink
+from django.db.models import Exists
 from django.utils import timezone
 import logging
-import datetime
 from datetime import date, timedelta
-from app_api.alfa_crm_service.crm_service import get_client_lessons, get_taught_trial_lesson
+from app_api.alfa_crm_service.crm_lesson_mirror import client_lessons, first_lessons, history_branch_ids, scheduled_branch_ids
+from app_api.models import Lesson
+from app_api.tasks.crm_sync import tracked_clients
 
 
 logger = logging.getLogger(__name__)
@@ -110,228 +112,164 @@ def send_birthday_congratulations():
             logger.error(f"Ошибка при отправке поздравления пользователю {user.telegram_id}: {e}")
 
 
+def notified_clients():
+    """
+    Клиенты с пользователем в Telegram, аннотированные для запросов к зеркалу уроков.
+    ---
+    Клиенты филиалов, расписание которых еще не загружено в зеркало,
+    пропускаются: по пустому зеркалу уведомления были бы ошибочными.
+    """
+    return (
+        tracked_clients()
+        .select_related("user")
+        .filter(user__telegram_id__isnull=False, branch_int__in=scheduled_branch_ids())
+        .exclude(user__telegram_id="")
+    )
+
+
+def lesson_locations(lessons) -> dict[str, Location]:
+    """
+    Локации аудиторий уроков: location_crm_id -> локация.
+    """
+    room_ids = {str(lesson.room_id) for lesson in lessons if lesson.room_id is not None}
+    return {location.location_crm_id: location for location in Location.objects.filter(location_crm_id__in=room_ids)}
+
+
 @shared_task
 def check_clients_balance_and_notify():
     """
     Проверяет клиентов и отправляет уведомления тем, у кого paid_lesson_count < 1
+    и последний запланированный групповой урок - сегодня (по зеркалу уроков).
     В зависимости от даты отправляет разные сообщения:
     - до 10-го числа: обычное уведомление
     - после 10-го числа: напоминание с ссылкой на оплату
+    ---
+    Зеркало хранит расписание на LESSON_MIRROR_DAYS_AHEAD дней вперед,
+    поэтому "последний" означает: после сегодняшнего в этом окне
+    запланированных групповых уроков нет.
     """
     now = timezone.now()
+    today = timezone.localdate()
     logger.info("Запущена проверка баланса клиентов и отправка уведомлений...")
 
-    clients = Client.objects.select_related("user").filter(paid_lesson_count__lt=1)
+    clients = notified_clients().filter(
+        Exists(client_lessons(date=today, status=1, lesson_type_id=2)),
+        ~Exists(client_lessons(date__gt=today, status=1, lesson_type_id=2)),
+        paid_lesson_count__lt=1,
+    )
+
+    message = (
+        f"🔔 Это PUSH уведомление о необходимости пополнить KIBERказну\n\n"
+        "Чтобы оплатить обучение KIBERone, нажмите на боковую кнопку Меню->КИБЕРменю->Оплатить\n\n"
+        "Ваш KIBERone!\n"
+    )
+
+    reminder_message = (
+        "Уважаемый клиент!\n"
+        "У нас не отобразилась ваша оплата за занятия.\n"
+        "Чтобы оплатить обучение KIBERone, нажмите на боковую кнопку Меню->КИБЕРменю->Оплатить\n\n"
+        "Ваш KIBERone!\n"
+    )
+
+    # Выбираем сообщение в зависимости от текущей даты
+    notification_text = message if now.day <= 10 else reminder_message
 
     for client in clients:
         user: AppUser = client.user
-        if not user or not user.telegram_id:
-            continue
-
-        lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2)
-        planned_lessons_count = lesson_response.get("total", 0)
-        if planned_lessons_count > 0:
-            if lesson_response.get("total", 0) > lesson_response.get("count", 0):
-                page = lesson_response.get("total", 0) // lesson_response.get("count", 1)
-            else:
-                page = 0
-            logger.info(f"page: {page}")
-            lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2, page=page)
-            last_user_lesson = lesson_response.get("items", [])[-1]
-            next_lesson_date = last_user_lesson.get("lesson_date") if last_user_lesson.get("lesson_date") else last_user_lesson.get("date")
-
-            # если урок сегодня, то отправить уведомление
-            if timezone.now().strftime("%Y-%m-%d") == next_lesson_date:
-                message = (
-                    f"🔔 Это PUSH уведомление о необходимости пополнить KIBERказну\n\n"
-                    "Чтобы оплатить обучение KIBERone, нажмите на боковую кнопку Меню->КИБЕРменю->Оплатить\n\n"
-                    "Ваш KIBERone!\n"
-                )
-
-                reminder_message = (
-                    "Уважаемый клиент!\n"
-                    "У нас не отобразилась ваша оплата за занятия.\n"
-                    "Чтобы оплатить обучение KIBERone, нажмите на боковую кнопку Меню->КИБЕРменю->Оплатить\n\n"
-                    "Ваш KIBERone!\n"
-                )
-
-                # Выбираем сообщение в зависимости от текущей даты
-                current_day = now.day
-                notification_text = message if current_day <= 10 else reminder_message
-
-                try:
-                    send_telegram_message(user.telegram_id, notification_text)
-                    logger.info(f"Уведомление отправлено пользователю {user.telegram_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке сообщения пользователю {user.telegram_id}: {e}")
-                    continue
+        try:
+            send_telegram_message(user.telegram_id, notification_text)
+            logger.info(f"Уведомление отправлено пользователю {user.telegram_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения пользователю {user.telegram_id}: {e}")
+
+
+def send_lesson_tomorrow(client: Client, lesson: Lesson, location: Location | None, title: str):
+    if location is None:
+        logger.warning(f"Не найдена локация аудитории {lesson.room_id} для урока {lesson.crm_lesson_id}")
+        return
+    message = (
+        f"🔔 {title} в КИБЕР-школе уже завтра!\n"
+        f"Дата: {lesson.date:%d.%m}\n"
+        f"Время: {lesson.time_from.strftime('%H:%M') if lesson.time_from else '—'}\n"
+        f"Адрес: {location.name}\n{location.map_url}\n\n"
+        "Ваш KIBERone ♥"
+    )
+    try:
+        send_telegram_message(client.user.telegram_id, message)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке напоминания пользователю {client.user.telegram_id}: {e}")
 
 
 @shared_task
 def check_clients_lessons_before():
     """
-    Проверяет клиентов и отправляет уведомления тем, у кого пробные занятия завтра
+    Проверяет клиентов и отправляет уведомления тем, у кого завтра пробное
+    занятие или первое групповое занятие (запланировано на завтра, проведенных
+    групповых уроков нет). Данные берутся из зеркала уроков.
+    ---
+    Первое занятие определяется только в филиалах с полной историей
+    проведенных уроков (см. history_branch_ids).
     """
+    tomorrow = timezone.localdate() + timedelta(days=1)
+    clients = notified_clients().filter(paid_lesson_count__lt=1)
+
+    # Пробные занятия
+    trial_clients = list(clients.filter(Exists(client_lessons(date=tomorrow, status=1, lesson_type_id=3))))
+    trial_lessons = first_lessons(Lesson.objects.filter(date=tomorrow, status=1, lesson_type_id=3))
+
+    # НАПОМИНАНИЕ О ПЕРВОМ ЗАНЯТИИ
+    first_clients = list(
+        clients.filter(
+            Exists(client_lessons(date=tomorrow, status=1, lesson_type_id=2)),
+            ~Exists(client_lessons(status=3, lesson_type_id=2)),
+            branch_int__in=history_branch_ids(),
+        )
+    )
+    group_lessons = first_lessons(Lesson.objects.filter(date=tomorrow, status=1, lesson_type_id=2))
 
-    # Получаем клиентов с количеством оплаченных занятий меньше 1
-    clients = Client.objects.select_related("user").filter(paid_lesson_count__lt=1)
-
-    for client in clients:
-
-        # Запрос пробных занятий
-        lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=3)
-
-        total_trial_lessons = int(lesson_response.get("total", 0))
-
-        if total_trial_lessons > 0:
-            trial_lesson = lesson_response.get("items", [])[0]
-            lesson_date = trial_lesson.get("date", None)
-            lesson_time = f"{trial_lesson.get('time_from').split(' ')[1][:-3]}"
-            room_id = trial_lesson.get("room_id", None)
-
-            # Поиск локации
-            location = Location.objects.filter(location_crm_id=room_id).first()
-
-            if location:
-                message = (
-                    f"🔔 Ваше пробное занятие в КИБЕР-школе уже завтра!\n"
-                    f"Дата: {lesson_date.split('-')[2]}.{lesson_date.split('-')[1]}\n"
-                    f"Время: {lesson_time}\n"
-                    f"Адрес: {location.name}\n{location.map_url}\n\n"
-                    "Ваш KIBERone ♥"
-                )
-                try:
-                    send_telegram_message(client.user.telegram_id, message)
-                except Exception as e:
-                    continue
-
-        # НАПОМИНАНИЕ О ПЕРВОМ ЗАНЯТИИ
-
-        # запланированные уроки
-        lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2)
-
-        planned_lessons_count = lesson_response.get("total", 0)
-
-        if planned_lessons_count > 0:
-            # проведенные уроки
-            user_taught_lessons = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=3, lesson_type=2)
-            # если нет посещенных уроков
-            taught_lessons_count = user_taught_lessons.get("total", 0)
-
-            if taught_lessons_count == 0:
-                # забираем последний запланированный урок
-                if lesson_response.get("total", 0) > lesson_response.get("count", 0):
-                    page = lesson_response.get("total", 0) // lesson_response.get("count", 1)
-                else:
-                    page = 0
-                lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2, page=page)
-                last_user_lesson = lesson_response.get("items", [])[-1]
-
-                next_lesson_date = last_user_lesson.get("lesson_date") if last_user_lesson.get("lesson_date") else last_user_lesson.get("date")
-
-                room_id = last_user_lesson.get("room_id", None)
-                location = Location.objects.filter(location_crm_id=room_id).first()
-
-                # проверить что урок завтра
-                tomorrow_date = (timezone.now() + timezone.timedelta(days=1)).strftime("%Y-%m-%d")
-
-                if next_lesson_date == tomorrow_date:
-                    message = (
-                        f"🔔 Ваше первое занятие в КИБЕР-школе уже завтра!\n"
-                        f"Дата: {next_lesson_date.split('-')[2]}.{next_lesson_date.split('-')[1]}\n"
-                        f"Время: {last_user_lesson.get('time_from').split(' ')[1][:-3]}\n"
-                        f"Адрес: {location.name}\n{location.map_url}\n\n"
-                        "Ваш KIBERone ♥"
-                    )
-
-                    try:
-                        send_telegram_message(client.user.telegram_id, message)
-                    except Exception as e:
-                        continue
+    locations = lesson_locations([*trial_lessons.values(), *group_lessons.values()])
+    for title, lessons, reminded in (
+        ("Ваше пробное занятие", trial_lessons, trial_clients),
+        ("Ваше первое занятие", group_lessons, first_clients),
+    ):
+        for client in reminded:
+            lesson = lessons.get((client.branch_int, client.crm_id_int))
+            if lesson is not None:
+                send_lesson_tomorrow(client, lesson, locations.get(str(lesson.room_id)), title)
 
 
 @shared_task
 def check_client_passed_trial_lessons():
     """
-    Проверяет пробные занятия всех клиентов и отправляет уведомления о посещенных занятиях.
+    Отправляет уведомления клиентам, которые вчера посетили пробное занятие
+    (по зеркалу уроков).
     """
     logger.info("Старт задачи проверки пробных занятий для всех пользователей")
 
-    # Исправленный запрос: получаем пользователей с их клиентами и филиалами
-    users_qs = AppUser.objects.prefetch_related("clients", "clients__branch").filter(clients__isnull=False).distinct()
+    yesterday = timezone.localdate() - timedelta(days=1)
+    clients = notified_clients().filter(
+        Exists(client_lessons(date=yesterday, status=3, lesson_type_id=3, is_attend=True))
+    )
 
-    notification_count = 0
-
-    for user in users_qs:
-        user_clients = user.clients.all()
-
-        for client in user_clients:
-            client_crm_id = client.crm_id
-            branch_id = None
-
-            try:
-                branch_id = int(client.branch.branch_id) if client.branch and client.branch.branch_id else None
-            except Exception:
-                branch_id = None
-
-            if not client_crm_id or not branch_id:
-                logger.warning(f"Пропуск клиента без crm_id/branch_id: user={user.id} client={client.id}")
-                continue
-
-            try:
-                lessons_response = get_taught_trial_lesson(customer_id=client_crm_id, branch_id=branch_id)
-                items = []
-
-                if lessons_response is not None:
-                    try:
-                        items = lessons_response.get("items", []) or []
-                    except Exception as e:
-                        logger.error(f"Ошибка обработки ответа CRM для клиента {client_crm_id}: {e}")
-
-                attended = check_attend_on_lesson(items) if items else False
-
-                # Отправка уведомления в Telegram при обнаружении пробного урока
-                if attended:
-                    if user.telegram_id:
-                        message = (
-                            "Вчера вы были на пробном занятии в KIBERone 🚀\n"
-                            "А сегодня ловите ловите гайд по анимации в ROBLOX — оживите персонажей и попробуйте себя в роли разработчика 🔥\n\n"
-                            "До встречи на занятиях в KIBERone! 🚀"
-                        )
-
-                        # Создаем инлайн клавиатуру с кнопкой-ссылкой "Получить подарок"
-                        gift_link_obj = GiftLink.objects.first()
-                        gift_link_url = gift_link_obj.url if gift_link_obj else "#"  # fallback на старую ссылку
-                        inline_keyboard = [[{"text": "Получить подарок", "url": gift_link_url}]]
-
-                        try:
-                            send_telegram_message_with_inline_keyboard(user.telegram_id, message, inline_keyboard)
-                            notification_count += 1
-                            logger.info(f"Уведомление о пробном занятии отправлено пользователю {user.telegram_id} (client_id={client.id})")
-                        except Exception as e:
-                            logger.error(f"Ошибка при отправке уведомления о пробном занятии пользователю {user.telegram_id}: {e}")
-                    else:
-                        logger.info(f"Пробное занятие обнаружено, но у пользователя user_id={user.id} отсутствует telegram_id")
-
-                logger.info(f"user={user.id} client_crm_id={client_crm_id} attended_yesterday_trial={attended}")
-
-            except Exception as e:
-                logger.error(f"Ошибка при проверке пробных занятий для клиента {client_crm_id} (user={user.id}): {e}")
-
-    logger.info(f"Завершена проверка пробных занятий. Отправлено уведомлений: {notification_count}")
+    message = (
+        "Вчера вы были на пробном занятии в KIBERone 🚀\n"
+        "А сегодня ловите ловите гайд по анимации в ROBLOX — оживите персонажей и попробуйте себя в роли разработчика 🔥\n\n"
+        "До встречи на занятиях в KIBERone! 🚀"
+    )
 
+    # Создаем инлайн клавиатуру с кнопкой-ссылкой "Получить подарок"
+    gift_link_obj = GiftLink.objects.first()
+    gift_link_url = gift_link_obj.url if gift_link_obj else "#"  # fallback на старую ссылку
+    inline_keyboard = [[{"text": "Получить подарок", "url": gift_link_url}]]
 
-def check_attend_on_lesson(lessons):
-    for lesson in lessons:
-        details = lesson.get("details") or []
-        if not details:
-            continue
-        lesson_details = details[0]
-        is_attend = lesson_details.get("is_attend", False)
-        date_str = lesson.get("date")
-        if not date_str:
-            continue
-        if date_str == str(datetime.datetime.now().date() - timedelta(1)) and is_attend:
-            return True
+    notification_count = 0
+    for client in clients:
+        user: AppUser = client.user
+        try:
+            send_telegram_message_with_inline_keyboard(user.telegram_id, message, inline_keyboard)
+            notification_count += 1
+            logger.info(f"Уведомление о пробном занятии отправлено пользователю {user.telegram_id} (client_id={client.id})")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления о пробном занятии пользователю {user.telegram_id}: {e}")
 
-    return False
+    logger.info(f"Завершена проверка пробных занятий. Отправлено уведомлений: {notification_count}")
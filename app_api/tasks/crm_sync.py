@@ -1,57 +1,589 @@
+import hashlib
+import json
+import heapq
 import logging
+import math
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
 
-from app_api.alfa_crm_service.crm_service import find_client_by_id
-from app_api.utils.util_parse_date import parse_date
-from app_api.utils.user_status_utils import update_bot_user_status
+from django.db import connection, transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, IntegerField, Q
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from app_api.alfa_crm_service.crm_async_service import CRM_BULK_CHUNK_SIZE
+from app_api.alfa_crm_service.crm_circuit_breaker import CRMUnavailableError, crm_available
+from app_api.alfa_crm_service.crm_phone_index import index_customers
+from app_api.alfa_crm_service.crm_records import CustomerRecord
+from app_api.alfa_crm_service.crm_service import find_clients_by_ids, get_all_clients_in_branches, send_request_to_crm
+from app_api.alfa_crm_service.crm_transport import crm_url
+from app_api.models import CRMSyncRun
+from app_api.utils.user_status_utils import recompute_bot_user_statuses
 from app_kiberclub.models import Client
-from celery import shared_task
+from celery import chord, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 
 logger = logging.getLogger(__name__)
 
+CRM_SYNC_CHUNK_SIZE = int(os.getenv("CRM_SYNC_CHUNK_SIZE", 200))  # Сколько клиентов сохраняется одной транзакцией
+CRM_SYNC_MODE = os.getenv("CRM_SYNC_MODE")  # sharded, bulk или per_client; по умолчанию bulk на SQLite, иначе sharded
+CRM_SYNC_SHARD_SIZE = int(os.getenv("CRM_SYNC_SHARD_SIZE", 500))  # Сколько клиентов в одном шарде синхронизации
+CRM_SYNC_SHARD_RETRIES = int(os.getenv("CRM_SYNC_SHARD_RETRIES", 3))  # Повторы шарда при ошибке
+CRM_SYNC_SHARD_RETRY_DELAY = int(os.getenv("CRM_SYNC_SHARD_RETRY_DELAY", 60))  # Задержка первого повтора, секунд
+CRM_SYNC_STALE_AFTER = int(os.getenv("CRM_SYNC_STALE_AFTER", 35 * 60))  # Через сколько секунд без контрольной точки запуск считается оборванным
+CRM_SYNC_SOFT_TIME_LIMIT = int(os.getenv("CRM_SYNC_SOFT_TIME_LIMIT", 28 * 60))  # Мягкий лимит задачи синхронизации, секунд
+CRM_SYNC_BUDGET = int(os.getenv("CRM_SYNC_BUDGET", 20))  # Запросов к CRM на один цикл sync_priority_clients
+CRM_SYNC_HOT_INTERVAL = int(os.getenv("CRM_SYNC_HOT_INTERVAL", 60 * 60))  # Как часто синхронизировать горячих клиентов, секунд
+CRM_SYNC_WARM_INTERVAL = int(os.getenv("CRM_SYNC_WARM_INTERVAL", 12 * 60 * 60))  # Остальных занимающихся клиентов
+CRM_SYNC_COLD_INTERVAL = int(os.getenv("CRM_SYNC_COLD_INTERVAL", 7 * 24 * 60 * 60))  # Лидов без активности
+CRM_SYNC_HOT_SEEN_DAYS = int(os.getenv("CRM_SYNC_HOT_SEEN_DAYS", 7))  # Активность в боте или веб-приложении за столько дней делает клиента горячим
 
-@shared_task
-def sync_all_users_with_crm():
+# Поля клиента, которые берутся из CRM
+SYNC_FIELDS = ["name", "is_study", "dob", "balance", "next_lesson_date", "paid_till", "note", "paid_lesson_count"]
+
+
+def tracked_clients():
     """
-    Синхронизирует всех клиентов из CRM и обновляет их данные в БД.
+    Клиенты БД с числовыми id филиала и клиента в CRM.
+    ---
+    branch_int и crm_id_int задают порядок синхронизации и курсор
+    контрольной точки. Клиенты с нечисловым crm_id в CRM не найти,
+    поэтому они не синхронизируются.
     """
-    clients = Client.objects.select_related("user", "branch").exclude(crm_id__isnull=True).exclude(crm_id="")
+    return (
+        Client.objects.filter(crm_id__regex=r"^\d+$", branch__branch_id__regex=r"^\d+$")
+        .annotate(branch_int=Cast("branch__branch_id", IntegerField()), crm_id_int=Cast("crm_id", IntegerField()))
+    )
 
-    for client in clients:
-        logger.info(f"Синхронизация клиента {client.crm_id} (Пользователь: {client.user.id})")
-        try:
-            crm_response = find_client_by_id(branch_id=client.branch.branch_id, crm_id=client.crm_id)
-            logger.info(crm_response)
 
-            if not crm_response:
+def load_tracked_customers(clients=None) -> dict[tuple[int, int], CustomerRecord]:
+    """
+    Выгружает customer/index филиалов клиентов clients (по умолчанию всех
+    клиентов БД) один раз (is_study=2) и возвращает их записи по ключу
+    (филиал, id в CRM).
+    ---
+    Все выгруженные записи по пути попадают в индекс телефонов, в памяти
+    остаются только записи отслеживаемых клиентов. Если выгрузка прервалась,
+    возвращается то, что успели получить: недостающих клиентов
+    синхронизация запросит по одному.
+    """
+    clients = tracked_clients() if clients is None else clients
+    tracked = set(clients.values_list("branch_int", "crm_id_int"))
+    branch_ids = sorted({branch_id for branch_id, _ in tracked})
+    customers = {}
+
+    def collect(items):
+        for item in items:
+            if item.get("id") is None:
+                continue
+            customer = CustomerRecord.from_crm(item)
+            for branch_id in customer.branch_ids:
+                if (branch_id, customer.id) in tracked:
+                    customers[(branch_id, customer.id)] = customer
+            yield customer
+
+    try:
+        index_customers(collect(get_all_clients_in_branches(branch_ids, is_study=2, fields=CustomerRecord.FIELDS)))
+    except Exception as e:
+        logger.exception(f"Выгрузка клиентов из CRM прервана: {e}")
+    logger.info(f"Выгружено из CRM {len(customers)} из {len(tracked)} клиентов БД")
+    return customers
+
+
+def fetch_customer(branch_id, crm_id) -> CustomerRecord | None:
+    """
+    Запись клиента из CRM; None - клиента в CRM нет.
+    ---
+    Если CRM не ответила, выбрасывается CRMUnavailableError: клиент
+    считается ошибкой синхронизации, а не удаляется.
+    """
+    response = send_request_to_crm(crm_url(f"{branch_id}/customer/index"), {"id": crm_id, "is_study": 2, "page": 0}, None)
+    if response is None:
+        raise CRMUnavailableError(f"CRM не ответила на запрос клиента {crm_id}")
+    items = response.get("items") or []
+    return CustomerRecord.from_crm(items[0]) if items else None
+
+
+def plan_sync_shards(shard_size: int = CRM_SYNC_SHARD_SIZE) -> list[dict]:
+    """
+    Делит клиентов БД на шарды: филиал и диапазон id в CRM,
+    не больше shard_size клиентов в шарде.
+    """
+    ids_by_branch = defaultdict(list)
+    for branch_id, crm_id in tracked_clients().values_list("branch_int", "crm_id_int"):
+        ids_by_branch[branch_id].append(crm_id)
+
+    shards = []
+    for branch_id, crm_ids in sorted(ids_by_branch.items()):
+        crm_ids = sorted(set(crm_ids))
+        for start in range(0, len(crm_ids), shard_size):
+            part = crm_ids[start:start + shard_size]
+            shards.append({"index": len(shards), "branch_id": branch_id, "crm_id_from": part[0], "crm_id_to": part[-1]})
+    return shards
+
+
+def shard_clients(shard: dict):
+    """
+    Клиенты БД одного шарда.
+    """
+    return tracked_clients().filter(
+        branch_int=shard["branch_id"], crm_id_int__range=(shard["crm_id_from"], shard["crm_id_to"])
+    )
+
+
+def load_branch_customers(branch_id: int, crm_ids) -> dict[tuple[int, int], CustomerRecord]:
+    """
+    Записи CRM клиентов филиала: id запрашиваются пачками (customer/index?id=[...]).
+    Полученные записи попадают в индекс телефонов.
+    """
+    customers = {
+        (branch_id, crm_id): CustomerRecord.from_crm(item)
+        for crm_id, item in find_clients_by_ids(branch_id, list(crm_ids)).items()
+    }
+    index_customers(customers.values(), branch_id)
+    return customers
+
+
+def load_shard_customers(shard: dict) -> dict[tuple[int, int], CustomerRecord]:
+    """
+    Записи CRM клиентов шарда (см. load_branch_customers).
+    """
+    return load_branch_customers(shard["branch_id"], shard_clients(shard).values_list("crm_id_int", flat=True))
+
+
+def reconcile_clients(clients, customers: dict[tuple[int, int], CustomerRecord], run: CRMSyncRun | None = None) -> dict:
+    """
+    Обновляет клиентов БД (см. tracked_clients) по записям CRM customers
+    (филиал, id в CRM) -> запись.
+    ---
+    Клиенты, которых нет в customers, запрашиваются по одному и удаляются,
+    если их нет и в CRM. Клиенты, чьи данные в CRM не изменились
+    с прошлой синхронизации (совпадает crm_hash) и совпадают со строкой БД,
+    не сохраняются, у них обновляется только last_synced_at. Изменения записываются пачками
+    по CRM_SYNC_CHUNK_SIZE через bulk_update, статус пользователя
+    пересчитывается, только если у его клиентов изменился is_study
+    или клиент удален.
+    Клиенты обходятся по (филиал, id в CRM); с run после каждой сохраненной
+    пачки курсор сдвигается на ее последнего клиента. Если CRM стала
+    недоступна (circuit breaker), обход останавливается перед первым
+    клиентом, которого нужно запросить, с CRMUnavailableError: следующий
+    запуск продолжит с курсора, не повторяя сохраненные пачки.
+    Возвращает счетчики changed/unchanged/missing/failed.
+    """
+    clients = (
+        clients.select_related("branch")
+        .order_by("branch_int", "crm_id_int")
+        .iterator(chunk_size=CRM_SYNC_CHUNK_SIZE)
+    )
+    counts = {"changed": 0, "unchanged": 0, "missing": 0, "failed": 0}
+    synced_customers = []
+
+    while chunk := list(islice(clients, CRM_SYNC_CHUNK_SIZE)):
+        chunk_counts = {"changed": 0, "unchanged": 0, "missing": 0, "failed": 0}
+        changed, unchanged, missing, user_ids = [], [], [], set()
+        processed = 0
+
+        for client in chunk:
+            customer = customers.get((client.branch_int, client.crm_id_int))
+            if customer is None and not crm_available("customer"):
+                break
+            processed += 1
+            try:
+                if customer is None:
+                    customer = fetch_customer(client.branch_int, client.crm_id_int)
+                    if customer is not None:
+                        synced_customers.append(customer)
+            except Exception as e:
+                logger.exception(f"Ошибка при синхронизации клиента {client.crm_id}: {e}")
+                chunk_counts["failed"] += 1
+                continue
+
+            if customer is None:
                 logger.warning(f"Нет данных для клиента {client.crm_id} в CRM. Удаляю.")
-                client.delete()
+                missing.append(client.id)
+                if client.user_id:
+                    user_ids.add(client.user_id)
                 continue
 
-            update_client_from_crm(client, crm_response)
-            update_bot_user_status(client.user)
+            was_study = client.is_study
+            if not update_client_from_crm(client, customer):
+                unchanged.append(client.id)
+                continue
 
+            changed.append(client)
+            if client.user_id and client.is_study != was_study:
+                user_ids.add(client.user_id)
+
+        try:
+            with transaction.atomic():
+                Client.objects.bulk_update(changed, SYNC_FIELDS + ["crm_hash"])
+                Client.objects.filter(id__in=[client.id for client in changed] + unchanged).update(
+                    last_synced_at=timezone.now()
+                )
+                Client.objects.filter(id__in=missing).delete()
+                if user_ids:
+                    recompute_bot_user_statuses(user_ids)
+                chunk_counts["changed"] = len(changed)
+                chunk_counts["unchanged"] = len(unchanged)
+                chunk_counts["missing"] = len(missing)
         except Exception as e:
-            logger.exception(f"Ошибка при синхронизации клиента {client.crm_id}: {e}")
+            logger.exception(f"Не удалось сохранить пачку клиентов: {e}")
+            chunk_counts["failed"] += len(changed) + len(unchanged) + len(missing)
+
+        for key, value in chunk_counts.items():
+            counts[key] += value
+        if run is not None and processed:
+            save_checkpoint(run, chunk[processed - 1], chunk_counts)
+        if processed < len(chunk):
+            raise CRMUnavailableError(f"CRM недоступна, синхронизация остановлена перед клиентом {chunk[processed].crm_id}")
+
+    # Телефоны клиентов, запрошенных по одному, попадают в индекс для поиска по номеру
+    try:
+        index_customers(synced_customers)
+    except Exception as e:
+        logger.exception(f"Не удалось обновить индекс телефонов: {e}")
+    return counts
+
+
+def save_checkpoint(run: CRMSyncRun, last_client: Client, counts: dict):
+    """
+    Сдвигает курсор запуска на последнего клиента пачки и добавляет ее счетчики.
+    """
+    run.cursor_branch_id = last_client.branch_int
+    run.cursor_crm_id = last_client.crm_id_int
+    run.cursor_page += 1
+    for key, value in counts.items():
+        setattr(run, key, getattr(run, key) + value)
+    run.save(update_fields=["cursor_branch_id", "cursor_crm_id", "cursor_page", *counts, "updated_at"])
+
+
+def after_cursor(clients, run: CRMSyncRun):
+    """
+    Клиенты, которые идут после курсора запуска (еще не синхронизированы).
+    """
+    if run.cursor_crm_id is None:
+        return clients
+    return clients.filter(
+        Q(branch_int__gt=run.cursor_branch_id) | Q(branch_int=run.cursor_branch_id, crm_id_int__gt=run.cursor_crm_id)
+    )
+
+
+def start_sync_run(mode: str) -> CRMSyncRun | None:
+    """
+    Продолжает незавершенный запуск синхронизации режима mode или начинает новый.
+    ---
+    Запуск, который выполняется и обновлял контрольную точку не раньше
+    CRM_SYNC_STALE_AFTER секунд назад, не трогается - возвращается None.
+    Запуск без свежей контрольной точки считается оборванным (воркер
+    остановлен) и продолжается, как прерванный.
+    """
+    run = CRMSyncRun.objects.filter(mode=mode).exclude(status=CRMSyncRun.STATUS_COMPLETED).first()
+    if run is None:
+        return CRMSyncRun.objects.create(mode=mode)
 
+    stale_before = timezone.now() - timedelta(seconds=CRM_SYNC_STALE_AFTER)
+    if run.status == CRMSyncRun.STATUS_RUNNING and run.updated_at > stale_before:
+        logger.warning(f"Синхронизация {run.pk} еще выполняется, новый запуск пропущен")
+        return None
 
-def update_client_from_crm(client: Client, crm_data: dict):
+    run.status = CRMSyncRun.STATUS_RUNNING
+    run.resumed_count += 1
+    run.error = None
+    run.save(update_fields=["status", "resumed_count", "error", "updated_at"])
+    logger.info(
+        f"Синхронизация {run.pk} продолжается с филиала {run.cursor_branch_id}, "
+        f"клиента {run.cursor_crm_id} (пачка {run.cursor_page})"
+    )
+    return run
+
+
+def finish_sync_run(run: CRMSyncRun, status: str, error: str | None = None):
+    run.status = status
+    run.error = error
+    if status == CRMSyncRun.STATUS_COMPLETED:
+        run.finished_at = timezone.now()
+    run.save(update_fields=["status", "error", "finished_at", "updated_at"])
+
+
+def record_shard_done(run_id: int, shard: dict, counts: dict):
+    """
+    Отмечает шард запуска завершенным и добавляет его счетчики.
+    """
+    with transaction.atomic():
+        run = CRMSyncRun.objects.select_for_update().get(pk=run_id)
+        if shard["index"] in run.done_shards:
+            return
+        run.done_shards.append(shard["index"])
+        for key, value in counts.items():
+            setattr(run, key, F(key) + value)
+        run.save(update_fields=["done_shards", *counts, "updated_at"])
+
+
+def _run_counts(run: CRMSyncRun) -> dict:
+    return {"run": run.pk, "changed": run.changed, "unchanged": run.unchanged, "missing": run.missing, "failed": run.failed}
+
+
+def _log_counts(title: str, counts: dict):
+    logger.info(
+        f"{title}: изменено {counts['changed']}, без изменений {counts['unchanged']}, "
+        f"удалено {counts['missing']}, ошибок {counts['failed']}"
+    )
+
+
+@shared_task(bind=True, max_retries=CRM_SYNC_SHARD_RETRIES)
+def sync_clients_shard(self, shard: dict, run_id: int | None = None) -> dict:
     """
-    Обновляет данные клиента на основе данных из CRM.
+    Синхронизирует клиентов одного шарда (см. plan_sync_shards).
+    ---
+    При ошибке шард повторяется с растущей задержкой; повтор дешевый,
+    так как уже сохраненные клиенты не изменятся (crm_hash). После
+    последней попытки шард возвращает ошибку, а не падает, чтобы
+    итог собрался по остальным шардам. Успешный шард отмечается
+    в запуске run_id и при продолжении запуска не повторяется.
     """
     try:
-        client.name = crm_data.get("name")
-        client.is_study = bool(crm_data.get("is_study"))
-        client.dob = parse_date(crm_data.get("dob"))
-        client.balance = crm_data.get("balance")
-        client.next_lesson_date = parse_date(crm_data.get("next_lesson_date"))
-        client.paid_till = parse_date(crm_data.get("paid_till"))
-        client.note = crm_data.get("note")
-        client.paid_lesson_count = crm_data.get("paid_lesson_count")
+        counts = reconcile_clients(shard_clients(shard), load_shard_customers(shard))
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=CRM_SYNC_SHARD_RETRY_DELAY * 2 ** self.request.retries)
+        logger.exception(f"Шард {shard} не синхронизирован: {e}")
+        return {"shard": shard, "error": str(e), "changed": 0, "unchanged": 0, "missing": 0, "failed": 0}
+    if run_id is not None:
+        record_shard_done(run_id, shard, counts)
+    _log_counts(f"Шард {shard} синхронизирован", counts)
+    return {"shard": shard, **counts}
 
-        client.save()
-        logger.info(f"Клиент {client.crm_id} успешно обновлен")
 
+@shared_task
+def sync_shards_done(results: list[dict], started_at: float, run_id: int | None = None) -> dict:
+    """
+    Сводит результаты шардов синхронизации клиентов и закрывает запуск run_id:
+    если есть шарды с ошибкой, запуск остается прерванным и следующий
+    запуск повторит только их.
+    """
+    totals = {key: sum(result.get(key, 0) for result in results) for key in ("changed", "unchanged", "missing", "failed")}
+    totals["failed_shards"] = [result["shard"] for result in results if result.get("error")]
+    _log_counts(f"Синхронизация клиентов завершена за {time.time() - started_at:.0f} с, шардов {len(results)}", totals)
+    if totals["failed_shards"]:
+        logger.error(f"Шарды с ошибкой: {totals['failed_shards']}")
 
+    if run_id is not None:
+        run = CRMSyncRun.objects.get(pk=run_id)
+        if totals["failed_shards"]:
+            finish_sync_run(run, CRMSyncRun.STATUS_INTERRUPTED, f"Шардов с ошибкой: {len(totals['failed_shards'])}")
+        else:
+            finish_sync_run(run, CRMSyncRun.STATUS_COMPLETED)
+    return totals
 
+
+def start_sharded_sync(run: CRMSyncRun) -> dict:
+    """
+    Запускает шарды запуска run, которые еще не завершены.
+    План шардов сохраняется в запуске при первом старте.
+    """
+    if not run.shards:
+        run.shards = plan_sync_shards()
+        run.save(update_fields=["shards", "updated_at"])
+    pending = [shard for shard in run.shards if shard["index"] not in run.done_shards]
+    if not pending:
+        finish_sync_run(run, CRMSyncRun.STATUS_COMPLETED)
+        return {"run": run.pk, "shards": 0}
+
+    chord([sync_clients_shard.s(shard, run.pk) for shard in pending])(sync_shards_done.s(time.time(), run.pk))
+    logger.info(f"Синхронизация клиентов {run.pk} запущена: {len(pending)} из {len(run.shards)} шардов")
+    return {"run": run.pk, "shards": len(pending)}
+
+
+def default_sync_mode() -> str:
+    """
+    Режим синхронизации по умолчанию: CRM_SYNC_MODE или bulk для SQLite
+    и sharded для остальных БД.
+    """
+    if CRM_SYNC_MODE:
+        return CRM_SYNC_MODE
+    return "bulk" if connection.vendor == "sqlite" else "sharded"
+
+
+@shared_task(soft_time_limit=CRM_SYNC_SOFT_TIME_LIMIT)
+def sync_all_users_with_crm(mode: str | None = None):
+    """
+    Синхронизирует всех клиентов из CRM и обновляет их данные в БД.
+    ---
+    Режимы (CRM_SYNC_MODE):
+    - sharded: клиенты делятся на шарды по филиалу и диапазону id, шарды
+      выполняются параллельно на воркерах (chord), итог сводит
+      sync_shards_done. Все воркеры делят общий лимит запросов к CRM
+      (rate_limiter, приоритет batch);
+    - bulk: в этой задаче, филиалы выгружаются из CRM целиком, примерно
+      total / размер страницы запросов вместо запроса на каждого клиента;
+    - per_client: в этой задаче, каждый клиент запрашивается по id.
+    Каждый запуск записывается в CRMSyncRun. Если прошлый запуск режима
+    прерван (лимит времени, остановка воркера, недоступность CRM),
+    синхронизация продолжается с его контрольной точки: с курсора
+    или с незавершенных шардов.
+    Без CRM_SYNC_MODE на SQLite выбирается bulk: SQLite допускает одного
+    писателя, и параллельные шарды падают с "database is locked".
+    """
+    mode = mode or default_sync_mode()
+    run = start_sync_run(mode)
+    if run is None:
+        return {"skipped": True}
+    if mode == "sharded":
+        return start_sharded_sync(run)
+
+    clients = after_cursor(tracked_clients(), run)
+    try:
+        customers = load_tracked_customers(clients) if mode == "bulk" else {}
+        reconcile_clients(clients, customers, run)
+    except (CRMUnavailableError, SoftTimeLimitExceeded) as e:
+        logger.warning(f"Синхронизация {run.pk} прервана на клиенте {run.cursor_crm_id}: {e!r}")
+        finish_sync_run(run, CRMSyncRun.STATUS_INTERRUPTED, repr(e))
+        return _run_counts(run)
     except Exception as e:
-        logger.exception(f"Не удалось обновить клиента {client.crm_id}: {e}")
+        finish_sync_run(run, CRMSyncRun.STATUS_INTERRUPTED, repr(e))
+        raise
+
+    finish_sync_run(run, CRMSyncRun.STATUS_COMPLETED)
+    counts = _run_counts(run)
+    _log_counts("Синхронизация клиентов завершена", counts)
+    return counts
+
+
+def sync_interval(hot: bool, is_study: bool) -> int:
+    """
+    Желаемый интервал синхронизации клиента, секунд: горячие клиенты
+    (активность родителя, урок на этой неделе, долг) - CRM_SYNC_HOT_INTERVAL,
+    остальные занимающиеся - CRM_SYNC_WARM_INTERVAL, лиды - CRM_SYNC_COLD_INTERVAL.
+    """
+    if hot:
+        return CRM_SYNC_HOT_INTERVAL
+    return CRM_SYNC_WARM_INTERVAL if is_study else CRM_SYNC_COLD_INTERVAL
+
+
+def plan_priority_sync(budget: int = CRM_SYNC_BUDGET) -> dict[int, list[int]]:
+    """
+    Выбирает клиентов для очередного цикла синхронизации: филиал -> id в CRM.
+    ---
+    Вес клиента - давность синхронизации × приоритет, то есть сколько
+    его интервалов (sync_interval) прошло с last_synced_at; клиенты,
+    которые ни разу не синхронизировались, идут первыми. Берутся только
+    просроченные клиенты (вес >= 1) по убыванию веса, пока хватает
+    бюджета: один запрос к CRM загружает до CRM_BULK_CHUNK_SIZE клиентов
+    одного филиала.
+    """
+    now = timezone.now()
+    hot = ExpressionWrapper(
+        Q(user__last_seen_at__gte=now - timedelta(days=CRM_SYNC_HOT_SEEN_DAYS))
+        | Q(next_lesson_date__range=(now, now + timedelta(days=7)))
+        | Q(balance__lt=0),
+        output_field=BooleanField(),
+    )
+    candidates = []
+    rows = tracked_clients().annotate(hot=hot).values_list("branch_int", "crm_id_int", "last_synced_at", "hot", "is_study")
+    for branch_id, crm_id, last_synced_at, is_hot, is_study in rows.iterator(chunk_size=2000):
+        if last_synced_at is None:
+            weight = math.inf
+        else:
+            weight = (now - last_synced_at).total_seconds() / sync_interval(is_hot, is_study)
+        if weight >= 1:
+            candidates.append((weight, branch_id, crm_id))
+
+    plan, requests_left = defaultdict(list), budget
+    for _, branch_id, crm_id in heapq.nlargest(budget * CRM_BULK_CHUNK_SIZE, candidates):
+        crm_ids = plan[branch_id]
+        if len(crm_ids) % CRM_BULK_CHUNK_SIZE == 0:
+            # Клиент открывает новую пачку филиала - еще один запрос к CRM
+            if requests_left == 0:
+                continue
+            requests_left -= 1
+        crm_ids.append(crm_id)
+    logger.info(f"Просрочена синхронизация {len(candidates)} клиентов, в цикл взято {sum(map(len, plan.values()))}")
+    return dict(plan)
+
+
+@shared_task(soft_time_limit=CRM_SYNC_SOFT_TIME_LIMIT)
+def sync_priority_clients(budget: int | None = None) -> dict:
+    """
+    Цикл синхронизации по свежести и приоритету (см. plan_priority_sync).
+    ---
+    Запускается часто и в пределах бюджета CRM_SYNC_BUDGET запросов
+    обновляет самых просроченных клиентов: горячих - примерно раз
+    в CRM_SYNC_HOT_INTERVAL, лидов - раз в CRM_SYNC_COLD_INTERVAL.
+    Полная синхронизация sync_all_users_with_crm остается страховкой
+    и может запускаться редко.
+    """
+    plan = plan_priority_sync(CRM_SYNC_BUDGET if budget is None else budget)
+    totals = {"changed": 0, "unchanged": 0, "missing": 0, "failed": 0}
+    for branch_id, crm_ids in plan.items():
+        if not crm_available("customer"):
+            logger.warning("CRM недоступна, цикл синхронизации остановлен")
+            break
+        clients = tracked_clients().filter(branch_int=branch_id, crm_id_int__in=crm_ids)
+        try:
+            counts = reconcile_clients(clients, load_branch_customers(branch_id, crm_ids))
+        except CRMUnavailableError as e:
+            logger.warning(f"Цикл синхронизации остановлен: {e}")
+            break
+        except Exception as e:
+            logger.exception(f"Филиал {branch_id} не синхронизирован: {e}")
+            totals["failed"] += len(crm_ids)
+            continue
+        for key, value in counts.items():
+            totals[key] += value
+    _log_counts("Цикл синхронизации клиентов завершен", totals)
+    return totals
+
+
+def sync_values(source: Client | CustomerRecord) -> dict:
+    """
+    Значения SYNC_FIELDS клиента БД или записи CRM в сравнимом виде:
+    баланс - Decimal с копейками, дата занятия - без часового пояса,
+    is_study - bool.
+    """
+    values = {field: getattr(source, field) for field in SYNC_FIELDS}
+    values["is_study"] = bool(values["is_study"])
+    if values["balance"] is not None:
+        values["balance"] = Decimal(str(values["balance"])).quantize(Decimal("0.01"))
+    next_lesson_date = values["next_lesson_date"]
+    if next_lesson_date is not None and timezone.is_aware(next_lesson_date):
+        values["next_lesson_date"] = timezone.make_naive(next_lesson_date)
+    return values
+
+
+def customer_hash(customer: CustomerRecord) -> str:
+    """
+    Хэш полей клиента, которые синхронизируются из CRM.
+    """
+    payload = json.dumps(list(sync_values(customer).values()), default=str, ensure_ascii=False)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def update_client_from_crm(client: Client, customer: CustomerRecord) -> bool:
+    """
+    Переносит данные из CRM в клиента (без сохранения).
+    Возвращает False, если данные в CRM не изменились с прошлой
+    синхронизации и строка БД им соответствует.
+    ---
+    Совпадение crm_hash доказывает только, что не изменилась CRM:
+    поля могли изменить в админке или через create_or_update_clients_in_db,
+    поэтому текущие значения строки тоже сравниваются с записью CRM.
+    """
+    values = sync_values(customer)
+    crm_hash = customer_hash(customer)
+    if client.crm_hash == crm_hash and sync_values(client) == values:
+        return False
+
+    client.name = customer.name
+    client.is_study = bool(customer.is_study)
+    client.dob = customer.dob
+    client.balance = customer.balance
+    client.next_lesson_date = customer.next_lesson_date
+    client.paid_till = customer.paid_till
+    client.note = customer.note
+    client.paid_lesson_count = customer.paid_lesson_count
+    client.crm_hash = crm_hash
+    return True
@@ -1,3 +1,806 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import redis
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from app_api.alfa_crm_service import crm_service
+from app_api.alfa_crm_service.crm_circuit_breaker import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreaker,
+    CRMUnavailableError,
+)
+from app_api.alfa_crm_service.crm_coalescing import RequestCoalescer
+from app_api.alfa_crm_service.crm_lesson_mirror import (
+    LESSON_MIRROR_HISTORY_START,
+    LESSON_TAUGHT,
+    mark_branch_mirrored,
+    mirror_branch_lessons,
+)
+from app_api.alfa_crm_service.crm_phone_index import get_phone_targets, index_customers
+from app_api.alfa_crm_service.crm_rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, CRMRateLimiter, CRMRateLimitTimeout
+from app_api.alfa_crm_service.crm_records import CustomerRecord, LessonRecord, TariffRecord, active_on, to_records
+from app_api.alfa_crm_service.crm_redis import get_redis_client
+from app_api.alfa_crm_service.crm_reference_cache import CRMReferenceCache
+from app_api.alfa_crm_service.crm_response_cache import CRMResponseCache, invalidate_customer_responses
+from app_api.alfa_crm_service.crm_stream import ItemsStreamDecoder
+from app_api.alfa_crm_service.crm_token import CRMTokenManager
+from app_api.models import CRMSyncRun, CustomerPhone, Lesson
+from app_api.tasks.check_clients_balance_and_notify import check_clients_balance_and_notify, check_clients_lessons_before
+from app_api.tasks.crm_sync import (
+    after_cursor,
+    load_tracked_customers,
+    plan_priority_sync,
+    reconcile_clients,
+    sync_all_users_with_crm,
+    tracked_clients,
+)
+from app_api.utils.user_status_utils import recompute_bot_user_statuses, update_bot_user_status
+from app_api.utils.util_phone import normalize_phone
+from app_kiberclub.models import AppUser, Branch, Client, Location
+
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def customer(crm_id: int, **fields) -> CustomerRecord:
+    item = {"id": crm_id, "name": f"Клиент {crm_id}", "is_study": 1, "balance": "100.5", "paid_lesson_count": 4,
+            "next_lesson_date": "2030-01-01 15:00:00", "dob": "2015-05-01", "note": ""}
+    item.update(fields)
+    return CustomerRecord.from_crm(item)
+
+
+def redis_available() -> bool:
+    try:
+        return get_redis_client().ping()
+    except redis.RedisError:
+        return False
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CRMSyncTests(TestCase):
+    def setUp(self):
+        self.branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        self.user = AppUser.objects.create(telegram_id="100")
+        for crm_id in range(1, 6):
+            Client.objects.create(user=self.user, branch=self.branch, crm_id=str(crm_id))
+        self.customers = {(1, crm_id): customer(crm_id) for crm_id in range(1, 6)}
+
+    def test_unchanged_clients_are_not_saved(self):
+        counts = reconcile_clients(tracked_clients(), self.customers)
+        self.assertEqual(counts["changed"], 5)
+        client = Client.objects.get(crm_id="1")
+        self.assertEqual(client.balance, Decimal("100.50"))
+        self.assertTrue(client.crm_hash)
+
+        with mock.patch.object(Client.objects, "bulk_update", wraps=Client.objects.bulk_update) as bulk_update:
+            counts = reconcile_clients(tracked_clients(), self.customers)
+        self.assertEqual((counts["changed"], counts["unchanged"]), (0, 5))
+        bulk_update.assert_called_once()
+        self.assertEqual(bulk_update.call_args.args[0], [])
+        self.assertEqual(Client.objects.filter(last_synced_at__isnull=False).count(), 5)
+
+    def test_changed_clients_are_saved_with_bulk_update(self):
+        reconcile_clients(tracked_clients(), self.customers)
+        self.customers[(1, 2)] = customer(2, balance="-10")
+
+        with mock.patch.object(Client.objects, "bulk_update", wraps=Client.objects.bulk_update) as bulk_update:
+            counts = reconcile_clients(tracked_clients(), self.customers)
+        self.assertEqual((counts["changed"], counts["unchanged"]), (1, 4))
+        self.assertEqual([client.crm_id for client in bulk_update.call_args.args[0]], ["2"])
+        self.assertEqual(Client.objects.get(crm_id="2").balance, Decimal("-10.00"))
+
+    def test_local_changes_are_overwritten_despite_unchanged_hash(self):
+        reconcile_clients(tracked_clients(), self.customers)
+        Client.objects.filter(crm_id="3").update(name="Изменено в админке", paid_lesson_count=0)
+
+        counts = reconcile_clients(tracked_clients(), self.customers)
+        self.assertEqual(counts["changed"], 1)
+        client = Client.objects.get(crm_id="3")
+        self.assertEqual((client.name, client.paid_lesson_count), ("Клиент 3", 4))
+
+    def test_interrupted_run_resumes_after_cursor(self):
+        run = CRMSyncRun.objects.create(mode="bulk")
+        del self.customers[(1, 4)]
+        with (
+            mock.patch("app_api.tasks.crm_sync.CRM_SYNC_CHUNK_SIZE", 2),
+            mock.patch("app_api.tasks.crm_sync.crm_available", return_value=False),
+            self.assertRaises(CRMUnavailableError),
+        ):
+            reconcile_clients(tracked_clients(), self.customers, run)
+
+        run.refresh_from_db()
+        self.assertEqual((run.cursor_branch_id, run.cursor_crm_id, run.cursor_page), (1, 3, 2))
+        self.assertEqual(run.changed, 3)
+        remaining = after_cursor(tracked_clients(), run).order_by("crm_id_int")
+        self.assertEqual([client.crm_id for client in remaining], ["4", "5"])
+
+    def test_priority_plan_fits_budget(self):
+        other = Branch.objects.create(branch_id="2", name="Филиал 2")
+        for crm_id in range(1, 4):
+            Client.objects.create(branch=other, crm_id=str(crm_id))
+        Client.objects.filter(branch=self.branch, crm_id="5").update(last_synced_at=timezone.now())
+
+        with mock.patch("app_api.tasks.crm_sync.CRM_BULK_CHUNK_SIZE", 2):
+            plan = plan_priority_sync(budget=2)
+        # Один запрос к CRM на каждую пачку из двух клиентов филиала
+        self.assertEqual(sum(-(-len(crm_ids) // 2) for crm_ids in plan.values()), 2)
+        self.assertNotIn(5, plan.get(1, []))
+
+    def test_priority_plan_skips_recently_synced(self):
+        Client.objects.update(last_synced_at=timezone.now())
+        self.assertEqual(plan_priority_sync(budget=10), {})
+
+
+@mock.patch("app_api.alfa_crm_service.crm_token.get_redis_client", side_effect=redis.ConnectionError)
+class CRMTokenManagerTests(SimpleTestCase):
+    def test_token_is_cached_in_process(self, _):
+        login = mock.Mock(return_value="token-1")
+        manager = CRMTokenManager(login_func=login)
+        self.assertEqual([manager.get_token() for _ in range(3)], ["token-1"] * 3)
+        login.assert_called_once()
+
+    def test_concurrent_misses_log_in_once(self, _):
+        def slow_login():
+            time.sleep(0.05)
+            return "token-1"
+
+        login = mock.Mock(side_effect=slow_login)
+        manager = CRMTokenManager(login_func=login)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ["token-1"] * 8)
+        login.assert_called_once()
+
+    def test_invalidate_forgets_only_rejected_token(self, _):
+        manager = CRMTokenManager(login_func=mock.Mock(side_effect=["token-1", "token-2"]))
+        manager.get_token()
+        manager.invalidate("stale")
+        self.assertEqual(manager.get_token(), "token-1")
+        manager.invalidate("token-1")
+        self.assertEqual(manager.get_token(), "token-2")
+
+    def test_rejected_token_is_renewed_and_request_retried(self, _):
+        manager = CRMTokenManager(login_func=mock.Mock(side_effect=["token-1", "token-2"]))
+        responses = iter([
+            mock.Mock(status_code=401),
+            mock.Mock(status_code=200, json=mock.Mock(return_value={"total": 0})),
+        ])
+        sent_tokens = []
+
+        def post(url, headers, **kwargs):
+            sent_tokens.append(headers["X-ALFACRM-TOKEN"])
+            return next(responses)
+
+        with (
+            mock.patch.object(crm_service, "token_manager", manager),
+            mock.patch.object(crm_service, "get_crm_transport", return_value=mock.Mock(post=post)),
+        ):
+            self.assertEqual(crm_service._send_request_to_crm("http://crm/1/customer/index", {}, None), {"total": 0})
+        self.assertEqual(sent_tokens, ["token-1", "token-2"])
+
+
+class CRMRateLimiterTests(SimpleTestCase):
+    def test_waits_until_allowed(self):
+        limiter = CRMRateLimiter(max_wait=1, enabled=True)
+        with mock.patch.object(limiter, "try_acquire", side_effect=[(False, 0.01), (True, 0.0)]) as try_acquire:
+            limiter.acquire("crm", PRIORITY_INTERACTIVE)
+        self.assertEqual(try_acquire.call_count, 2)
+
+    def test_times_out_instead_of_bypassing(self):
+        limiter = CRMRateLimiter(max_wait=0.5, enabled=True)
+        with mock.patch.object(limiter, "try_acquire", return_value=(False, 1.0)):
+            with self.assertRaises(CRMRateLimitTimeout):
+                limiter.acquire("crm", PRIORITY_BATCH)
+            with self.assertRaises(CRMRateLimitTimeout):
+                asyncio.run(limiter.acquire_async("crm", PRIORITY_BATCH))
+
+    def test_disabled_limiter_does_not_call_redis(self):
+        limiter = CRMRateLimiter(enabled=False)
+        with mock.patch.object(limiter, "try_acquire") as try_acquire:
+            self.assertEqual(limiter.acquire("crm"), 0.0)
+        try_acquire.assert_not_called()
+
+    @skipUnless(redis_available(), "Redis недоступен")
+    def test_token_bucket_keeps_interactive_reserve(self):
+        host = f"test-{timezone.now().timestamp()}"
+        limiter = CRMRateLimiter(rate=0.001, burst=4, batch_share=1, interactive_reserve=0.5, enabled=True)
+        try:
+            batch = [limiter.try_acquire(host, PRIORITY_BATCH)[0] for _ in range(3)]
+            interactive = [limiter.try_acquire(host, PRIORITY_INTERACTIVE)[0] for _ in range(3)]
+        finally:
+            get_redis_client().delete(f"crm_rate:{host}", f"crm_rate:{host}:{PRIORITY_BATCH}", f"crm_rate:{host}:{PRIORITY_INTERACTIVE}")
+        self.assertEqual(batch, [True, True, False])
+        self.assertEqual(interactive, [True, True, False])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def make_breaker(self) -> CircuitBreaker:
+        return CircuitBreaker("test", window=60, min_calls=4, failure_rate=0.5, slow_call=5, open_seconds=60)
+
+    def test_opens_on_failure_rate(self):
+        breaker = self.make_breaker()
+        for failed in (False, True, False):
+            breaker.record(0.1, failed)
+        self.assertEqual(breaker.state, STATE_CLOSED)
+        breaker.record(0.1, True)
+        self.assertEqual(breaker.state, STATE_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_slow_calls_open_breaker(self):
+        breaker = self.make_breaker()
+        for _ in range(4):
+            breaker.record(10, False)
+        self.assertEqual(breaker.state, STATE_OPEN)
+
+    def test_half_open_probe_closes_or_reopens(self):
+        clock = [0.0]
+        breaker = self.make_breaker()
+        with mock.patch("app_api.alfa_crm_service.crm_circuit_breaker.time.monotonic", side_effect=lambda: clock[0]):
+            for _ in range(4):
+                breaker.record(0.1, True)
+            self.assertFalse(breaker.allow())
+
+            clock[0] = 61
+            self.assertEqual(breaker.state, STATE_HALF_OPEN)
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.cancel()
+            self.assertTrue(breaker.allow())
+            breaker.record(0.1, True)
+            self.assertEqual(breaker.state, STATE_OPEN)
+
+            clock[0] = 122
+            self.assertTrue(breaker.allow())
+            breaker.record(0.1, False)
+            self.assertEqual(breaker.state, STATE_CLOSED)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CRMReferenceCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.loader = mock.Mock(return_value={1: {"id": 1, "price": 100}})
+
+    def test_loads_once_and_shares_between_processes(self):
+        first = CRMReferenceCache("test", self.loader, ttl=60)
+        self.assertEqual(first.lookup(1, "1"), {"id": 1, "price": 100})
+        first.lookup(1, 1)
+        # Другой процесс берет справочник из общего кэша, а не из CRM
+        self.assertEqual(CRMReferenceCache("test", self.loader, ttl=60).lookup(1, 1)["price"], 100)
+        self.loader.assert_called_once_with(1)
+
+    def test_concurrent_misses_load_once(self):
+        def slow_loader(branch_id):
+            time.sleep(0.05)
+            return {1: {"id": 1}}
+
+        loader = mock.Mock(side_effect=slow_loader)
+        reference = CRMReferenceCache("test", loader, ttl=60)
+        threads = [threading.Thread(target=reference.get, args=(1,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loader.assert_called_once()
+
+    def test_missing_id_reloads_once_per_interval(self):
+        reference = CRMReferenceCache("test", self.loader, ttl=60)
+        self.assertIsNone(reference.lookup(1, 2))
+        self.assertIsNone(reference.lookup(1, 2))
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_invalidate_forces_reload(self):
+        reference = CRMReferenceCache("test", self.loader, ttl=60)
+        reference.get(1)
+        reference.invalidate([1])
+        reference.get(1)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_tariff_price_comes_from_catalog(self):
+        self.addCleanup(crm_service.invalidate_tariff_catalog, 1)
+        with mock.patch.object(crm_service.tariff_catalog, "loader", self.loader):
+            crm_service.invalidate_tariff_catalog(1)
+            self.assertEqual(crm_service.get_tariff_price(1, "1"), 100)
+            self.assertEqual(crm_service.get_tariff_price(1, 1), 100)
+        self.loader.assert_called_once_with(1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CRMMetadataTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        crm_service.invalidate_crm_metadata(1)
+        self.addCleanup(crm_service.invalidate_crm_metadata, 1)
+
+    def test_subjects_and_groups_are_loaded_once_per_branch(self):
+        pages = {
+            "subject/index": [{"id": 5, "name": "Робототехника"}, {"id": 6, "name": "Python"}],
+            "group/index": [{"id": 9, "note": "https://t.me/group9"}],
+        }
+
+        def fetch_all_items(url, data=None, fields=None):
+            return next(items for endpoint, items in pages.items() if url.endswith(endpoint))
+
+        with mock.patch.object(crm_service, "fetch_all_items", side_effect=fetch_all_items) as fetch:
+            self.assertEqual(crm_service.get_subject_name(1, "5"), "Робототехника")
+            self.assertEqual(crm_service.get_subject_name(1, 6), "Python")
+            self.assertEqual(crm_service.get_group_note(1, 9), "https://t.me/group9")
+            self.assertIsNone(crm_service.get_group_note(1, None))
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_failed_load_is_not_cached(self):
+        with mock.patch.object(crm_service, "fetch_all_items", side_effect=[None, [{"id": 5, "name": "Python"}]]) as fetch:
+            self.assertEqual(crm_service.subject_names.get(1), {})
+            self.assertEqual(crm_service.get_subject_name(1, 5), "Python")
+        self.assertEqual(fetch.call_count, 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FindClientsByIdTests(TestCase):
+    def setUp(self):
+        self.requested = []
+
+        async def fetch_customers(session, branch_id, crm_ids):
+            self.requested.append((branch_id, sorted(crm_ids)))
+            return {crm_id: {"id": crm_id, "balance": crm_id * 10} for crm_id in crm_ids if crm_id != 404}
+
+        patcher = mock.patch("app_api.alfa_crm_service.crm_async_service.fetch_customers_by_ids_async", fetch_customers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_request_per_branch_in_input_order(self):
+        found = crm_service.find_clients_by_id([("1", "3"), ("2", "5"), ("1", 404), ("1", "3")])
+        self.assertEqual(found, [{"id": 3, "balance": 30}, {"id": 5, "balance": 50}, None, {"id": 3, "balance": 30}])
+        self.assertEqual(sorted(self.requested), [("1", [3, 404]), ("2", [5])])
+
+    def test_invalid_ids_are_skipped(self):
+        found = crm_service.find_clients_by_id([("1", None), ("1", ""), ("1", "abc"), (None, "7"), ("1", "7")])
+        self.assertEqual(found, [None, None, None, None, {"id": 7, "balance": 70}])
+        self.assertEqual(self.requested, [("1", [7])])
+
+    def test_balances_view_survives_client_without_crm_id(self):
+        branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        user = AppUser.objects.create(telegram_id="100")
+        Client.objects.create(user=user, branch=branch, crm_id="7", name="Есть в CRM")
+        Client.objects.create(user=user, branch=branch, crm_id=None, name="Без ID")
+
+        response = self.client.post(reverse("app_crm_api:get_user_balances"), {"telegram_id": "100"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        balances = {item["client_name"]: item["balance"] for item in response.json()["data"]}
+        self.assertEqual(balances, {"Есть в CRM": 70, "Без ID": 0})
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PhoneIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.searched = []
+
+        async def find_by_phone(phone_number, targets):
+            self.searched.append(sorted(targets))
+            known = normalize_phone(phone_number) in ("+375291234567", "+375445556677")
+            items = [{"id": 7, "phone": [phone_number], "branch_ids": [branch], "is_study": status}
+                     for branch, status in targets if known and (branch, status) == (3, 1)]
+            return {"failed_requests": 0, "total": len(items), "count": len(items), "items": items}
+
+        patcher = mock.patch.object(crm_service, "find_user_by_phone_async", find_by_phone)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_normalize_phone_to_e164(self):
+        for raw in ("+375 (29) 123-45-67", "375291234567", "8 029 123 45 67", "291234567"):
+            self.assertEqual(normalize_phone(raw), "+375291234567", raw)
+        self.assertEqual(normalize_phone("+7 (912) 345-67-89"), "+79123456789")
+        for raw in (None, "", "12345", "1234567890123456"):
+            self.assertIsNone(normalize_phone(raw), raw)
+
+    def test_index_replaces_customer_phones(self):
+        index_customers([{"id": 7, "phone": ["+375 29 123-45-67", "мусор"], "branch_ids": [1, 2], "is_study": 1}])
+        self.assertEqual(get_phone_targets("+375291234567"), [(1, 1), (2, 1)])
+
+        index_customers([{"id": 7, "phone": ["80291112233"], "branch_ids": [2], "is_study": 0}])
+        self.assertEqual(get_phone_targets("+375291234567"), [])
+        self.assertEqual(list(CustomerPhone.objects.values_list("phone", "crm_branch_id", "crm_id")),
+                         [("+375291112233", 2, "7")])
+
+    def test_indexed_phone_queries_only_its_branch(self):
+        index_customers([{"id": 7, "phone": ["291234567"], "branch_ids": [3], "is_study": 1}])
+
+        result = crm_service.find_user_by_phone("+375 29 123 45 67")
+        self.assertEqual(result["total"], 1)
+        self.assertEqual(self.searched, [[(3, 1)]])
+
+    def test_missing_phone_is_remembered(self):
+        self.assertEqual(crm_service.find_user_by_phone("+375 29 000 00 00")["total"], 0)
+        searched = len(self.searched)
+        self.assertEqual(crm_service.find_user_by_phone("80290000000")["total"], 0)
+        self.assertEqual(len(self.searched), searched)
+
+    def test_unindexed_phone_found_by_full_search_is_indexed(self):
+        result = crm_service.find_user_by_phone("+375 44 555 66 77")
+        self.assertEqual(result["total"], 1)
+        self.assertEqual(get_phone_targets("+375445556677"), [(3, 1)])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CRMResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        patcher = mock.patch("app_api.alfa_crm_service.crm_response_cache.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.response_cache = CRMResponseCache("test", "test", ttl=60, stale_ttl=600)
+        self.calls = 0
+
+    def fetch(self):
+        self.calls += 1
+        return {"version": self.calls}
+
+    def test_fresh_response_served_from_cache(self):
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {"page": 0}, self.fetch), {"version": 1})
+        self.now += 30
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {"page": 0}, self.fetch), {"version": 1})
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {"page": 1}, self.fetch), {"version": 2})
+
+    def test_stale_response_served_while_refreshing(self):
+        self.response_cache.get_or_fetch(1, 7, {}, self.fetch)
+        self.now += 120
+        refreshed = threading.Event()
+
+        def slow_fetch():
+            value = self.fetch()
+            refreshed.set()
+            return value
+
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {}, slow_fetch), {"version": 1})
+        self.assertTrue(refreshed.wait(5))
+        # Ответ сохраняется после возврата из fetch
+        for _ in range(50):
+            if self.response_cache.get_or_fetch(1, 7, {}, self.fetch) == {"version": 2}:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {}, self.fetch), {"version": 2})
+        self.assertEqual(self.calls, 2)
+
+    def test_expired_response_fetched_synchronously(self):
+        self.response_cache.get_or_fetch(1, 7, {}, self.fetch)
+        self.now += 60 + 600 + 1
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {}, self.fetch), {"version": 2})
+
+    def test_invalidate_customer_responses(self):
+        self.response_cache.get_or_fetch(1, 7, {}, self.fetch)
+        self.response_cache.get_or_fetch(1, 8, {}, self.fetch)
+        invalidate_customer_responses(1, 7)
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {}, self.fetch), {"version": 3})
+        self.assertEqual(self.response_cache.get_or_fetch(1, 8, {}, self.fetch), {"version": 2})
+
+    def test_none_is_not_cached(self):
+        self.assertIsNone(self.response_cache.get_or_fetch(1, 7, {}, lambda: None))
+        self.assertEqual(self.response_cache.get_or_fetch(1, 7, {}, self.fetch), {"version": 1})
+
+
+class RequestCoalescerTests(SimpleTestCase):
+    def test_concurrent_threads_share_one_fetch(self):
+        coalescer, calls, results = RequestCoalescer(use_redis=False), [], []
+        started, release = threading.Event(), threading.Event()
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"items": [1]}
+
+        leader = threading.Thread(target=lambda: results.append(coalescer.run("key", fetch)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(coalescer.run("key", fetch))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"items": [1]}] * 4)
+
+    def test_async_followers_get_separate_copies(self):
+        coalescer, calls = RequestCoalescer(use_redis=False), []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"items": [1]}
+
+        async def main():
+            return await asyncio.gather(*(coalescer.run_async("key", fetch) for _ in range(3)))
+
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"items": [1]}] * 3)
+        results[1]["items"].append(2)
+        self.assertEqual(results[2], {"items": [1]})
+
+    def test_leader_cancellation_does_not_fail_followers(self):
+        coalescer, calls = RequestCoalescer(use_redis=False), []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"items": [1]}
+
+        async def main():
+            leader = asyncio.ensure_future(coalescer.run_async("key", fetch))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(coalescer.run_async("key", fetch))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower, leader.cancelled()
+
+        result, leader_cancelled = asyncio.run(main())
+        self.assertTrue(leader_cancelled)
+        self.assertEqual(result, {"items": [1]})
+        self.assertEqual(len(calls), 1)
+
+    def test_async_redis_calls_run_off_the_event_loop(self):
+        coalescer, threads = RequestCoalescer(use_redis=True), {}
+        claims = iter([True, False])
+
+        def record(name, result):
+            def call(*args):
+                threads.setdefault(name, set()).add(threading.get_ident())
+                return next(claims) if result is claims else result
+            return call
+
+        async def fetch():
+            return {"items": [1]}
+
+        async def main():
+            threads["loop"] = {threading.get_ident()}
+            return await coalescer.run_async("key", fetch), await coalescer.run_async("other", fetch)
+
+        with mock.patch.object(coalescer, "_claim", record("claim", claims)), \
+                mock.patch.object(coalescer, "_poll", record("poll", (True, {"items": [2]}))), \
+                mock.patch.object(coalescer, "_publish", record("publish", None)):
+            self.assertEqual(asyncio.run(main()), ({"items": [1]}, {"items": [2]}))
+
+        for name in ("claim", "poll", "publish"):
+            self.assertTrue(threads[name].isdisjoint(threads["loop"]), name)
+
+
+class ItemsStreamDecoderTests(SimpleTestCase):
+    page = {"total": 2, "count": 2, "page": 0, "items": [
+        {"id": 1, "name": "Анна \"Ф\"", "phone": ["+375291112233"], "extra": {"nested": [1, 2]}},
+        {"id": 2, "name": "Борис", "phone": [], "extra": None},
+    ]}
+
+    def decode(self, chunks, fields=None) -> dict:
+        decoder = ItemsStreamDecoder(fields)
+        items = [item for chunk in chunks for item in decoder.feed(chunk)]
+        return {**decoder.close(), "items": items}
+
+    def test_decodes_page_split_into_single_bytes(self):
+        body = json.dumps(self.page, ensure_ascii=False).encode()
+        self.assertEqual(self.decode(body[i:i + 1] for i in range(len(body))), self.page)
+
+    def test_projects_fields(self):
+        body = json.dumps(self.page, ensure_ascii=False).encode()
+        result = self.decode([body[:17], body[17:]], fields=("id", "name"))
+        self.assertEqual(result["items"], [{"id": 1, "name": "Анна \"Ф\""}, {"id": 2, "name": "Борис"}])
+        self.assertEqual(result["total"], 2)
+
+    def test_yields_items_as_soon_as_complete(self):
+        decoder = ItemsStreamDecoder()
+        self.assertEqual(decoder.feed(b'{"total": 2, "items": [{"id": 1}, {"id"'), [{"id": 1}])
+        self.assertEqual(decoder.feed(b': 2}]}'), [{"id": 2}])
+        self.assertEqual(decoder.close(), {"total": 2})
+
+    def test_truncated_response_raises(self):
+        decoder = ItemsStreamDecoder()
+        decoder.feed(b'{"total": 2, "items": [{"id": 1}')
+        with self.assertRaises(ValueError):
+            decoder.close()
+
+
+class CRMRecordsTests(SimpleTestCase):
+    def test_customer_record(self):
+        record = CustomerRecord.from_crm({
+            "id": "7", "branch_ids": ["1", 2], "is_study": "1", "phone": "+375291112233", "balance": "12.5",
+            "paid_count": "3", "paid_till": "31.01.2030", "next_lesson_date": "2030-01-02 15:30:00", "dob": "2015-05-01",
+        })
+        self.assertEqual((record.id, record.branch_ids, record.is_study, record.phones), (7, (1, 2), 1, ("+375291112233",)))
+        self.assertEqual((record.balance, record.paid_lesson_count), (12.5, 3))
+        self.assertEqual(record.paid_till, date(2030, 1, 31))
+        self.assertEqual(record.next_lesson_date, datetime(2030, 1, 2, 15, 30))
+        self.assertEqual(record.dob, date(2015, 5, 1))
+
+    def test_bad_values_become_none(self):
+        record = CustomerRecord.from_crm({"id": 7, "is_study": None, "phone": [None, ""], "balance": "n/a",
+                                          "paid_lesson_count": "", "dob": "31.02.2015", "next_lesson_date": ""})
+        self.assertEqual((record.is_study, record.phones, record.balance, record.paid_lesson_count), (0, (), None, None))
+        self.assertIsNone(record.dob)
+        self.assertIsNone(record.next_lesson_date)
+
+    def test_lesson_record_details(self):
+        record = LessonRecord.from_crm({
+            "id": 1, "date": "2030-01-02", "time_from": "2030-01-02 15:00:00", "status": "3", "customer_ids": [10],
+            "details": [{"customer_id": 10, "reason_id": None, "is_attend": "1"}, {"customer_id": "11", "reason_id": "2", "is_attend": 0}],
+        })
+        self.assertEqual(record.date, date(2030, 1, 2))
+        self.assertEqual(record.time_from, datetime(2030, 1, 2, 15))
+        self.assertEqual(record.status, 3)
+        self.assertEqual(record.attended, {10: True, 11: False})
+        self.assertEqual(record.reasons, {10: None, 11: 2})
+        self.assertIsNone(record.reason_id)
+        self.assertEqual(record.all_customer_ids, (10, 11))
+
+    def test_active_tariff(self):
+        tariffs = to_records([
+            {"id": 1, "tariff_id": "5", "b_date": "01.01.2030", "e_date": "31.12.2030", "price": "100"},
+            {"id": 2, "tariff_id": "6", "b_date": "2030-01-01", "e_date": "2030-01-31"},
+            {"id": None, "b_date": "2030-01-01", "e_date": "2030-01-02"},
+        ], TariffRecord)
+        self.assertEqual(len(tariffs), 2)
+        self.assertEqual(tariffs[0].price, 100.0)
+        self.assertEqual(active_on(tariffs, date(2030, 1, 15)).tariff_id, 6)
+        self.assertEqual(active_on(tariffs, date(2030, 6, 1)).tariff_id, 5)
+        self.assertIsNone(active_on(tariffs, date(2031, 1, 1)))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BulkSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = AppUser.objects.create(telegram_id="100")
+        for branch_id in ("1", "2"):
+            branch = Branch.objects.create(branch_id=branch_id, name=f"Филиал {branch_id}")
+            for crm_id in (1, 2):
+                Client.objects.create(user=user, branch=branch, crm_id=f"{branch_id}{crm_id}")
+        self.streamed = []
+
+    def stream(self, items):
+        def get_all_clients_in_branches(branch_ids, is_study=0, fields=None):
+            self.streamed.append((list(branch_ids), is_study))
+            yield from items
+        return mock.patch("app_api.tasks.crm_sync.get_all_clients_in_branches", get_all_clients_in_branches)
+
+    def crm_item(self, crm_id, branch_id, **fields):
+        return {"id": crm_id, "branch_ids": [branch_id], "name": f"Клиент {crm_id}", "is_study": 1, "balance": "5", **fields}
+
+    def test_load_tracked_customers_keeps_only_tracked(self):
+        items = [self.crm_item(11, 1), self.crm_item(99, 1), self.crm_item(21, 2, phone=["291234567"]), {"id": None}]
+        with self.stream(items):
+            customers = load_tracked_customers()
+        self.assertEqual(sorted(customers), [(1, 11), (2, 21)])
+        self.assertEqual(self.streamed, [([1, 2], 2)])
+        self.assertEqual(get_phone_targets("+375291234567"), [(2, 1)])
+
+    def test_interrupted_stream_returns_loaded_customers(self):
+        def items():
+            yield self.crm_item(11, 1)
+            raise ConnectionError("обрыв")
+
+        with self.stream(items()):
+            self.assertEqual(list(load_tracked_customers()), [(1, 11)])
+
+    def test_bulk_sync_requests_only_missing_clients(self):
+        items = [self.crm_item(11, 1, balance="7"), self.crm_item(12, 1), self.crm_item(21, 2)]
+        with self.stream(items), \
+                mock.patch("app_api.tasks.crm_sync.send_request_to_crm", return_value={"items": []}) as send:
+            counts = sync_all_users_with_crm("bulk")
+
+        self.assertEqual((counts["changed"], counts["missing"], counts["failed"]), (3, 1, 0))
+        send.assert_called_once()
+        self.assertEqual(send.call_args.args[1]["id"], 22)
+        self.assertEqual(Client.objects.get(crm_id="11").balance, Decimal("7.00"))
+        self.assertFalse(Client.objects.filter(crm_id="22").exists())
+
+
+class UserStatusTests(TestCase):
+    def setUp(self):
+        branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        self.users = {}
+        for name, clients in {
+            "client": [{"is_study": True}, {"is_study": False}],
+            "lead_with_group": [{"has_scheduled_lessons": True}],
+            "lead": [{}],
+            "no_clients": [],
+        }.items():
+            user = self.users[name] = AppUser.objects.create(telegram_id=name, status="1")
+            for fields in clients:
+                Client.objects.create(user=user, branch=branch, **fields)
+
+    def statuses(self) -> dict:
+        return {name: AppUser.objects.get(pk=user.pk).status for name, user in self.users.items()}
+
+    def test_statuses_from_clients(self):
+        self.assertEqual(recompute_bot_user_statuses(), 3)
+        self.assertEqual(self.statuses(), {"client": "2", "lead_with_group": "1", "lead": "0", "no_clients": "0"})
+
+    def test_only_changed_rows_are_updated(self):
+        recompute_bot_user_statuses()
+        self.assertEqual(recompute_bot_user_statuses(), 0)
+
+        Client.objects.filter(user=self.users["lead"]).update(is_study=True)
+        self.assertEqual(recompute_bot_user_statuses(), 1)
+        self.assertEqual(self.statuses()["lead"], "2")
+
+    def test_user_ids_limit_recomputation(self):
+        self.assertEqual(recompute_bot_user_statuses([self.users["client"].pk]), 1)
+        self.assertEqual(self.statuses(), {"client": "2", "lead_with_group": "1", "lead": "1", "no_clients": "1"})
+
+    def test_update_bot_user_status(self):
+        user = self.users["lead"]
+        update_bot_user_status(user)
+        self.assertEqual(user.status, "0")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class LessonNotificationTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        Location.objects.create(branch=self.branch, location_crm_id="7", name="Локация", map_url="https://map")
+        self.clients = {}
+        for crm_id in range(1, 5):
+            user = AppUser.objects.create(telegram_id=str(100 + crm_id))
+            self.clients[crm_id] = Client.objects.create(user=user, branch=self.branch, crm_id=str(crm_id), paid_lesson_count=0)
+        mark_branch_mirrored(1, self.today - timedelta(days=1), self.today + timedelta(days=14))
+
+    def lesson(self, crm_id: int, days: int, status: int = 1, lesson_type_id: int = 2):
+        Lesson.objects.create(
+            crm_branch_id=1, crm_lesson_id=Lesson.objects.count() + 1, crm_customer_id=crm_id,
+            date=self.today + timedelta(days=days), status=status, lesson_type_id=lesson_type_id, room_id=7,
+        )
+
+    def notified(self, task) -> set[str]:
+        with mock.patch("app_api.tasks.check_clients_balance_and_notify.send_telegram_message") as send:
+            task()
+        return {call.args[0] for call in send.call_args_list}
+
+    def test_balance_notification_on_last_planned_lesson(self):
+        self.lesson(1, 0)
+        self.lesson(2, 0)
+        self.lesson(2, 7)
+        self.lesson(3, 1)
+        self.assertEqual(self.notified(check_clients_balance_and_notify), {"101"})
+
+    def test_no_notifications_before_schedule_is_loaded(self):
+        other = Branch.objects.create(branch_id="2", name="Филиал 2")
+        Client.objects.create(user=AppUser.objects.create(telegram_id="200"), branch=other, crm_id="1", paid_lesson_count=0)
+        Lesson.objects.create(crm_branch_id=2, crm_lesson_id=1, crm_customer_id=1, date=self.today, status=1, lesson_type_id=2)
+        self.assertEqual(self.notified(check_clients_balance_and_notify), set())
+
+    def test_first_lesson_requires_full_history(self):
+        self.lesson(1, 1)
+        self.lesson(2, 1)
+        self.lesson(2, -7, status=LESSON_TAUGHT)
+        self.lesson(3, 1, lesson_type_id=3)
+        self.assertEqual(self.notified(check_clients_lessons_before), {"103"})
+
+        mark_branch_mirrored(1, LESSON_MIRROR_HISTORY_START, self.today, LESSON_TAUGHT)
+        self.assertEqual(self.notified(check_clients_lessons_before), {"101", "103"})
+
+    def test_mirror_replaces_rescheduled_lessons(self):
+        item = {"id": 1, "date": self.today.isoformat(), "time_from": f"{self.today} 15:00:00", "status": 1,
+                "lesson_type_id": 2, "room_id": 7, "customer_ids": [1, 2], "details": []}
+        self.assertEqual(mirror_branch_lessons(1, [item], self.today, self.today), 2)
+
+        moved = {**item, "date": (self.today + timedelta(days=30)).isoformat(), "customer_ids": [1]}
+        mirror_branch_lessons(1, [moved], self.today + timedelta(days=30), self.today + timedelta(days=30))
+        self.assertEqual(list(Lesson.objects.values_list("crm_customer_id", "date")), [(1, self.today + timedelta(days=30))])
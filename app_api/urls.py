@@ -20,6 +20,8 @@ from app_api.views import (
     get_partner_by_id_view, get_manager, get_user_balances, get_client_payment_data, get_user_tg_links,
     find_client_by_id_view,
     telegram_callback_handler,
+    get_crm_status_view,
+    crm_metrics_view,
 )
 
 app_name = "app_crm_api"
@@ -49,4 +51,6 @@ urlpatterns = [
     path("get_user_tg_links/", get_user_tg_links, name="get_user_tg_links"),
     path("find_client_by_id_view/", find_client_by_id_view, name="find_client_by_id_view"),
     path("telegram_callback/", telegram_callback_handler, name="telegram_callback"),
+    path("crm_status/", get_crm_status_view, name="crm_status"),
+    path("metrics/", crm_metrics_view, name="crm_metrics"),
 ]
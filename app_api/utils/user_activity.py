@@ -0,0 +1,22 @@
+import os
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from app_kiberclub.models import AppUser
+
+LAST_SEEN_RESOLUTION = int(os.getenv("LAST_SEEN_RESOLUTION", 15 * 60))  # Не чаще раза в столько секунд записывать активность пользователя
+
+
+def mark_user_seen(user: AppUser):
+    """
+    Отмечает активность пользователя в боте или веб-приложении (last_seen_at).
+    ---
+    Время записывается одним UPDATE и только если прошлая отметка старше
+    LAST_SEEN_RESOLUTION, чтобы частые запросы не писали в БД.
+    """
+    now = timezone.now()
+    AppUser.objects.filter(pk=user.pk).filter(
+        Q(last_seen_at__isnull=True) | Q(last_seen_at__lt=now - timedelta(seconds=LAST_SEEN_RESOLUTION))
+    ).update(last_seen_at=now)
@@ -1,31 +1,49 @@
 import logging
-from app_kiberclub.models import Client
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from app_kiberclub.models import AppUser, Client
 
 logger = logging.getLogger(__name__)
 
 
-def update_bot_user_status(user):
+def recompute_bot_user_statuses(user_ids=None) -> int:
     """
-    Обновляет статус пользователя на основе статусов его клиентов.
+    Пересчитывает статусы пользователей по статусам их клиентов.
     ---
-    Алгоритм:
-    1. Если у пользователя есть хотя бы один клиент с is_study=True,
-       устанавливаем статус пользователя в "2" (Клиент).
-    2. Иначе, если у пользователя есть хотя бы один клиент с has_scheduled_lessons=True,
-       устанавливаем статус пользователя в "1" (Lead с группой).
-    3. Иначе, устанавливаем статус пользователя в "0" (Lead).
+    Алгоритм тот же, что в update_bot_user_status:
+    1. Есть клиент с is_study=True - статус "2" (Клиент).
+    2. Иначе есть клиент с has_scheduled_lessons=True - статус "1" (Lead с группой).
+    3. Иначе - статус "0" (Lead).
+    Статус вычисляется в самом запросе (EXISTS по клиентам), на каждое
+    значение статуса выполняется один UPDATE только тех строк, где
+    статус изменился. user_ids ограничивает пересчет пользователями,
+    None - все пользователи. Возвращает число измененных строк.
+    """
+    users = AppUser.objects.all() if user_ids is None else AppUser.objects.filter(pk__in=list(user_ids))
+    has_active_clients = Exists(Client.objects.filter(user=OuterRef("pk"), is_study=True))
+    has_scheduled_lessons = Exists(Client.objects.filter(user=OuterRef("pk"), has_scheduled_lessons=True))
+
+    conditions = {
+        "2": [has_active_clients],
+        "1": [~has_active_clients, has_scheduled_lessons],
+        "0": [~has_active_clients, ~has_scheduled_lessons],
+    }
+    updated = 0
+    with transaction.atomic():
+        for status, condition in conditions.items():
+            updated += users.filter(*condition).exclude(status=status).update(status=status)
+    if updated:
+        logger.info(f"Статусы пользователей обновлены: {updated}")
+    return updated
+
+
+def update_bot_user_status(user):
+    """
+    Обновляет статус одного пользователя на основе статусов его клиентов
+    (см. recompute_bot_user_statuses).
     """
-    # Проверяем, есть ли хотя бы один клиент с is_study=True
-    has_active_clients = Client.objects.filter(user=user, is_study=True).exists()
-
-    # Если нет активных клиентов, проверяем наличие запланированных уроков
-    if not has_active_clients:
-        has_scheduled_lessons = Client.objects.filter(
-            user=user, has_scheduled_lessons=True
-        ).exists()
-        user.status = "1" if has_scheduled_lessons else "0"
-    else:
-        user.status = "2"  # Клиент
-
-    user.save()
-    logger.info(f"Статус пользователя {user.id} обновлен: {user.status}")
\ No newline at end of file
+    recompute_bot_user_statuses([user.pk])
+    user.refresh_from_db(fields=["status"])
+    logger.info(f"Статус пользователя {user.id}: {user.status}")
@@ -7,6 +7,7 @@ from datetime import datetime
 import requests
 from dateutil.relativedelta import relativedelta
 
+from app_api.alfa_crm_service.crm_records import LessonRecord, lessons_in_month, to_records
 from app_api.alfa_crm_service.crm_service import get_client_lessons, get_curr_tariff
 
 logger = logging.getLogger(__name__)
@@ -64,35 +65,29 @@ def get_paid_summ(user_data, user_balance, curr_date):
 
 def get_curr_month_lessons(user_data, curr_date):
 
-    taught_lesson_dates = []
-    plan_lesson_dates = []
-
     taught_lessons = get_client_lessons(user_data.get("crm_id"), user_data.get("branch_id", 0), None, 3)
-    taught_lessons = taught_lessons.get("items", [])
+    taught_lessons = lessons_in_month(to_records(taught_lessons.get("items"), LessonRecord), curr_date)
 
     plan_lessons = get_client_lessons(user_data.get("crm_id"), user_data.get("branch_id", 0), None, 1)
-    plan_lessons = plan_lessons.get("items", [])
-
-    for lesson in taught_lessons:
-        reason_id = lesson.get("details")[0].get("reason_id")
-        lesson_date = datetime.strptime(lesson.get("date"), '%Y-%m-%d')
-        if lesson_date.month == curr_date.month and lesson_date.year == curr_date.year and reason_id != 1:
-            taught_lesson_dates.append({"date": lesson.get("date"), "reason": reason_id})
-
-    for lesson in plan_lessons:
-        details = lesson.get("details", [])
-        if details:
-            reason_id = details[0].get("reason_id")
-            lesson_date = datetime.strptime(lesson.get("date"), '%Y-%m-%d')
-            if lesson_date.month == curr_date.month and lesson_date.year == curr_date.year and reason_id != 1:
-                plan_lesson_dates.append({"date": lesson_date, "reason": reason_id})
+    plan_lessons = lessons_in_month(to_records(plan_lessons.get("items"), LessonRecord), curr_date)
+
+    taught_lesson_dates = [
+        {"date": lesson.date.isoformat(), "reason": lesson.reason_id}
+        for lesson in taught_lessons
+        if lesson.reason_id != 1
+    ]
+    plan_lesson_dates = [
+        {"date": lesson.date, "reason": lesson.reason_id}
+        for lesson in plan_lessons
+        if lesson.reasons and lesson.reason_id != 1
+    ]
 
     return taught_lesson_dates, plan_lesson_dates
 
 
 def get_lesson_price(user_crm_id, branch_id, curr_date):
     tariff = get_curr_tariff(user_crm_id, branch_id, curr_date)
-    price = tariff.get("price") / 4
+    price = tariff.price / 4
     return price
 
 
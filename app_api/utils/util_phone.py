@@ -0,0 +1,30 @@
+import re
+
+BELARUS_CODE = "375"
+BELARUS_NUMBER_LENGTH = 9  # Код оператора и номер без кода страны
+
+
+def normalize_phone(phone) -> str | None:
+    """
+    Приводит номер телефона к формату E.164 (+375XXXXXXXXX).
+    Если номер не похож на телефон, возвращает None.
+    ---
+    Поддерживаемые форматы:
+        - +375 (29) 123-45-67, 375291234567
+        - 8 029 123 45 67 (внутренний формат Беларуси)
+        - 291234567 (без кода страны)
+        - номера других стран с кодом страны
+    """
+    if not phone:
+        return None
+
+    digits = re.sub(r"\D", "", str(phone))
+    if digits.startswith("80") and len(digits) == BELARUS_NUMBER_LENGTH + 2:
+        digits = BELARUS_CODE + digits[2:]
+    elif len(digits) == BELARUS_NUMBER_LENGTH:
+        digits = BELARUS_CODE + digits
+
+    # E.164 допускает не больше 15 цифр
+    if not 10 <= len(digits) <= 15:
+        return None
+    return f"+{digits}"
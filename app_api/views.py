@@ -1,24 +1,30 @@
 from django.db.models import QuerySet
+from django.http import HttpResponse
 from django.shortcuts import render
+import hmac
 import logging
 import os
 from django.conf import settings
 
 from rest_framework.decorators import api_view
+from app_api.alfa_crm_service.crm_circuit_breaker import breaker_states, crm_available
+from app_api.alfa_crm_service.crm_metrics_publisher import render_metrics
 from app_api.alfa_crm_service.crm_service import (
     find_user_by_phone,
     create_user_in_crm,
     get_client_lessons,
     get_user_groups_from_crm,
-    get_group_link_from_crm,
+    get_group_note,
     find_client_by_id,
-    get_manager_from_crm,
+    find_clients_by_id,
+    find_manager_by_id,
 )
 from rest_framework import status
 from rest_framework.response import Response
 
 from app_api.utils.util_erip import set_pay
 from app_api.utils.util_parse_date import parse_date
+from app_api.utils.user_activity import mark_user_seen
 from app_api.utils.user_status_utils import update_bot_user_status
 from app_api.tasks.check_clients_balance_and_notify import send_telegram_document
 from app_kiberclub.models import AppUser, Client, Branch, ClientBonus, EripPaymentHelp, Location, PartnerCategory, PartnerClientBonus, QuestionsAnswers, SalesManager, SocialLink
@@ -51,6 +57,35 @@ def find_user_by_phone_view(request) -> Response:
         )
 
 
+@api_view(["GET"])
+def get_crm_status_view(request) -> Response:
+    """
+    Состояние предохранителей запросов к CRM в этом процессе.
+    Если CRM недоступна, бот может сразу показать упрощенный ответ.
+    """
+    return Response(
+        {"success": True, "available": crm_available(), "breakers": breaker_states()},
+        status=status.HTTP_200_OK,
+    )
+
+
+def crm_metrics_view(request) -> HttpResponse:
+    """
+    Метрики запросов к CRM в текстовом формате Prometheus.
+    ---
+    Доступны сотрудникам (is_staff) или по заголовку Authorization: Bearer
+    <CRM_METRICS_TOKEN>. Без заданного токена остальным доступ закрыт:
+    метрики раскрывают трафик по методам и вызывающим view.
+    """
+    metrics_token = os.getenv("CRM_METRICS_TOKEN")
+    authorized = bool(metrics_token) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {metrics_token}"
+    )
+    if not authorized and not getattr(request.user, "is_staff", False):
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @api_view(["POST"])
 def register_user_in_crm_view(request) -> Response:
     """
@@ -97,6 +132,7 @@ def find_user_in_db_view(request) -> Response:
     try:
         user = AppUser.objects.filter(telegram_id=telegram_id).first()
         if user:
+            mark_user_seen(user)
             return Response(
                 {
                     "success": True,
@@ -700,29 +736,14 @@ def get_manager(request, branch_id, user_crm_id):
     client_assigned_id = client.get("assigned_id")
 
     if client_assigned_id:
-        # 3. Если есть назначенный менеджер - ищем его
-        MAX_PAGES = 20
-        curr_page = 0
-
-        while curr_page < MAX_PAGES:
-            managers = get_manager_from_crm(branch_id, page=curr_page)
-            if not managers:
-                break
-
-            managers_items = managers.get("items", [])
-            if not managers_items:
-                break
-
-            for manager in managers_items:
-                if manager.get("id") == client_assigned_id:
-                    return Response(
-                        {"success": True, "data": manager, "has_assigned": True, "is_study": client.get("is_study", False)},
-                        status=status.HTTP_200_OK,
-                    )
-
-            curr_page += 1
+        # 3. Если есть назначенный менеджер - ищем его в справочнике филиала
+        manager = find_manager_by_id(branch_id, client_assigned_id)
+        if manager:
+            return Response(
+                {"success": True, "data": manager, "has_assigned": True, "is_study": client.get("is_study", False)},
+                status=status.HTTP_200_OK,
+            )
 
-        # Если прошли все страницы и не нашли менеджера
         return Response(
             {"success": False, "message": "Менеджер с ID {} не найден.".format(client_assigned_id)},
             status=status.HTTP_200_OK,
@@ -754,6 +775,7 @@ def get_user_balances(request) -> Response:
                 {"success": False, "message": "Пользователь не найден"},
                 status=status.HTTP_404_NOT_FOUND,
             )
+        mark_user_seen(user)
 
         # Получаем клиентов пользователя
         clients = Client.objects.filter(user=user)
@@ -764,14 +786,15 @@ def get_user_balances(request) -> Response:
             )
 
         # Формируем данные о балансе для каждого клиента
+        clients = list(clients.select_related("branch"))
+        clients_crm_data = find_clients_by_id([(client.branch.branch_id, client.crm_id) for client in clients])
         balances = []
-        for client in clients:
-            client_crm_data = find_client_by_id(client.branch.branch_id, client.crm_id)
+        for client, client_crm_data in zip(clients, clients_crm_data):
             balances.append(
                 {
                     "client_id": client.id,
                     "client_name": client.name,
-                    "balance": client_crm_data.get("balance", 0),
+                    "balance": (client_crm_data or {}).get("balance", 0),
                 }
             )
 
@@ -808,6 +831,7 @@ def get_client_payment_data(request) -> Response:
                 {"success": False, "message": "Пользователь не найден"},
                 status=status.HTTP_404_NOT_FOUND,
             )
+        mark_user_seen(user)
 
         logger.debug(f"Поиск клиентов для пользователя {user_id}")
         clients = Client.objects.filter(user=user)
@@ -820,14 +844,15 @@ def get_client_payment_data(request) -> Response:
 
         logger.debug(f"Сбор данных по клиентам пользователя {user_id}")
 
+        clients = list(clients.select_related("branch"))
+        clients_crm_data = find_clients_by_id([(client.branch.branch_id, client.crm_id) for client in clients])
         clients_data = []
-        for client in clients:
-            client_crm_data = find_client_by_id(client.branch.branch_id, client.crm_id)
+        for client, client_crm_data in zip(clients, clients_crm_data):
             clients_data.append(
                 {
                     "crm_id": client.crm_id,
                     "branch_id": client.branch_id,
-                    "balance": client_crm_data.get("balance", 0),
+                    "balance": (client_crm_data or {}).get("balance", 0),
                     "name": client.name,
                 }
             )
@@ -867,6 +892,7 @@ def get_user_tg_links(request) -> Response:
                 {"success": False, "message": "Пользователь не найден"},
                 status=status.HTTP_404_NOT_FOUND,
             )
+        mark_user_seen(user)
 
         clients = Client.objects.filter(user=user)
         if not clients.exists():
@@ -896,11 +922,9 @@ def get_user_tg_links(request) -> Response:
                             pass
 
                     group_id = group_item["group_id"]
-                    group_link_data = get_group_link_from_crm(client.branch_id, group_id)
-                    if group_link_data.get("total", 0) > 0:
-                        group_tg_link = group_link_data.get("items", [])[0].get("note", None)
-                        if group_tg_link and group_tg_link not in group_tg_links:
-                            group_tg_links.append(group_tg_link)
+                    group_tg_link = get_group_note(client.branch_id, group_id)
+                    if group_tg_link and group_tg_link not in group_tg_links:
+                        group_tg_links.append(group_tg_link)
         return Response({"success": True, "data": group_tg_links}, status=status.HTTP_200_OK)
     except Exception as e:
         return Response(
@@ -978,6 +1002,7 @@ def find_client_by_id_view(request) -> Response:
                 {"success": False, "message": "Пользователь не найден"},
                 status=status.HTTP_404_NOT_FOUND,
             )
+        mark_user_seen(user)
 
         clients = Client.objects.filter(user=user)
         if not clients.exists():
@@ -986,9 +1011,10 @@ def find_client_by_id_view(request) -> Response:
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+        clients = list(clients)
+        crm_results = find_clients_by_id([(client.branch_id, client.crm_id) for client in clients])
         results = []
-        for client in clients:
-            result = find_client_by_id(client.branch_id, client.crm_id)
+        for client, result in zip(clients, crm_results):
             if result:
                 results.append({"client_crm_id": client.crm_id, "data": result})
             else:
@@ -49,7 +49,7 @@ class BotUserAdmin(admin.ModelAdmin):
     Админ-класс для модели BotUser.
     """
 
-    list_display = ["phone_number", "telegram_id", "username", "client_count"]
+    list_display = ["phone_number", "telegram_id", "username", "client_count", "last_seen_at"]
     search_fields = ["telegram_id", "phone_number"]
     inlines = [ClientInline]  # Добавляем inline для клиентов
 
@@ -68,7 +68,7 @@ class ClientAdmin(admin.ModelAdmin):
     Админ-класс для модели Client.
     """
 
-    list_display = ["__str__", "branch", "crm_id", "is_study"]
+    list_display = ["__str__", "branch", "crm_id", "is_study", "last_synced_at"]
     list_filter = ["is_study", "branch"]
     search_fields = ["crm_id", "user__username", "user__telegram_id"]
 
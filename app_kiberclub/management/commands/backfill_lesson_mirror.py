@@ -0,0 +1,33 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app_api.alfa_crm_service.crm_lesson_mirror import LESSON_MIRROR_BACKFILL_DAYS, LESSON_MIRROR_HISTORY_START
+from app_api.alfa_crm_service.crm_service import backfill_lesson_history, refresh_lesson_schedule
+
+
+class Command(BaseCommand):
+    help = 'Заполняет зеркало уроков CRM: расписание и полную историю проведенных уроков (после развертывания или простоя)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help=f'С какой даты загружать историю, ГГГГ-ММ-ДД (по умолчанию {LESSON_MIRROR_HISTORY_START})')
+        parser.add_argument('--no-schedule', action='store_true', help='Не загружать расписание')
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['since']) if options['since'] else LESSON_MIRROR_HISTORY_START
+        except ValueError:
+            raise CommandError(f'Неверная дата: {options["since"]}')
+
+        if not options['no_schedule']:
+            mirrored = refresh_lesson_schedule()
+            self.stdout.write(self.style.SUCCESS(f'Расписание загружено: {mirrored} записей'))
+
+        # Окна загружаются по очереди в этом процессе, без лимита времени задачи
+        today = date.today()
+        while start <= today:
+            mirrored = backfill_lesson_history(start.isoformat(), follow=False)
+            end = min(start + timedelta(days=LESSON_MIRROR_BACKFILL_DAYS - 1), today)
+            self.stdout.write(f'История за {start}..{end}: {mirrored} записей')
+            start = end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS('История проведенных уроков загружена'))
@@ -0,0 +1,226 @@
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client as TestClient
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from app_api.alfa_crm_service.crm_rate_limiter import rate_limiter
+from app_api.alfa_crm_service.crm_stub import STUB_TOKEN, CRMStub, generate_dataset
+from app_api.alfa_crm_service.crm_token import token_manager
+from app_api.alfa_crm_service.crm_transport import get_crm_transport
+from app_kiberclub.models import AppUser, Branch, Client, Location
+
+BENCHMARK_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+VIEW_OK_STATUSES = (200,)  # Остальные ответы эндпоинтов считаются ошибками
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """
+    Перцентиль методом ближайшего ранга.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def seed_database(data: dict) -> list[dict]:
+    """
+    Создает филиалы, родителей и детей из синтетических данных заглушки.
+    Возвращает родителей: telegram_id, телефон, дети (branch_id, crm_id)
+    и дети, которые ходят в группу (у них есть уроки).
+    """
+    in_groups = {(item["branch_id"], item["customer_id"]) for item in data["cgi"]}
+    branch_ids = sorted({customer["branch_ids"][0] for customer in data["customers"].values()})
+    branches = {branch_id: Branch.objects.create(branch_id=str(branch_id), name=f"Филиал {branch_id}") for branch_id in branch_ids}
+    for room_id in range(1, 11):
+        Location.objects.create(branch=branches[branch_ids[0]], location_crm_id=str(room_id), name=f"Локация {room_id}")
+
+    parents = {}
+    for customer in data["customers"].values():
+        phone = customer["phone"][0]
+        parent = parents.setdefault(
+            phone, {"phone": phone, "telegram_id": str(100000 + len(parents)), "children": [], "students": []}
+        )
+        child = (customer["branch_ids"][0], customer["id"])
+        parent["children"].append(child)
+        if child in in_groups:
+            parent["students"].append(child)
+
+    for parent in parents.values():
+        user = AppUser.objects.create(telegram_id=parent["telegram_id"], phone_number=parent["phone"])
+        Client.objects.bulk_create(
+            [
+                Client(user=user, branch=branches[branch_id], crm_id=str(crm_id), name=data["customers"][crm_id]["name"])
+                for branch_id, crm_id in parent["children"]
+            ]
+        )
+    return list(parents.values())
+
+
+def post_json(path: str, payload: dict):
+    return TestClient().post(path, data=json.dumps(payload), content_type="application/json")
+
+
+def view_scenarios(parents: list[dict]) -> dict:
+    """
+    Горячие эндпоинты app_api: сценарий -> (вызов, родители для вызова),
+    один вызов на случайного родителя. Все родители и их дети есть
+    в заглушке, поэтому успешный вызов - ответ 200.
+    """
+    def child(parent):
+        return random.choice(parent["children"])
+
+    students = [parent for parent in parents if parent["students"]]
+    return {
+        "find_user_in_crm": (lambda parent: post_json("/api/find_user_in_crm/", {"phone_number": parent["phone"]}), parents),
+        "get_user_balances": (lambda parent: post_json("/api/get_user_balances/", {"telegram_id": parent["telegram_id"]}), parents),
+        "find_client_by_id_view": (
+            lambda parent: post_json("/api/find_client_by_id_view/", {"user_id": parent["telegram_id"]}),
+            parents,
+        ),
+        # Уроки есть только у детей из групп
+        "get_user_lessons": (
+            lambda parent: post_json(
+                "/api/get_user_lessons/", dict(zip(("branch_id", "user_crm_id"), random.choice(parent["students"])))
+            ),
+            students,
+        ),
+        "get_manager": (lambda parent: TestClient().get("/api/get_manager/{}/{}/".format(*child(parent))), parents),
+    }
+
+
+def task_scenarios() -> dict:
+    """
+    Celery-задачи, которые обращаются к CRM (выполняются синхронно).
+    """
+    from app_api.alfa_crm_service.crm_service import (
+        rebuild_customer_phone_index,
+        refresh_crm_metadata,
+        refresh_manager_index,
+    )
+    from app_api.tasks.crm_sync import sync_all_users_with_crm
+
+    # Шардированный режим требует брокера, поэтому синхронизация измеряется в процессе
+    return {
+        "sync_all_users_with_crm[bulk]": lambda: sync_all_users_with_crm(mode="bulk"),
+        "sync_all_users_with_crm[per_client]": lambda: sync_all_users_with_crm(mode="per_client"),
+        "refresh_manager_index": refresh_manager_index,
+        "refresh_crm_metadata": refresh_crm_metadata,
+        "rebuild_customer_phone_index": rebuild_customer_phone_index,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест эндпоинтов и задач, обращающихся к CRM, на локальной заглушке AlfaCRM (без сети)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help='Какие сценарии запустить (по умолчанию все)')
+        parser.add_argument('--iterations', type=int, default=50, help='Вызовов каждого эндпоинта')
+        parser.add_argument('--task-iterations', type=int, default=1, help='Запусков каждой задачи')
+        parser.add_argument('--concurrency', type=int, default=4, help='Одновременных вызовов эндпоинта')
+        parser.add_argument('--parents', type=int, default=50, help='Родителей (телефонов) на филиал')
+        parser.add_argument('--latency', type=float, default=0.05, help='Средняя задержка заглушки, секунд')
+        parser.add_argument('--jitter', type=float, default=0.3, help='Разброс задержки (доля от средней)')
+        parser.add_argument('--rate-429', type=float, default=0.0, help='Доля ответов 429')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора данных')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        data = generate_dataset(parents_per_branch=options['parents'], seed=options['seed'])
+        stub = CRMStub(data, latency=options['latency'], jitter=options['jitter'], rate_429=options['rate_429'], seed=options['seed'])
+        address = stub.start()
+
+        # Все запросы идут в заглушку; токен и кэши не затрагивают рабочий Redis
+        transport = get_crm_transport()
+        transport.close()
+        transport.scheme, transport.hostname = "http", address
+        rate_limiter.enabled = False
+        token_manager.use_token(STUB_TOKEN)
+
+        self.stdout.write(f'Заглушка AlfaCRM: http://{address}, {len(data["customers"])} клиентов')
+
+        with override_settings(CACHES=BENCHMARK_CACHES, ALLOWED_HOSTS=["testserver"]):
+            setup_test_environment()
+            # Файловая тестовая БД: общая БД в памяти SQLite блокирует таблицы
+            # при одновременной записи из потоков (database table is locked)
+            connection.settings_dict.setdefault("TEST", {})
+            if connection.vendor == "sqlite" and not connection.settings_dict["TEST"].get("NAME"):
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), "benchmark_crm.sqlite3")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                parents = seed_database(data)
+                results = self.run_scenarios(stub, parents, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+                stub.stop()
+
+        self.report(results)
+
+    def run_scenarios(self, stub: CRMStub, parents: list[dict], options) -> list[dict]:
+        views = view_scenarios(parents)
+        tasks = task_scenarios()
+        selected = options['scenarios'] or list(views) + list(tasks)
+        unknown = set(selected) - set(views) - set(tasks)
+        if unknown:
+            raise CommandError(f'Неизвестные сценарии: {", ".join(sorted(unknown))}')
+
+        results = []
+        for name in selected:
+            stub.calls.clear()
+            if name in views:
+                view, pool = views[name]
+                iterations = options['iterations']
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                    timings = list(
+                        executor.map(lambda _: self.timed(view, random.choice(pool), VIEW_OK_STATUSES), range(iterations))
+                    )
+            else:
+                task = tasks[name]
+                iterations = options['task_iterations']
+                timings = [self.timed(lambda _: task(), None) for _ in range(iterations)]
+
+            durations = [duration for duration, _ in timings]
+            results.append({
+                "name": name,
+                "ops": iterations,
+                "errors": sum(1 for _, ok in timings if not ok),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "p99": percentile(durations, 99),
+                "crm_calls": sum(stub.calls.values()),
+                "calls": dict(stub.calls),
+            })
+            self.stdout.write(f'  {name}: готово')
+        return results
+
+    @staticmethod
+    def timed(func, argument, ok_statuses: tuple = (200,)) -> tuple[float, bool]:
+        started = time.perf_counter()
+        try:
+            response = func(argument)
+            # У задач нет ответа HTTP: успех - завершение без исключения
+            ok = response is None or not hasattr(response, "status_code") or response.status_code in ok_statuses
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def report(self, results: list[dict]):
+        header = f'{"Сценарий":<30} {"вызовов":>8} {"ошибок":>7} {"p50, мс":>9} {"p95, мс":>9} {"p99, мс":>9} {"CRM/вызов":>10}'
+        self.stdout.write(self.style.SUCCESS(header))
+        for result in results:
+            self.stdout.write(
+                f'{result["name"]:<30} {result["ops"]:>8} {result["errors"]:>7} '
+                f'{result["p50"] * 1000:>9.1f} {result["p95"] * 1000:>9.1f} {result["p99"] * 1000:>9.1f} '
+                f'{result["crm_calls"] / max(result["ops"], 1):>10.1f}'
+            )
+        for result in results:
+            self.stdout.write(f'{result["name"]}: {result["calls"]}')
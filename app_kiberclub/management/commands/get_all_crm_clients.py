@@ -11,9 +11,11 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('branch_id', type=int, help='ID филиала в CRM')
+        parser.add_argument('--fields', help='Какие поля клиентов сохранить, через запятую (по умолчанию все)')
 
     def handle(self, *args, **options):
         branch_id = options['branch_id']
+        fields = tuple(field.strip() for field in options['fields'].split(',')) if options['fields'] else None
         self.stdout.write(self.style.SUCCESS(f'Получение клиентов из CRM для филиала с ID: {branch_id}'))
         
         # Создаем директорию fixtures, если она не существует
@@ -24,26 +26,31 @@ class Command(BaseCommand):
         output_file = os.path.join(fixtures_dir, f'crm_clients_branch_{branch_id}.json')
         
         try:
-            # Получаем всех клиентов из CRM
-            clients = get_all_clients(branch_id)
-            
-            if clients:
-                # Сохраняем результаты в JSON-файл
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(clients, f, ensure_ascii=False, indent=4)
-                
+            # Клиенты записываются в файл по мере загрузки, весь список в памяти не держится
+            count = 0
+            examples = []
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write('[')
+                for client in get_all_clients(branch_id, fields=fields):
+                    f.write(',\n' if count else '\n')
+                    f.write(json.dumps(client, ensure_ascii=False, indent=4))
+                    if len(examples) < 3:
+                        examples.append(client)
+                    count += 1
+                f.write('\n]\n')
+
+            if count:
                 self.stdout.write(self.style.SUCCESS(
                     f'Данные успешно получены и сохранены в {output_file}'
                 ))
-                self.stdout.write(self.style.SUCCESS(f'Всего получено клиентов: {len(clients)}'))
+                self.stdout.write(self.style.SUCCESS(f'Всего получено клиентов: {count}'))
                 
                 # Выводим примеры полученных данных
-                if len(clients) > 0:
-                    self.stdout.write(self.style.SUCCESS('Примеры полученных данных:'))
-                    for i, client in enumerate(clients[:3]):
-                        self.stdout.write(f"Клиент {i+1}: {client.get('name', 'Нет имени')} (ID: {client.get('id', 'Нет ID')})")
-                    if len(clients) > 3:
-                        self.stdout.write(f"... и еще {len(clients) - 3} клиентов")
+                self.stdout.write(self.style.SUCCESS('Примеры полученных данных:'))
+                for i, client in enumerate(examples):
+                    self.stdout.write(f"Клиент {i+1}: {client.get('name', 'Нет имени')} (ID: {client.get('id', 'Нет ID')})")
+                if count > 3:
+                    self.stdout.write(f"... и еще {count - 3} клиентов")
             else:
                 self.stdout.write(self.style.WARNING('Не удалось получить данные клиентов из CRM'))
         
@@ -32,7 +32,7 @@ class Command(BaseCommand):
         # Получаем всех клиентов из базы данных
         branch_ids = [1, 2, 3, 4]
         for branch in branch_ids:
-            clients = get_all_clients(branch)
+            clients = get_all_clients(branch, fields=("id", "name", "branch_ids"))
             
             # Проверяем, существует ли файл, и если нет, создаем его с заголовками
             file_exists = os.path.isfile(output_file)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app_api.alfa_crm_service.crm_service import (
+    invalidate_crm_metadata,
+    invalidate_manager_index,
+    invalidate_tariff_catalog,
+)
+
+INVALIDATORS = {
+    "tariffs": invalidate_tariff_catalog,
+    "managers": invalidate_manager_index,
+    "metadata": invalidate_crm_metadata,
+}
+
+
+class Command(BaseCommand):
+    help = 'Сбрасывает кэшированные справочники CRM (например, после изменения тарифов)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Какие справочники сбросить: {", ".join(INVALIDATORS)} (по умолчанию все)')
+        parser.add_argument('--branch', type=int, help='ID филиала в CRM (по умолчанию все филиалы)')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(INVALIDATORS)
+        unknown = set(names) - set(INVALIDATORS)
+        if unknown:
+            raise CommandError(f'Неизвестные справочники: {", ".join(sorted(unknown))}')
+
+        for name in names:
+            INVALIDATORS[name](options['branch'])
+            self.stdout.write(self.style.SUCCESS(f'Справочник "{name}" сброшен'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from app_api.alfa_crm_service.crm_stub import CRMStub, generate_dataset
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальную заглушку AlfaCRM на синтетических данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес сервера')
+        parser.add_argument('--port', type=int, default=8765, help='Порт сервера')
+        parser.add_argument('--parents', type=int, default=100, help='Родителей (телефонов) на филиал')
+        parser.add_argument('--latency', type=float, default=0.05, help='Средняя задержка ответа, секунд')
+        parser.add_argument('--jitter', type=float, default=0.3, help='Разброс задержки (доля от средней)')
+        parser.add_argument('--rate-429', type=float, default=0.0, help='Доля ответов 429')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора данных')
+
+    def handle(self, *args, **options):
+        data = generate_dataset(parents_per_branch=options['parents'], seed=options['seed'])
+        stub = CRMStub(data, latency=options['latency'], jitter=options['jitter'], rate_429=options['rate_429'], seed=options['seed'])
+        server = stub.make_server(options['host'], options['port'])
+        address = f"{server.server_address[0]}:{server.server_address[1]}"
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Заглушка AlfaCRM запущена на http://{address}: {len(data["customers"])} клиентов, {len(data["lessons"])} уроков'
+        ))
+        self.stdout.write(f'Для подключения: CRM_SCHEME=http CRM_HOSTNAME={address} CRM_RATE_LIMIT_ENABLED=0')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'Вызовы по методам: {dict(stub.calls)}')
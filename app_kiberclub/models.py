@@ -120,6 +120,7 @@ class AppUser(models.Model):
         null=True,
         verbose_name="Номер телефона",
     )
+    last_seen_at = models.DateTimeField(blank=True, null=True, verbose_name="Последняя активность")
 
     def __str__(self):
         return f"{self.username or 'Пользователь'} (ID: {self.telegram_id})"
@@ -160,6 +161,8 @@ class Client(models.Model):
         null=True,
         blank=True,
     )
+    crm_hash = models.CharField(max_length=40, blank=True, null=True, verbose_name="Хэш данных CRM")
+    last_synced_at = models.DateTimeField(blank=True, null=True, verbose_name="Синхронизирован с CRM")
 
     def __str__(self):
         return f"{self.name or 'noname'} | (Родитель: {self.user})"
@@ -9,11 +9,13 @@ from django.http import JsonResponse, HttpRequest, HttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from oauth2client.service_account import ServiceAccountCredentials
 
+from app_api.alfa_crm_service.crm_circuit_breaker import crm_available
 from app_api.alfa_crm_service.crm_service import (
     get_client_lessons,
-    get_client_lesson_name,
+    get_subject_name,
     get_client_kiberons,
 )
+from app_api.utils.user_activity import mark_user_seen
 from app_kiberclub.models import AppUser, Client, Location, RunningLine
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
@@ -45,6 +47,7 @@ def index(request: HttpRequest) -> HttpResponse:
 
         bot_user = get_object_or_404(AppUser, telegram_id=telegram_id_from_req)
         logger.debug(f"Найден пользователь: {bot_user.telegram_id}")
+        mark_user_seen(bot_user)
 
         user_clients = Client.objects.filter(user=bot_user)
         logger.debug(f"Найдено профилей клиентов: {user_clients.count()}")
@@ -119,16 +122,8 @@ def open_profile(request):
             subject_id = lesson.get("subject_id")
             logger.debug(f"Последний урок: room_id={room_id}, subject_id={subject_id}")
 
-            lesson_info = get_client_lesson_name(branch_id, subject_id)
-            logger.debug(f"Информация о названии урока: {lesson_info}")
-
-            if lesson_info.get("total") > 0:
-                all_lesson_items = lesson_info.get("items")
-                lesson_name = ""
-                for item in all_lesson_items:
-                    if item.get("id") == subject_id:
-                        lesson_name = item.get("name", "")
-                        logger.debug(f"Название урока найдено: {lesson_name}")
+            lesson_name = get_subject_name(branch_id, subject_id) or ""
+            logger.debug(f"Название урока: {lesson_name}")
 
             if room_id:
                 logger.debug(f"Установлен room_id в сессию: {room_id}")
@@ -149,24 +144,23 @@ def open_profile(request):
                 )
 
                 kiberons = get_client_kiberons(branch_id, client.crm_id)
+                if kiberons is None and not crm_available("bonus"):
+                    kiberons = "—"
 
                 context["client"].update(
                     {
                         "kiberons_count": kiberons if kiberons else "0",
                     }
                 )
-
-                # Add running line to context
-                running_line = RunningLine.objects.first()
-                if running_line and running_line.is_active:
-                    context["running_line_text"] = running_line.text
-                else:
-                    context["running_line_text"] = None
+                context["running_line_text"] = get_running_line_text()
 
                 return render(request, "app_kiberclub/client_card.html", context)
             else:
                 logger.warning(f"room_id не найден для урока клиента {client_id}")
                 return redirect("app_kiberclub:error_page")
+        elif not crm_available("lesson"):
+            logger.warning(f"CRM недоступна, профиль клиента {client_id} показан по данным из БД")
+            return render_degraded_client_card(request, context)
         else:
             logger.warning(f"У клиента {client_id} нет активных уроков")
             return redirect("app_kiberclub:error_page")
@@ -175,6 +169,35 @@ def open_profile(request):
         return redirect("app_kiberclub:error_page")
 
 
+def get_running_line_text() -> str | None:
+    running_line = RunningLine.objects.first()
+    if running_line and running_line.is_active:
+        return running_line.text
+    return None
+
+
+def render_degraded_client_card(request, context: dict) -> HttpResponse:
+    """
+    Карточка клиента, когда CRM недоступна: только данные из БД,
+    без запросов к CRM (урок, кибероны и резюме не показываются).
+    """
+    room_id = request.session.get("room_id")
+    location = Location.objects.filter(location_crm_id=room_id).first() if room_id else None
+
+    context["client"].update(
+        {
+            "location_name": location.name if location else "",
+            "lesson_name": "",
+            "resume": "Появится позже",
+            "room_id": room_id,
+            "kiberons_count": "—",
+        }
+    )
+    context["running_line_text"] = get_running_line_text()
+    context["crm_unavailable"] = True
+    return render(request, "app_kiberclub/client_card.html", context)
+
+
 def error_page_view(request):
     return render(request, "app_kiberclub/error_page.html")
 
@@ -10,3 +10,31 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_scheduler = "django_celery_beat.schedulers:DatabaseScheduler"
+
+# Периодические задачи кода; остальные расписания настраиваются в админке django_celery_beat
+app.conf.beat_schedule = {
+    "refresh-crm-manager-index": {
+        "task": "app_api.alfa_crm_service.crm_service.refresh_manager_index",
+        "schedule": 60 * 60,
+    },
+    "refresh-crm-metadata": {
+        "task": "app_api.alfa_crm_service.crm_service.refresh_crm_metadata",
+        "schedule": 30 * 60,
+    },
+    "sync-crm-priority-clients": {
+        "task": "app_api.tasks.crm_sync.sync_priority_clients",
+        "schedule": 10 * 60,
+    },
+    "refresh-crm-lesson-schedule": {
+        "task": "app_api.alfa_crm_service.crm_service.refresh_lesson_schedule",
+        "schedule": 30 * 60,
+    },
+    "refresh-crm-lesson-history": {
+        "task": "app_api.alfa_crm_service.crm_service.refresh_lesson_history",
+        "schedule": 24 * 60 * 60,
+    },
+    "rebuild-crm-phone-index": {
+        "task": "app_api.alfa_crm_service.crm_service.rebuild_customer_phone_index",
+        "schedule": 24 * 60 * 60,
+    },
+}